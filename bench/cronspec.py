@@ -0,0 +1,64 @@
+"""
+Benchmark the compiled cron engine against the `crontab` library, which is
+installed with the "bench" extra.
+
+    pip install -e .[bench]
+    python -m bench.cronspec
+"""
+
+import crontab
+import time
+import timeit
+from cronredux import cronspec
+
+SPECS = [
+    '* * * * *',
+    '*/5 * * * *',
+    '0 * * * *',
+    '0 0 * * *',
+    '15,45 8-17 * * mon-fri',
+    '0 9 1-7 * 1',
+    '0 0 1 1 *',
+]
+
+
+def report(label, seconds, count):
+    print('%-40s %10.2f us/op' % (label, seconds / count * 1e6))
+
+
+def main(number=2000):
+    now = time.time()
+    print('Single next() call, %d iterations per spec' % number)
+    for spec in SPECS:
+        ct = crontab.CronTab(spec)
+        cs = cronspec.CronSpec(spec)
+        t = timeit.timeit(lambda: ct.next(now=now, default_utc=False),
+                          number=number)
+        report('crontab   %s' % spec, t, number)
+        t = timeit.timeit(lambda: cs.next(now), number=number)
+        report('cronspec  %s' % spec, t, number)
+    print()
+    # A crontab sized workload: many lines sharing a handful of specs.
+    lines = SPECS * 200
+    n = 10
+    cts = [crontab.CronTab(x) for x in lines]
+    css = [cronspec.CronSpec(x) for x in lines]
+
+    def crontab_next_n():
+        for ct in cts:
+            t = now
+            for i in range(n):
+                t += ct.next(now=t, default_utc=False)
+
+    print('Next %d fire times for %d lines' % (n, len(lines)))
+    t = timeit.timeit(crontab_next_n, number=1)
+    report('crontab   loop', t, len(lines))
+    t = timeit.timeit(lambda: cronspec.batch_next_n(css, n, now), number=1)
+    report('cronspec  batch_next_n', t, len(lines))
+    t = timeit.timeit(lambda: cronspec.batch_window(css, now, now + 86400),
+                      number=1)
+    report('cronspec  batch_window (1 day)', t, len(lines))
+
+
+if __name__ == '__main__':
+    main()
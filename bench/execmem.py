@@ -0,0 +1,111 @@
+"""
+Benchmark the per-execution footprint of `TaskExecContext`.
+
+The legacy layout (a `__dict__` instance with pendulum timestamps, string
+states and `pendulum.Interval` run time accumulation) is reproduced here for
+comparison with the current slotted, monotonic clock implementation.
+
+    python -m bench.execmem
+"""
+
+import gc
+import itertools
+import pendulum
+import timeit
+import tracemalloc
+from cronredux import cronspec, scheduler
+
+
+class LegacyExecContext(object):
+    """ TaskExecContext as it was before slots and raw clock readings. """
+
+    def __init__(self, task, loop):
+        self.queued = None
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.output = ''
+        self.output_size = 0
+        self.output_file = None
+        self.rusage = None
+        self.alarm = None
+        self.timeout_alarm = None
+        self.timed_out = False
+        self.process = None
+        self.reader = None
+        self.state = 'init'
+        self.ident = next(task.context_identer)
+        self.task = task
+        self.loop = loop
+
+    def set_queued(self):
+        self.queued = pendulum.now()
+        self.state = 'queued'
+
+    def set_start(self):
+        self.started = pendulum.now()
+        self.state = 'start'
+
+    def set_finish(self, returncode, output):
+        self.finished = pendulum.now()
+        self.state = 'finish'
+        self.output = output
+        self.returncode = returncode
+
+    @property
+    def elapsed(self):
+        return self.finished - self.started
+
+
+def legacy_lifecycle(task, totals):
+    context = LegacyExecContext(task, None)
+    context.set_queued()
+    context.set_start()
+    context.set_finish(0, '')
+    totals[0] += context.elapsed
+    return context
+
+
+def lifecycle(task, totals):
+    context = scheduler.TaskExecContext(task, None)
+    context.set_queued()
+    context.set_start()
+    context.set_finish(0, '')
+    totals[0] += context.elapsed_seconds
+    return context
+
+
+def footprint(fn, task, totals, count):
+    """ Bytes retained per execution and peak bytes allocated per execution
+    while running `count` executions and keeping them (as the history cache
+    does). """
+    gc.collect()
+    tracemalloc.start()
+    keep = [fn(task, totals) for i in range(count)]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return retained / count, peak / count
+
+
+def report(label, retained, peak, seconds, count):
+    print('%-10s %10.0f B retained %10.0f B peak %10.2f us/exec' % (
+          label, retained, peak, seconds / count * 1e6))
+
+
+def main(count=10000):
+    task = scheduler.Task(cronspec.intern('* * * * *'), 'true')
+    task.context_identer = itertools.count()
+    print('Execution lifecycle (queue, start, finish, accumulate run time), '
+          '%d executions' % count)
+    for label, fn, total in (('legacy', legacy_lifecycle,
+                              pendulum.Interval()),
+                             ('current', lifecycle, 0.0)):
+        totals = [total]
+        retained, peak = footprint(fn, task, totals, count)
+        seconds = timeit.timeit(lambda: fn(task, totals), number=count)
+        report(label, retained, peak, seconds, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark task spawn throughput and latency for shell and direct exec modes.
+
+Each mode runs the same trivial command through `Task.__call__`, first one
+execution at a time (latency) and then `concurrency` at a time (throughput).
+
+    python -m bench.spawn
+"""
+
+import asyncio
+import itertools
+import time
+from cronredux import cronspec, output, scheduler
+
+COMMAND = 'uname -s'
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+@asyncio.coroutine
+def execute(task, loop):
+    context = scheduler.TaskExecContext(task, loop)
+    context.set_queued()
+    context.set_start()
+    start = time.monotonic()
+    yield from context.run_task(output.OutputCapture())
+    return time.monotonic() - start
+
+
+@asyncio.coroutine
+def latency(task, loop, count):
+    times = []
+    for i in range(count):
+        times.append((yield from execute(task, loop)))
+    return times
+
+
+@asyncio.coroutine
+def throughput(task, loop, count, concurrency):
+    sem = asyncio.Semaphore(concurrency, loop=loop)
+
+    @asyncio.coroutine
+    def one():
+        yield from sem.acquire()
+        try:
+            yield from execute(task, loop)
+        finally:
+            sem.release()
+    start = time.monotonic()
+    yield from asyncio.gather(*[one() for i in range(count)], loop=loop)
+    return count / (time.monotonic() - start)
+
+
+def main(count=500, concurrency=16):
+    loop = asyncio.get_event_loop()
+    spec = cronspec.intern('* * * * *')
+    modes = (('shell', {"exec": False}), ('exec', {"exec": True}))
+    print('Spawn "%s", %d executions per mode, %d concurrent for throughput'
+          % (COMMAND, count, concurrency))
+    for label, options in modes:
+        task = scheduler.Task(spec, COMMAND, options)
+        task.context_identer = itertools.count()
+        times = loop.run_until_complete(latency(task, loop, count))
+        rate = loop.run_until_complete(throughput(task, loop, count,
+                                                  concurrency))
+        print('%-6s p50 %8.2f ms  p99 %8.2f ms  %8.1f spawns/s' % (
+              label, percentile(times, 50) * 1e3,
+              percentile(times, 99) * 1e3, rate))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Time source for scheduling.
+
+The scheduler reads the time through `time` and `monotonic` here instead of
+the `time` module so a `VirtualClock` can be swapped in (see `use`) to replay
+a crontab faster than real time.
+"""
+
+import time as _time
+
+
+class SystemClock(object):
+    """ The real wall and monotonic clocks. """
+
+    time = staticmethod(_time.time)
+    monotonic = staticmethod(_time.monotonic)
+
+
+class VirtualClock(object):
+    """ A clock that only moves when it is told to.  Wall time starts at
+    `start` (epoch seconds) and the monotonic clock at 0. """
+
+    def __init__(self, start=None):
+        self.start = _time.time() if start is None else start
+        self.elapsed = 0.0
+
+    def time(self):
+        return self.start + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.elapsed += seconds
+
+
+current = SystemClock()
+
+
+def use(clock):
+    """ Make `clock` the time source and return the previous one. """
+    global current
+    previous, current = current, clock
+    return previous
+
+
+def time():
+    return current.time()
+
+
+def monotonic():
+    return current.monotonic()
@@ -0,0 +1,578 @@
+"""
+Share one crontab between several cronredux nodes.
+
+Tasks are spread over the live nodes by consistent hashing and only the
+owner of a task fires it.  Ownership alone can't guarantee a run happens
+exactly once (nodes may briefly disagree on who is alive), so each firing is
+also claimed, as a (task, fire time) slot, from a lease backend that grants
+it to one node only.
+
+Nodes heartbeat into the backend every `ttl / 3` seconds and are considered
+dead once a heartbeat is `ttl` seconds old.  The other nodes wait for that
+before taking over the runs a dead node was due to make, so with the default
+ttl of 15 a failed node's tasks move within one scheduling tick.
+
+Backends are picked by URL:
+
+    sqlite:///var/lib/cronredux/leases.db   nodes on one host
+    file:///var/lib/cronredux/leases        nodes on one host (lock files)
+    tcp://127.0.0.1:7908                    a `cronredux coordinator`
+"""
+
+import asyncio
+import bisect
+import concurrent.futures
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import urllib.parse
+from cronredux import clock
+
+
+def hash_key(key):
+    """ A hash of `key` that is the same in every process. """
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """ Consistent hashing of keys onto nodes.  Each node has `replicas`
+    points on the ring so keys spread evenly and only the keys of a node
+    that comes or goes change owner. """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.nodes = tuple(sorted(set(nodes)))
+        self.replicas = replicas
+        points = sorted((hash_key('%s#%d' % (node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self.points = [x[0] for x in points]
+        self.owners = [x[1] for x in points]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, hash_key(key)) % len(self.points)
+        return self.owners[i]
+
+
+class SQLiteLeases(object):
+    """ Leases in an SQLite database shared by the nodes of one host.
+    Queries run on a dedicated thread so the event loop never waits on the
+    database lock. """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS nodes ('
+        '    node TEXT PRIMARY KEY,'
+        '    expires REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS claims ('
+        '    slot TEXT PRIMARY KEY,'
+        '    node TEXT NOT NULL,'
+        '    expires REAL NOT NULL)',
+    )
+
+    def __init__(self, path, loop):
+        self.path = path
+        self.loop = loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.db = None
+
+    def __str__(self):
+        return 'sqlite://%s' % self.path
+
+    def call(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def connect(self):
+        """ Runs in the executor thread which owns the connection. """
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=10)
+            with self.db:
+                for x in self.schema:
+                    self.db.execute(x)
+        return self.db
+
+    def do_heartbeat(self, node, ttl):
+        db = self.connect()
+        now = clock.time()
+        with db:
+            db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?)',
+                       (node, now + ttl))
+            db.execute('DELETE FROM nodes WHERE expires < ?', (now,))
+            db.execute('DELETE FROM claims WHERE expires < ?', (now,))
+            cursor = db.execute('SELECT node FROM nodes ORDER BY node')
+            return [x[0] for x in cursor]
+
+    def do_claim(self, slot, node, ttl):
+        db = self.connect()
+        with db:
+            cursor = db.execute('INSERT OR IGNORE INTO claims VALUES '
+                                '(?, ?, ?)', (slot, node, clock.time() + ttl))
+            return cursor.rowcount == 1
+
+    def do_leave(self, node):
+        db = self.connect()
+        with db:
+            db.execute('DELETE FROM nodes WHERE node = ?', (node,))
+
+    @asyncio.coroutine
+    def heartbeat(self, node, ttl):
+        """ Renew the lease of `node` for `ttl` seconds and return every live
+        node. """
+        return (yield from self.call(self.do_heartbeat, node, ttl))
+
+    @asyncio.coroutine
+    def claim(self, slot, node, ttl):
+        """ Return True if `node` is the first to claim `slot`.  The claim
+        is kept for `ttl` seconds. """
+        return (yield from self.call(self.do_claim, slot, node, ttl))
+
+    @asyncio.coroutine
+    def leave(self, node):
+        yield from self.call(self.do_leave, node)
+
+    @asyncio.coroutine
+    def close(self):
+        def close_db():
+            if self.db is not None:
+                self.db.close()
+        yield from self.call(close_db)
+        self.executor.shutdown()
+
+
+class FileLeases(object):
+    """ Leases as files in a directory shared by the nodes of one host.  The
+    mtime of each file is when it expires.  A lease is written under a
+    temporary name with its expiry already set and then published, so no
+    file is ever visible with a stale mtime: a claim is published with
+    link(), which fails if the slot is taken, and a node's lease in "nodes"
+    with an atomic rename.  The file system work runs on a dedicated thread.
+    """
+
+    # Expired node leases are only removed after this long, so a sweep can't
+    # race a node renewing its lease.
+    node_grace = 3600
+
+    def __init__(self, directory, loop):
+        self.directory = directory
+        self.loop = loop
+        self.nodes_dir = os.path.join(directory, 'nodes')
+        self.claims_dir = os.path.join(directory, 'claims')
+        os.makedirs(self.nodes_dir, exist_ok=True)
+        os.makedirs(self.claims_dir, exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __str__(self):
+        return 'file://%s' % self.directory
+
+    def call(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def node_path(self, node):
+        return os.path.join(self.nodes_dir, urllib.parse.quote(node, safe=''))
+
+    @staticmethod
+    def write_lease(directory, data, ttl):
+        """ Write a lease expiring in `ttl` seconds to a temporary file in
+        `directory` and return its path. """
+        fd, path = tempfile.mkstemp(prefix='.', dir=directory)
+        try:
+            os.write(fd, data.encode())
+        finally:
+            os.close(fd)
+        expires = clock.time() + ttl
+        os.utime(path, (expires, expires))
+        return path
+
+    @staticmethod
+    def live(directory, grace=0):
+        """ Names of the unexpired leases in `directory`.  Those expired for
+        more than `grace` seconds are removed. """
+        now = clock.time()
+        names = []
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue  # Not published yet.
+            path = os.path.join(directory, name)
+            try:
+                expires = os.stat(path).st_mtime
+                if expires >= now:
+                    names.append(name)
+                elif expires < now - grace:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+        return names
+
+    def do_heartbeat(self, node, ttl):
+        tmp = self.write_lease(self.nodes_dir, node, ttl)
+        os.replace(tmp, self.node_path(node))
+        self.live(self.claims_dir)
+        return sorted(urllib.parse.unquote(x)
+                      for x in self.live(self.nodes_dir, self.node_grace))
+
+    def do_claim(self, slot, node, ttl):
+        name = hashlib.sha1(slot.encode()).hexdigest()
+        tmp = self.write_lease(self.claims_dir, '%s\n%s\n' % (node, slot),
+                               ttl)
+        try:
+            os.link(tmp, os.path.join(self.claims_dir, name))
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(tmp)
+        return True
+
+    def do_leave(self, node):
+        try:
+            os.unlink(self.node_path(node))
+        except FileNotFoundError:
+            pass
+
+    @asyncio.coroutine
+    def heartbeat(self, node, ttl):
+        return (yield from self.call(self.do_heartbeat, node, ttl))
+
+    @asyncio.coroutine
+    def claim(self, slot, node, ttl):
+        return (yield from self.call(self.do_claim, slot, node, ttl))
+
+    @asyncio.coroutine
+    def leave(self, node):
+        yield from self.call(self.do_leave, node)
+
+    @asyncio.coroutine
+    def close(self):
+        self.executor.shutdown()
+
+
+class TCPLeases(object):
+    """ Client of a `Coordinator`.  Requests and replies are JSON lines over
+    one connection, which is reopened after any error. """
+
+    def __init__(self, host, port, loop, timeout=5):
+        self.host = host
+        self.port = port
+        self.loop = loop
+        self.timeout = timeout
+        self.lock = asyncio.Lock(loop=loop)
+        self.reader = self.writer = None
+
+    def __str__(self):
+        return 'tcp://%s:%d' % (self.host, self.port)
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    @asyncio.coroutine
+    def request(self, **message):
+        yield from self.lock.acquire()
+        try:
+            if self.writer is None:
+                self.reader, self.writer = yield from asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port,
+                                            loop=self.loop),
+                    self.timeout, loop=self.loop)
+            try:
+                self.writer.write(json.dumps(message).encode() + b'\n')
+                line = yield from asyncio.wait_for(self.reader.readline(),
+                                                   self.timeout,
+                                                   loop=self.loop)
+                if not line:
+                    raise ConnectionError('Coordinator closed connection')
+            except Exception:
+                self.disconnect()
+                raise
+        finally:
+            self.lock.release()
+        reply = json.loads(line.decode())
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply
+
+    @asyncio.coroutine
+    def heartbeat(self, node, ttl):
+        reply = yield from self.request(op='heartbeat', node=node, ttl=ttl)
+        return reply['nodes']
+
+    @asyncio.coroutine
+    def claim(self, slot, node, ttl):
+        reply = yield from self.request(op='claim', slot=slot, node=node,
+                                        ttl=ttl)
+        return reply['claimed']
+
+    @asyncio.coroutine
+    def leave(self, node):
+        yield from self.request(op='leave', node=node)
+
+    @asyncio.coroutine
+    def close(self):
+        self.disconnect()
+
+
+class Coordinator(object):
+    """ A lease server for `TCPLeases` clients that keeps everything in
+    memory.  Run it with `cronredux coordinator`. """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.nodes = {}
+        self.claims = {}
+        self.server = None
+
+    @asyncio.coroutine
+    def start(self, host, port):
+        self.server = yield from asyncio.start_server(self.handle, host, port,
+                                                      loop=self.loop)
+
+    @asyncio.coroutine
+    def close(self):
+        self.server.close()
+        yield from self.server.wait_closed()
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = self.dispatch(json.loads(line.decode()))
+                except Exception as e:
+                    reply = {"error": '%s: %s' % (type(e).__name__, e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def dispatch(self, request):
+        op = request['op']
+        if op == 'heartbeat':
+            return {"nodes": self.heartbeat(request['node'], request['ttl'])}
+        elif op == 'claim':
+            return {"claimed": self.claim(request['slot'], request['node'],
+                                          request['ttl'])}
+        elif op == 'leave':
+            self.nodes.pop(request['node'], None)
+            return {}
+        raise ValueError('Invalid op: %s' % op)
+
+    @staticmethod
+    def purge(leases, now):
+        for key in [k for k, v in leases.items() if v[-1] < now]:
+            del leases[key]
+
+    def heartbeat(self, node, ttl):
+        now = clock.monotonic()
+        self.nodes[node] = (now + ttl,)
+        self.purge(self.nodes, now)
+        self.purge(self.claims, now)
+        return sorted(self.nodes)
+
+    def claim(self, slot, node, ttl):
+        now = clock.monotonic()
+        held = self.claims.get(slot)
+        if held is not None and held[-1] >= now:
+            return False
+        self.claims[slot] = (node, now + ttl)
+        return True
+
+
+def open_backend(url, loop):
+    """ Make the lease backend for a "sqlite://PATH", "file://DIR" or
+    "tcp://HOST:PORT" URL. """
+    scheme, sep, rest = url.partition('://')
+    if not sep or not rest:
+        raise ValueError('Invalid cluster URL: %s' % url)
+    if scheme == 'sqlite':
+        return SQLiteLeases(rest, loop)
+    elif scheme == 'file':
+        return FileLeases(rest, loop)
+    elif scheme == 'tcp':
+        host, sep, port = rest.rpartition(':')
+        if not sep or not port.isdigit():
+            raise ValueError('Invalid coordinator address: %s' % rest)
+        return TCPLeases(host, int(port), loop)
+    raise ValueError('Invalid cluster backend: %s' % scheme)
+
+
+class Cluster(object):
+    """ This node's membership in a cluster sharing `backend`.  The scheduler
+    hands each due run to `submit`, which fires it (through the scheduler's
+    callback) only on the node that owns the task and wins its slot.
+
+    A node that doesn't own a task waits `ttl` and two heartbeat intervals
+    (enough for a dead owner's lease to lapse and be noticed) and checks
+    again, so when the owner died just before a run the task's new owner
+    makes the run late rather than not at all.  A run the old owner
+    did make was claimed and is not repeated.
+
+    `on_change(old, new)` is called with the node lists when membership
+    changes and the `on_drop(task, due, error)` coroutine when a run is
+    dropped because its slot couldn't be claimed. """
+
+    replicas = 64
+    error_interval = 60
+
+    def __init__(self, node, backend, loop, ttl=15, retention=3600):
+        self.node = node
+        self.backend = backend
+        self.loop = loop
+        self.ttl = ttl
+        self.interval = ttl / 3
+        self.retention = max(retention, ttl * 4)
+        self.ring = HashRing((node,), self.replicas)
+        self.keys = {}
+        self.on_change = None
+        self.on_drop = None
+        self.heartbeats = None
+        self.dispatches = set()
+        self.claimed = 0
+        self.lost = 0
+        self.failovers = 0
+        self.errors = 0
+        self.last_error = None
+        self.errors_logged = 0
+        self.error_logged = None
+
+    def set_tasks(self, tasks):
+        """ Compute the cluster wide key of each task.  Keys come from the
+        crontab entry so every node reading the same crontab agrees on them.
+        The schedule is keyed by its canonical form since an interned spec
+        keeps whichever spelling of it was seen first. """
+        seen = {}
+        self.keys = {}
+        for task in tasks:
+            key = '%s %s' % (task.crontab.canonical(), task.cmd)
+            n = seen[key] = seen.get(key, 0) + 1
+            self.keys[task] = key if n == 1 else '%s #%d' % (key, n)
+
+    def owner(self, task):
+        return self.ring.owner(self.keys[task])
+
+    def shards(self):
+        """ The tasks owned by each live node. """
+        shards = dict((x, []) for x in self.ring.nodes)
+        for task, key in self.keys.items():
+            shards[self.ring.owner(key)].append(task)
+        return shards
+
+    def error(self, what, e):
+        """ Count an error and log it, at most once per `error_interval` so
+        an outage of the backend doesn't flood the log. """
+        self.errors += 1
+        self.last_error = '%s: %s' % (what, e)
+        now = clock.monotonic()
+        if self.error_logged is not None and \
+           now - self.error_logged < self.error_interval:
+            return
+        unlogged = self.errors - self.errors_logged - 1
+        print('Cluster %s failed: %s%s' % (what, e, (
+            ' (%d more errors since the last report)' % unlogged
+            if unlogged else '')), file=sys.stderr)
+        self.error_logged = now
+        self.errors_logged = self.errors
+
+    @asyncio.coroutine
+    def heartbeat(self):
+        try:
+            nodes = yield from self.backend.heartbeat(self.node, self.ttl)
+        except asyncio.CancelledError:
+            raise  # Not an Exception subclass until Python 3.8.
+        except Exception as e:
+            self.error('heartbeat', e)
+            return
+        nodes = set(nodes)
+        nodes.add(self.node)
+        if tuple(sorted(nodes)) != self.ring.nodes:
+            old = self.ring.nodes
+            self.ring = HashRing(nodes, self.replicas)
+            if self.on_change is not None:
+                self.on_change(old, self.ring.nodes)
+
+    @asyncio.coroutine
+    def run_heartbeats(self):
+        while True:
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            yield from self.heartbeat()
+
+    @asyncio.coroutine
+    def start(self):
+        yield from self.heartbeat()
+        self.heartbeats = self.loop.create_task(self.run_heartbeats())
+
+    @asyncio.coroutine
+    def close(self):
+        """ Leave the cluster so the other nodes take over right away.  Runs
+        still waiting on a takeover delay or a claim are dropped. """
+        tasks = list(self.dispatches)
+        if self.heartbeats is not None:
+            tasks.append(self.heartbeats)
+        for x in tasks:
+            x.cancel()
+        if tasks:
+            yield from asyncio.wait(tasks, loop=self.loop)
+        try:
+            yield from self.backend.leave(self.node)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error('leave', e)
+        yield from self.backend.close()
+
+    def submit(self, task, due, fire):
+        """ Fire `task` for its run at `due` with the `fire(task, due)`
+        coroutine if this node should. """
+        dispatch = self.loop.create_task(self.dispatch(task, due, fire))
+        self.dispatches.add(dispatch)
+        dispatch.add_done_callback(self.dispatches.discard)
+
+    @asyncio.coroutine
+    def dispatch(self, task, due, fire):
+        key = self.keys.get(task)
+        if key is None:
+            return
+        takeover = self.ring.owner(key) != self.node
+        if takeover:
+            ring = self.ring
+            yield from asyncio.sleep(self.ttl + self.interval * 2,
+                                     loop=self.loop)
+            if self.ring is ring or self.keys.get(task) != key or \
+               self.ring.owner(key) != self.node:
+                return
+        slot = '%s@%d' % (key, due)
+        try:
+            claimed = yield from self.backend.claim(slot, self.node,
+                                                    self.retention)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error('claim', e)
+            if self.on_drop is not None:
+                yield from self.on_drop(task, due, e)
+            return
+        if not claimed:
+            self.lost += 1
+            return
+        self.claimed += 1
+        if takeover:
+            self.failovers += 1
+        yield from fire(task, due)
+
+    def stats(self):
+        return {
+            "node": self.node,
+            "backend": str(self.backend),
+            "ttl": self.ttl,
+            "nodes": list(self.ring.nodes),
+            "claimed": self.claimed,
+            "lost": self.lost,
+            "failovers": self.failovers,
+            "errors": self.errors,
+            "last_error": self.last_error
+        }
@@ -1,23 +1,78 @@
 """
 Read and parse crontab files.
+
+Options for an entry may be given on `#:` directive lines directly above it,
+e.g. "#: group=db limit=2".  Other cron implementations treat these as
+comments.
+
+A command of the form "py:module:function [args...]" names a Python callable
+to run on the worker pool instead of a shell command.
 """
 
+import collections
+import re
+import shlex
+
+OPTIONS_PREFIX = '#:'
+CALL_PREFIX = 'py:'
+CALL_TARGET = re.compile(r'^[\w.]+:[\w.]+$')
+
+Entry = collections.namedtuple('Entry', 'spec, command, options')
+
 
 def parsef(f):
     """ Parse a file object into a generator of (spec, command) tuples. """
-    for x in f:
-        parsed = parseline(x.rstrip('\n'))
-        if parsed is not None:
-            yield parsed
+    for x in entries(f):
+        yield x.spec, x.command
 
 
 def parses(s):
     """ Parse a multiline string object into a generator of (spec, command)
     tuples. """
-    for x in s.splitlines():
+    for x in entries(s.splitlines()):
+        yield x.spec, x.command
+
+
+def entries(lines):
+    """ Parse an iterable of lines into a generator of `Entry` tuples.  The
+    options of each entry are collected from the directive lines preceding
+    it. """
+    options = {}
+    for x in lines:
+        x = x.rstrip('\n')
+        if x.startswith(OPTIONS_PREFIX):
+            options.update(parseoptions(x[len(OPTIONS_PREFIX):]))
+            continue
         parsed = parseline(x)
         if parsed is not None:
-            yield parsed
+            yield Entry(parsed[0], parsed[1], options)
+            options = {}
+
+
+def parseoptions(text):
+    """ Parse whitespace separated `key=value` options into a dict.  A bare
+    `key` is set to True. """
+    options = {}
+    for x in text.split():
+        key, sep, value = x.partition('=')
+        options[key] = value if sep else True
+    return options
+
+
+class PythonCall(str):
+    """ A command naming a Python callable.  It is still the command string
+    (for display and for matching entries on reload) with the parsed
+    `module`, `function` and `args` attached. """
+
+    def __new__(cls, command):
+        self = super().__new__(cls, command)
+        words = shlex.split(command.strip()[len(CALL_PREFIX):])
+        if not words or not CALL_TARGET.match(words[0]):
+            raise ValueError('Expected "%smodule:function [args...]": %s' % (
+                             CALL_PREFIX, command.strip()))
+        self.module, self.function = words[0].split(':')
+        self.args = tuple(words[1:])
+        return self
 
 
 def parseline(line):
@@ -29,7 +84,10 @@ def parseline(line):
     if line[0] == '#':
         return
     if line[0] == '@':
-        return tuple(line.split(' ', 1))
+        spec, command = line.split(' ', 1)
     else:
         parts = line.split(' ', 5)
-        return ' '.join(parts[:5]), parts[-1]
+        spec, command = ' '.join(parts[:5]), parts[-1]
+    if command.lstrip().startswith(CALL_PREFIX):
+        command = PythonCall(command)
+    return spec, command
@@ -0,0 +1,359 @@
+"""
+Compiled cron expressions.
+
+A spec is parsed once into bitsets for each field and the "next fire"
+computation walks those bitsets from the largest unit down instead of testing
+candidate times one at a time.  The matching rules follow the `crontab`
+library that was used previously; notably the day and weekday fields must
+both match.
+
+An "H" in a field (as in Jenkins) stands for a value picked by hashing a
+seed, normally the task's command, so that many tasks on the same schedule
+are spread out instead of all firing together.  The value is stable for a
+given seed.  "H(10-20)" limits it to a range and "H/15" picks the offset of
+a step, e.g. minutes 7, 22, 37 and 52.
+"""
+
+import calendar
+import datetime
+import itertools
+import re
+import time
+import weakref
+import zlib
+from cronredux import clock
+
+ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+MONTH_NAMES = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6, 'jul': 7,
+    'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12
+}
+
+WEEKDAY_NAMES = {
+    'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5, 'sat': 6
+}
+
+# Days of the month (as bits) that fall on the same weekday as the first
+# entry, e.g. _WEEKLY[3] has bits 3, 10, 17, 24 and 31 set.
+_WEEKLY = [0] + [sum(1 << d for d in range(start, 32, 7))
+                 for start in range(1, 8)]
+
+# Upper bound on the number of months searched before giving up on a spec
+# that can never fire, e.g. "0 0 30 2 *".  The calendar repeats every 28
+# years so nothing beyond that is ever going to match.
+MAX_MONTHS = 12 * 28 + 1
+
+_HASHED = re.compile(r'(^|[\s,])h($|[\s,/(])')
+
+
+def _next_bit(mask, i):
+    """ Return the index of the lowest set bit in `mask` at or above `i`. """
+    m = mask >> i
+    if not m:
+        return None
+    return i + (m & -m).bit_length() - 1
+
+
+def _bits(mask):
+    """ Generate the index of each set bit in `mask`. """
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+class CronSpec(object):
+    """ A cron expression compiled into bitsets.  Instances are immutable and
+    compare equal when they would fire at the same times. """
+
+    __slots__ = ('spec', 'minutes', 'hours', 'days', 'months', 'weekdays',
+                 'last_day', 'last_weekdays', '__weakref__')
+
+    def __init__(self, spec, seed=None):
+        self.spec = spec
+        expr = ALIASES.get(spec.strip().lower(), spec)
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron spec (need 5 fields): %r' % spec)
+        minute, hour, day, month, weekday = (x.lower() for x in fields)
+        if seed is None:
+            hashes = [None] * 5
+        else:
+            hashes = [zlib.crc32(('%d:%s' % (i, seed.strip())).encode())
+                      for i in range(5)]
+        self.minutes = self.parse_field(minute, 0, 59, hash=hashes[0])
+        self.hours = self.parse_field(hour, 0, 23, hash=hashes[1])
+        self.last_day = False
+        days = []
+        for x in day.split(','):
+            if x == 'l':
+                self.last_day = True
+            else:
+                days.append(x)
+        self.days = self.parse_field(','.join(days), 1, 31, any_ok='?',
+                                     hash=hashes[2]) if days else 0
+        self.months = self.parse_field(month, 1, 12, names=MONTH_NAMES,
+                                       hash=hashes[3])
+        self.last_weekdays = 0
+        weekdays = []
+        for x in weekday.split(','):
+            if x.startswith('l'):
+                self.last_weekdays |= self.parse_field(x[1:], 0, 7,
+                                                       names=WEEKDAY_NAMES)
+            else:
+                weekdays.append(x)
+        self.weekdays = self.parse_field(','.join(weekdays), 0, 7,
+                                         names=WEEKDAY_NAMES, any_ok='?',
+                                         hash=hashes[4]) if weekdays else 0
+        # Sunday may be written as 0 or 7.
+        self.weekdays = (self.weekdays | self.weekdays >> 7) & 0x7f
+        self.last_weekdays = (self.last_weekdays |
+                              self.last_weekdays >> 7) & 0x7f
+
+    @staticmethod
+    def parse_field(text, low, high, names=None, any_ok=None, hash=None):
+        """ Convert a single field such as "1-5,*/15,jan" into a bitmask.
+        `hash` picks the values of "H" items. """
+        mask = 0
+        for item in text.split(','):
+            step = 1
+            if '/' in item:
+                item, step = item.split('/', 1)
+                try:
+                    step = int(step)
+                except ValueError:
+                    step = 0
+                if step < 1:
+                    raise ValueError('Invalid step: %r' % text)
+            if item == '*' or (any_ok and item == any_ok):
+                start, end = low, high
+                if high == 7:  # weekday; don't double count sunday
+                    end = 6
+            elif item.startswith('h'):
+                start, end = CronSpec.parse_hashed(item, low, high, names,
+                                                   hash)
+                if step == 1:
+                    mask |= 1 << (start + hash % (end - start + 1))
+                    continue
+                start += hash % min(step, end - start + 1)
+            else:
+                start, sep, end = item.partition('-')
+                start = CronSpec.parse_value(start, low, high, names)
+                if sep:
+                    end = CronSpec.parse_value(end, low, high, names)
+                    if high == 7 and end == 0:  # e.g. "sat-sun"
+                        end = 7
+                elif step != 1:
+                    end = high
+                else:
+                    end = start
+                if start > end:
+                    raise ValueError('Invalid range: %r' % text)
+            for x in range(start, end + 1, step):
+                mask |= 1 << x
+        return mask
+
+    @staticmethod
+    def parse_hashed(item, low, high, names, hash):
+        """ Return the range an "H" or "H(a-b)" item picks its values from.
+        Days stop at 28 so every month gets the same value. """
+        if hash is None:
+            raise ValueError('H needs a seed: %r' % item)
+        if item == 'h':
+            if high == 7:
+                return low, 6
+            elif high == 31:
+                return low, 28
+            return low, high
+        if not (item.startswith('h(') and item.endswith(')')):
+            raise ValueError('Invalid hash: %r' % item)
+        start, sep, end = item[2:-1].partition('-')
+        if not sep:
+            raise ValueError('Invalid hash range: %r' % item)
+        start = CronSpec.parse_value(start, low, high, names)
+        end = CronSpec.parse_value(end, low, high, names)
+        if start > end:
+            raise ValueError('Invalid range: %r' % item)
+        return start, end
+
+    @staticmethod
+    def parse_value(value, low, high, names):
+        if names and value in names:
+            return names[value]
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError('Invalid value: %r' % value)
+        if not low <= value <= high:
+            raise ValueError('Value out of range [%d-%d]: %r' % (low, high,
+                             value))
+        return value
+
+    def __str__(self):
+        return self.spec
+
+    def __repr__(self):
+        return '<CronSpec %r>' % self.spec
+
+    def _key(self):
+        return (self.minutes, self.hours, self.days, self.months,
+                self.weekdays, self.last_day, self.last_weekdays)
+
+    def canonical(self):
+        """ A string that is the same for every spelling of this schedule,
+        unlike `str()` which is the spec as it was written. """
+        return '%x %x %x %x %x %d %x' % self._key()
+
+    def __eq__(self, other):
+        if not isinstance(other, CronSpec):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def month_days(self, year, month):
+        """ Bitmask of the days in this month that satisfy both the day and
+        the weekday fields. """
+        ndays = calendar.monthrange(year, month)[1]
+        valid = (1 << (ndays + 1)) - 2
+        days = self.days & valid
+        if self.last_day:
+            days |= 1 << ndays
+        if not days:
+            return 0
+        first = (calendar.weekday(year, month, 1) + 1) % 7  # 0 = sunday
+        weekly = 0
+        for wd in _bits(self.weekdays):
+            weekly |= _WEEKLY[(wd - first) % 7 + 1]
+        for wd in _bits(self.last_weekdays):
+            pattern = _WEEKLY[(wd - first) % 7 + 1] & valid
+            weekly |= 1 << (pattern.bit_length() - 1)
+        return days & weekly & valid
+
+    def _search(self, year, month, day, hour, minute):
+        """ Find the first matching local time at or after the given fields.
+        Out of range values (e.g. minute=60) are carried forward. """
+        for _ in range(MAX_MONTHS):
+            if self.months >> month & 1:
+                days = self.month_days(year, month)
+                while True:
+                    found = _next_bit(days, day)
+                    if found is None:
+                        break
+                    if found != day:
+                        day, hour, minute = found, 0, 0
+                    found = _next_bit(self.hours, hour)
+                    if found is not None:
+                        if found != hour:
+                            hour, minute = found, 0
+                        found = _next_bit(self.minutes, minute)
+                        if found is not None:
+                            return year, month, day, hour, found
+                        hour, minute = hour + 1, 0
+                        continue
+                    day, hour, minute = day + 1, 0, 0
+            month += 1
+            if month > 12:
+                month = 1
+                year += 1
+            day = 1
+            hour = minute = 0
+
+    def iter(self, after=None):
+        """ Generate fire times (epoch seconds) strictly after `after`. """
+        if after is None:
+            after = clock.time()
+        start = datetime.datetime.fromtimestamp((after // 60 + 1) * 60)
+        fields = (start.year, start.month, start.day, start.hour,
+                  start.minute)
+        while True:
+            found = self._search(*fields)
+            if found is None:
+                return
+            year, month, day, hour, minute = found
+            tt = (year, month, day, hour, minute, 0, 0, 0, -1)
+            ts = time.mktime(tt)
+            if ts <= after:
+                # Repeated wall clock time at the end of DST; take the later.
+                ts = time.mktime(tt[:8] + (0,))
+            if ts > after:
+                after = ts
+                yield ts
+            fields = year, month, day, hour, minute + 1
+
+    def next(self, after=None):
+        """ Return the first fire time (epoch seconds) strictly after `after`
+        (default now) or None if this spec never fires. """
+        for ts in self.iter(after):
+            return ts
+
+    def next_n(self, n, after=None):
+        """ Return a list of the next `n` fire times after `after`. """
+        return list(itertools.islice(self.iter(after), n))
+
+    def window(self, start, end):
+        """ Return a list of all fire times in (start, end]. """
+        return list(itertools.takewhile(lambda x: x <= end,
+                                        self.iter(start)))
+
+
+_interned_text = weakref.WeakValueDictionary()
+_interned = weakref.WeakValueDictionary()
+
+
+def intern(spec, seed=None):
+    """ Return the shared CronSpec for a spec string.  Specs that compile to
+    the same schedule (e.g. "@hourly" and "0 * * * *") share one instance so
+    callers can group work by identity.  `seed` is only used by specs with
+    "H" fields. """
+    text = ' '.join(spec.lower().split())
+    if seed is not None and _HASHED.search(text):
+        text = text, seed.strip()
+    else:
+        seed = None
+    try:
+        return _interned_text[text]
+    except KeyError:
+        pass
+    compiled = CronSpec(spec, seed)
+    compiled = _interned.setdefault(compiled._key(), compiled)
+    _interned_text[text] = compiled
+    return compiled
+
+
+def batch_next_n(specs, n, after=None):
+    """ Compute the next `n` fire times for every spec in one pass.  Returns
+    a list parallel to `specs`; equal specs are only evaluated once. """
+    if after is None:
+        after = clock.time()
+    cache = {}
+    results = []
+    for spec in specs:
+        if spec not in cache:
+            cache[spec] = spec.next_n(n, after)
+        results.append(cache[spec])
+    return results
+
+
+def batch_window(specs, start, end):
+    """ Compute all fire times in (start, end] for every spec.  Returns a list
+    parallel to `specs`; equal specs are only evaluated once. """
+    cache = {}
+    results = []
+    for spec in specs:
+        if spec not in cache:
+            cache[spec] = spec.window(start, end)
+        results.append(cache[spec])
+    return results
@@ -0,0 +1,209 @@
+"""
+Versioned JSON API for the diag service.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+from aiohttp import web
+
+
+class JSONAPI(object):
+    """ Read only JSON views of the scheduler.  Responses are cached against
+    the scheduler's version counter, so a repeated request only serializes
+    anything after the state changed, and clients sending `If-None-Match`
+    with the current ETag get an empty 304.  ETags include a nonce picked at
+    startup since the version counter starts over on every restart. """
+
+    prefix = '/api/v1'
+    max_page = 500
+    cache_size = 256
+
+    def __init__(self, sched):
+        self.sched = sched
+        self.cache = collections.OrderedDict()
+        self.nonce = os.urandom(8).hex()
+
+    def add_routes(self, router):
+        router.add_route('GET', self.prefix + '/tasks', self.tasks)
+        router.add_route('GET', self.prefix + '/tasks/{id}', self.task)
+        router.add_route('GET', self.prefix + '/execs', self.execs)
+        router.add_route('GET', self.prefix + '/active', self.active)
+        router.add_route('GET', self.prefix + '/load', self.load)
+        router.add_route('GET', self.prefix + '/concurrency',
+                         self.concurrency)
+        router.add_route('GET', self.prefix + '/cluster', self.cluster)
+
+    def etag(self, request):
+        key = '%s:%d:%s' % (self.nonce, self.sched.version, request.path_qs)
+        return '"%s"' % hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    @asyncio.coroutine
+    def respond(self, request, build, versioned=True):
+        """ Return the cached body for this request if the scheduler has not
+        changed since it was built, otherwise call `build` (a coroutine) for
+        fresh data.  Views whose data changes without a version bump are not
+        `versioned`; they are built every time and get no ETag. """
+        if not versioned:
+            data = yield from build()
+            return web.Response(body=json.dumps(data).encode(),
+                                content_type='application/json')
+        etag = self.etag(request)
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        cached = self.cache.get(request.path_qs)
+        if cached is not None and cached[0] == etag:
+            self.cache.move_to_end(request.path_qs)
+            body = cached[1]
+        else:
+            # Data built here is at least as new as the ETag; if the state
+            # moves on meanwhile the next request simply misses the cache.
+            data = yield from build()
+            body = json.dumps(data).encode()
+            self.cache[request.path_qs] = etag, body
+            self.cache.move_to_end(request.path_qs)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return web.Response(body=body, content_type='application/json',
+                            headers={"ETag": etag})
+
+    @staticmethod
+    def int_param(params, name, default=None, minimum=0, maximum=None):
+        value = params.get(name)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+            if value < minimum or (maximum is not None and value > maximum):
+                raise ValueError()
+        except ValueError:
+            raise web.HTTPBadRequest(text='Invalid %s: %s' % (name, value))
+        return value
+
+    def task_info(self, task):
+        schedule = task.schedule
+        cluster = self.sched.cluster
+        return {
+            "id": task.ident,
+            "cmd": task.cmd,
+            "crontab": str(task.crontab),
+            "options": task.options,
+            "argv": task.argv,
+            "next_run": schedule.eta if schedule is not None else None,
+            "active": task.active,
+            "run_count": task.run_count,
+            "timeout_count": task.timeout_count,
+            "run_time": task.run_time,
+            "rusage": task.rusage.as_dict(),
+            "owner": cluster.owner(task) if cluster is not None else None
+        }
+
+    @asyncio.coroutine
+    def tasks(self, request):
+        @asyncio.coroutine
+        def build():
+            return [self.task_info(x) for x in self.sched.tasks]
+        return (yield from self.respond(request, build))
+
+    @asyncio.coroutine
+    def task(self, request):
+        ident = self.int_param(request.match_info, 'id')
+        task = self.sched.tasks_by_id.get(ident)
+        if task is None:
+            raise web.HTTPNotFound(text='Task not found')
+
+        @asyncio.coroutine
+        def build():
+            return self.task_info(task)
+        return (yield from self.respond(request, build))
+
+    @asyncio.coroutine
+    def execs(self, request):
+        """ Executions newest first.  Query args: `task` (id), `failed` (0 or
+        1), `limit`, `offset` and `output` (1 to include output). """
+        params = request.query
+        task = self.int_param(params, 'task')
+        failed = self.int_param(params, 'failed', maximum=1)
+        if failed is not None:
+            failed = bool(failed)
+        limit = self.int_param(params, 'limit', 50, minimum=1,
+                               maximum=self.max_page)
+        offset = self.int_param(params, 'offset', 0)
+        output = bool(self.int_param(params, 'output', 0))
+
+        @asyncio.coroutine
+        def build():
+            execs = yield from self.sched.history.query_async(
+                task=task, failed=failed, limit=limit, offset=offset)
+            return {
+                "limit": limit,
+                "offset": offset,
+                "execs": [x.as_dict(output) for x in execs]
+            }
+        return (yield from self.respond(request, build))
+
+    @asyncio.coroutine
+    def active(self, request):
+        """ Running executions and those waiting in the dispatch queue.
+        Durations are as of the last change in scheduler state; clients
+        wanting live values should compute them from the timestamps. """
+        @asyncio.coroutine
+        def build():
+            return {
+                "running": [x.as_dict() for x in self.sched.active],
+                "queued": [x.as_dict()
+                           for x, _ in self.sched.queue.waiting()],
+                "dispatch": self.sched.queue.stats()
+            }
+        return (yield from self.respond(request, build))
+
+    @asyncio.coroutine
+    def load(self, request):
+        """ Preview of task starts by minute of the hour.  Query args:
+        `hours` to look ahead (default 24).  The window moves with the
+        clock so this is not versioned. """
+        hours = self.int_param(request.query, 'hours', 24, minimum=1,
+                               maximum=24 * 7)
+
+        @asyncio.coroutine
+        def build():
+            load = self.sched.load_histogram(hours)
+            return {
+                "hours": hours,
+                "peak": [x[0] for x in load],
+                "mean": [x[1] for x in load]
+            }
+        return (yield from self.respond(request, build, versioned=False))
+
+    @asyncio.coroutine
+    def concurrency(self, request):
+        """ The concurrency limit and, in adaptive mode, the pressure behind
+        it and recent decisions.  Pressure samples don't bump the version so
+        this is not versioned. """
+        @asyncio.coroutine
+        def build():
+            adaptive = self.sched.adaptive
+            if adaptive is None:
+                return {"adaptive": False, "limit": self.sched.queue.limit}
+            info = adaptive.stats()
+            info['adaptive'] = True
+            return info
+        return (yield from self.respond(request, build, versioned=False))
+
+    @asyncio.coroutine
+    def cluster(self, request):
+        """ The cluster's live nodes and the tasks each one owns.  Claim and
+        error counts don't bump the version so this is not versioned. """
+        @asyncio.coroutine
+        def build():
+            cluster = self.sched.cluster
+            if cluster is None:
+                return {"clustered": False}
+            info = cluster.stats()
+            info['clustered'] = True
+            info['shards'] = dict((node, sorted(x.ident for x in tasks))
+                                  for node, tasks in cluster.shards().items())
+            return info
+        return (yield from self.respond(request, build, versioned=False))
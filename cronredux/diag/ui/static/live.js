@@ -0,0 +1,84 @@
+/*
+ * Live updates for the diagnostics page from the /events stream.
+ *
+ * Recent Activity and Active Jobs rows are added, updated and removed as
+ * execution events arrive instead of reloading the whole page.  Browsers
+ * without EventSource fall back to reloading every few seconds.
+ */
+(function() {
+    'use strict';
+
+    var historySize = 100;
+    var status = document.getElementById('live-status');
+
+    function seconds(value) {
+        return value == null ? '' : value.toFixed(2) + ' seconds';
+    }
+
+    function link(info) {
+        var a = document.createElement('a');
+        a.href = 'task_exec.html?taskid=' + info.task + '&execid=' + info.id;
+        a.textContent = info.label;
+        return a;
+    }
+
+    function setRow(table, info, cells, limit) {
+        var key = info.task + '-' + info.id;
+        var row = table.querySelector('tr[data-key="' + key + '"]');
+        if (!row) {
+            row = document.createElement('tr');
+            row.setAttribute('data-key', key);
+            var header = table.rows[0];
+            header.parentNode.insertBefore(row, header.nextSibling);
+            while (limit && table.rows.length > limit + 1) {
+                table.deleteRow(-1);
+            }
+        }
+        row.innerHTML = '';
+        var first = row.insertCell(-1);
+        first.appendChild(link(info));
+        cells.forEach(function(text) {
+            row.insertCell(-1).textContent = text == null ? '' : text;
+        });
+    }
+
+    function removeRow(table, info) {
+        var row = table.querySelector('tr[data-key="' + info.task + '-' +
+                                      info.id + '"]');
+        if (row) {
+            row.parentNode.removeChild(row);
+        }
+    }
+
+    function onExec(event) {
+        var info = JSON.parse(event.data);
+        setRow(document.getElementById('history'), info, [
+            seconds(info.elapsed),
+            seconds(info.wait),
+            info.state,
+            info.returncode,
+            info.snippet
+        ], historySize);
+        var active = document.getElementById('active');
+        if (info.state === 'start') {
+            setRow(active, info, ['just now']);
+        } else if (info.state !== 'queued') {
+            removeRow(active, info);
+        }
+    }
+
+    if (!window.EventSource) {
+        setTimeout(function() { location.reload(); }, 5000);
+        return;
+    }
+    var source = new EventSource('/events');
+    ['queued', 'start', 'finish', 'timeout'].forEach(function(name) {
+        source.addEventListener(name, onExec);
+    });
+    source.onopen = function() {
+        status.textContent = '(live)';
+    };
+    source.onerror = function() {
+        status.textContent = '(reconnecting)';
+    };
+})();
@@ -10,6 +10,7 @@ import pendulum
 import platform
 import shellish
 from aiohttp import web
+from cronredux.diag import api
 
 
 class DiagService(object):
@@ -23,18 +24,18 @@ class DiagService(object):
         "python": platform.python_version()
     }
     ui_dir = os.path.join(os.path.dirname(__file__), 'ui')
+    event_keepalive = 15
 
     def __init__(self, tasks, args, loop, sched=None, plain=False):
         self.tasks = tasks
         self.args = args
         self.loop = loop
+        self.sched = sched
         self.tpl_context = {
             "environ": os.environ,
             "args": args,
             "tasks": tasks,
-            "tasks_by_id": dict((x.ident, x) for x in tasks),
-            "task_execs": lambda: dict(((x.task.ident, x.ident), x)
-                                       for x in sched.history),
+            "tasks_by_id": sched.tasks_by_id,
             "platform": self.platform_info,
             "ui_dir": self.ui_dir,
             "started": pendulum.now(),
@@ -51,9 +52,19 @@ class DiagService(object):
         env.globals.update({
             "sorted": sorted
         })
+        # Shared by every render so requests do not copy the context.
+        env.globals.update(self.tpl_context)
         self.app.router.add_route('GET', '/', self.index_redir)
         self.app.router.add_route('GET', '/health', self.health)
+        self.app.router.add_route('GET', '/metrics', self.metrics)
+        self.app.router.add_route('GET', '/events', self.event_stream)
+        self.app.router.add_route('GET', '/ui/task.html', self.task_page)
+        self.app.router.add_route('GET', '/ui/task_exec.html',
+                                  self.task_exec_page)
+        self.app.router.add_route('GET', '/ui/load.html', self.load_page)
         self.app.router.add_route('GET', '/ui/{path}', self.tpl_handler)
+        self.api = api.JSONAPI(self.sched)
+        self.api.add_routes(self.app.router)
         self.app.router.add_static('/ui/static',
                                    os.path.join(self.ui_dir, 'static'))
         self.handler = self.app.make_handler()
@@ -72,17 +83,107 @@ class DiagService(object):
         return web.json_response({
             "platform_info": self.platform_info,
             "tasks": [x.cmd for x in self.tasks],
+            "task_usage": [{
+                "cmd": x.cmd,
+                "run_count": x.run_count,
+                "timeout_count": x.timeout_count,
+                "elapsed": x.run_time,
+                "rusage": x.rusage.as_dict()
+            } for x in self.tasks],
+            "dispatch": self.sched.queue.stats(),
+            "adaptive": self.sched.adaptive and self.sched.adaptive.stats(),
+            "log_sinks": [x.stats() for x in self.sched.log_sinks],
+            "cgroups": self.sched.cgroups and self.sched.cgroups.stats(),
+            "cluster": self.sched.cluster and self.sched.cluster.stats()
         })
 
+    @asyncio.coroutine
+    def metrics(self, request):
+        registry = self.sched.metrics
+        return web.Response(text=registry.render(),
+                            headers={"Content-Type": registry.content_type})
+
+    @asyncio.coroutine
+    def event_stream(self, request):
+        """ Server-sent events for execution state changes.  A client that
+        cannot keep up is disconnected (browsers reconnect on their own). """
+        resp = web.StreamResponse(headers={
+            "Content-Type": 'text/event-stream',
+            "Cache-Control": 'no-cache'
+        })
+        yield from resp.prepare(request)
+        subscriber = self.sched.events.subscribe()
+        try:
+            yield from resp.write(b'retry: 5000\n\n')
+            while True:
+                messages = yield from subscriber.get(self.event_keepalive)
+                if messages is None:
+                    break
+                yield from resp.write(b''.join(messages) or b': keepalive\n\n')
+        except (ConnectionError, RuntimeError):
+            pass  # Client went away.
+        finally:
+            subscriber.close()
+        return resp
+
     @asyncio.coroutine
     def tpl_handler(self, request):
         path = request.match_info['path']
-        context = self.tpl_context.copy()
-        context['request'] = request
-        return aiohttp_jinja2.render_template(path, request, context)
+        return aiohttp_jinja2.render_template(path, request, {
+            "request": request
+        })
+
+    @staticmethod
+    def int_query(request, name, default=-1):
+        try:
+            return int(request.query.get(name, default))
+        except ValueError:
+            return default
+
+    @asyncio.coroutine
+    def task_page(self, request):
+        """ Render a task with a page of its history, which is loaded here
+        since templates can't wait on the history store. """
+        task = self.sched.tasks_by_id.get(self.int_query(request, 'id'))
+        failed = {'1': True, '0': False}.get(request.query.get('failed'))
+        page = max(self.int_query(request, 'page', 0), 0)
+        page_size = 50
+        execs = []
+        if task is not None:
+            execs = yield from self.sched.history.query_async(
+                task=task.ident, failed=failed, limit=page_size,
+                offset=page * page_size)
+        return aiohttp_jinja2.render_template('task.html', request, {
+            "request": request,
+            "task": task,
+            "failed": failed,
+            "page": page,
+            "page_size": page_size,
+            "execs": execs
+        })
+
+    @asyncio.coroutine
+    def task_exec_page(self, request):
+        context = yield from self.sched.history.get_async(
+            self.int_query(request, 'taskid'),
+            self.int_query(request, 'execid'))
+        return aiohttp_jinja2.render_template('task_exec.html', request, {
+            "request": request,
+            "exec": context
+        })
+
+    @asyncio.coroutine
+    def load_page(self, request):
+        hours = min(max(self.int_query(request, 'hours', 24), 1), 24 * 7)
+        return aiohttp_jinja2.render_template('load.html', request, {
+            "request": request,
+            "hours": hours,
+            "load": self.sched.load_histogram(hours)
+        })
 
     @asyncio.coroutine
     def cleanup(self):
+        self.sched.events.close()
         self.server.close()
         yield from self.server.wait_closed()
         yield from self.app.shutdown()
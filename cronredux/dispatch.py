@@ -0,0 +1,96 @@
+"""
+Dispatch queue for task executions waiting on a free slot.
+"""
+
+import collections
+import heapq
+import itertools
+from cronredux import clock
+
+
+class DispatchQueue(object):
+    """ Executions that are ready to run wait here until there is a free slot
+    in the worker pool and in each of their concurrency groups.  Entries are
+    served by priority (lower first) and FIFO within a priority.  An entry
+    blocked on a group does not hold up entries behind it.  Nothing ever
+    waits on the queue; `start` is called for each entry as it is
+    dispatched. """
+
+    def __init__(self, limit, start):
+        self.limit = limit
+        self.start = start
+        self.running = 0
+        self.pending = []
+        self.queued_at = collections.OrderedDict()  # seq -> enqueue time
+        self.seq = itertools.count()
+        self.dispatched = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, context, priority=0, groups=()):
+        """ Queue an execution and dispatch whatever can run now. """
+        seq = next(self.seq)
+        now = self.queued_at[seq] = clock.monotonic()
+        heapq.heappush(self.pending, (priority, seq, now, context, groups))
+        self.dispatch()
+
+    def dispatch(self):
+        """ Start as many pending entries as the limits allow. """
+        deferred = []
+        while self.pending and self.running < self.limit:
+            entry = heapq.heappop(self.pending)
+            groups = entry[4]
+            if any(x.active >= x.limit for x in groups):
+                deferred.append(entry)
+                continue
+            del self.queued_at[entry[1]]
+            self.running += 1
+            for x in groups:
+                x.active += 1
+            wait = clock.monotonic() - entry[2]
+            self.dispatched += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.start(entry[3])
+        for x in deferred:
+            heapq.heappush(self.pending, x)
+
+    def release(self, groups=()):
+        """ Return the slots held by a finished execution. """
+        self.running -= 1
+        for x in groups:
+            x.active -= 1
+        self.dispatch()
+
+    def waiting(self):
+        """ Generate (context, seconds waited) for pending entries in
+        dispatch order. """
+        now = clock.monotonic()
+        for entry in sorted(self.pending):
+            yield entry[3], now - entry[2]
+
+    @property
+    def wait_avg(self):
+        return self.wait_total / self.dispatched if self.dispatched else 0
+
+    @property
+    def oldest_wait(self):
+        """ Seconds waited by the earliest queued entry.  Sequence numbers
+        follow enqueue order so it is always the first one left. """
+        for queued_at in self.queued_at.values():
+            return clock.monotonic() - queued_at
+        return 0
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "running": self.running,
+            "limit": self.limit,
+            "dispatched": self.dispatched,
+            "wait_avg": self.wait_avg,
+            "wait_max": self.wait_max,
+            "oldest_wait": self.oldest_wait
+        }
@@ -0,0 +1,85 @@
+"""
+Fan out of scheduler events to live viewers.
+"""
+
+import asyncio
+import collections
+import json
+
+
+class Subscriber(object):
+    """ A bounded buffer of encoded events for one client.  A client that
+    falls more than `maxsize` events behind is dropped rather than letting its
+    buffer grow. """
+
+    def __init__(self, bus, maxsize):
+        self.bus = bus
+        self.maxsize = maxsize
+        self.buffer = collections.deque()
+        self.ready = asyncio.Event(loop=bus.loop)
+        self.closed = False
+        self.dropped = False
+
+    def put(self, message):
+        if len(self.buffer) >= self.maxsize:
+            self.dropped = True
+            self.close()
+        else:
+            self.buffer.append(message)
+            self.ready.set()
+
+    @asyncio.coroutine
+    def get(self, timeout=None):
+        """ Wait for and take every buffered event.  Returns an empty list if
+        `timeout` passes first and None once the subscriber is closed. """
+        if not self.buffer and not self.closed:
+            try:
+                yield from asyncio.wait_for(self.ready.wait(), timeout,
+                                            loop=self.bus.loop)
+            except asyncio.TimeoutError:
+                pass
+            self.ready.clear()
+        if self.closed:
+            return None
+        messages = list(self.buffer)
+        self.buffer.clear()
+        return messages
+
+    def close(self):
+        self.closed = True
+        self.buffer.clear()
+        self.ready.set()
+        self.bus.subscribers.discard(self)
+
+
+class EventBus(object):
+    """ Publish events to every subscriber as server-sent-event messages.
+    Each event is encoded once no matter how many clients are listening and
+    nothing is encoded when there are none. """
+
+    def __init__(self, loop, buffer_size=256):
+        self.loop = loop
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self.seq = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        subscriber = Subscriber(self, self.buffer_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def publish(self, kind, data):
+        self.seq += 1
+        if not self.subscribers:
+            return
+        message = ('id: %d\nevent: %s\ndata: %s\n\n' % (
+                   self.seq, kind, json.dumps(data))).encode()
+        for x in list(self.subscribers):
+            x.put(message)
+            if x.dropped:
+                self.dropped += 1
+
+    def close(self):
+        for x in list(self.subscribers):
+            x.close()
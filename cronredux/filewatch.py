@@ -0,0 +1,127 @@
+"""
+Notice when a file changes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_inotify():
+    """ Return libc if it provides inotify, otherwise None. """
+    name = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+class FileWatcher(object):
+    """ Call `callback` after `path` changes.  On Linux the directory holding
+    the file is watched with inotify, so editors that save by replacing the
+    file are noticed too.  Elsewhere (or if inotify is unavailable) the file
+    is polled with `os.stat` every `poll_interval` seconds.  Bursts of
+    changes are collapsed into one callback after `settle` seconds. """
+
+    settle = 0.1
+
+    def __init__(self, path, callback, loop, poll_interval=2):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.loop = loop
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.timer = None
+        self.pending = None
+        self.signature = None
+
+    @property
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'poll'
+
+    def start(self):
+        self.signature = self.stat()
+        if not self.start_inotify():
+            self.poll()
+
+    def stop(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        for x in (self.timer, self.pending):
+            if x is not None:
+                x.cancel()
+        self.timer = self.pending = None
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def start_inotify(self):
+        libc = load_inotify()
+        if libc is None:
+            return False
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return False
+        directory = os.path.dirname(self.path).encode()
+        if libc.inotify_add_watch(fd, directory, IN_WATCH_MASK) < 0:
+            os.close(fd)
+            return False
+        self.fd = fd
+        self.loop.add_reader(fd, self.on_inotify)
+        return True
+
+    def on_inotify(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        name = os.path.basename(self.path).encode()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            event_name = data[offset:offset + size].rstrip(b'\0')
+            offset += size
+            if event_name == name:
+                self.changed()
+
+    def poll(self):
+        if self.stat() != self.signature:
+            self.changed()
+        self.timer = self.loop.call_later(self.poll_interval, self.poll)
+
+    def changed(self):
+        if self.pending is not None:
+            self.pending.cancel()
+        self.pending = self.loop.call_later(self.settle, self.fire)
+
+    def fire(self):
+        self.pending = None
+        signature = self.stat()
+        if signature is None:
+            return  # Mid replace or deleted; wait for it to come back.
+        self.signature = signature
+        self.callback()
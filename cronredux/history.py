@@ -0,0 +1,472 @@
+"""
+Execution history backends.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import enum
+import json
+import os
+import pendulum
+import shellish
+import sqlite3
+import textwrap
+import zlib
+from cronredux import procwatch
+
+
+class ExecState(enum.IntEnum):
+    """ Life cycle of a task execution.  Members compare by their order in
+    the life cycle and print as their name. """
+
+    init = 0
+    queued = 1
+    start = 2
+    finish = 3
+    timeout = 4
+
+    def __str__(self):
+        return self.name
+
+    def __format__(self, spec):
+        return format(self.name, spec)
+
+    @property
+    def done(self):
+        return self >= ExecState.finish
+
+
+def localtime(ts):
+    """ Convert an epoch timestamp to a local `pendulum.Pendulum`. """
+    if ts is None:
+        return None
+    return pendulum.from_timestamp(ts, pendulum.local_timezone())
+
+
+class ExecView(object):
+    """ Display and serialized forms of an execution.  Subclasses keep plain
+    float seconds and supply `queued_ts`, `started_ts`, `finished_ts`,
+    `elapsed_seconds` and `wait_seconds`; pendulum objects are only built
+    when something is formatted for people. """
+
+    __slots__ = ()
+
+    @property
+    def queued(self):
+        return localtime(self.queued_ts)
+
+    @property
+    def started(self):
+        return localtime(self.started_ts)
+
+    @property
+    def finished(self):
+        return localtime(self.finished_ts)
+
+    @property
+    def elapsed(self):
+        """ Increments for active tasks and when finished gives the total
+        execution time. """
+        return pendulum.Interval(seconds=self.elapsed_seconds)
+
+    @property
+    def wait(self):
+        """ Time spent in the dispatch queue. """
+        return pendulum.Interval(seconds=self.wait_seconds)
+
+    def as_dict(self, output=False):
+        info = {
+            "task": self.task.ident,
+            "id": self.ident,
+            "cmd": self.task.cmd,
+            "state": self.state.name,
+            "returncode": self.returncode,
+            "queued": self.queued_ts,
+            "started": self.started_ts,
+            "finished": self.finished_ts,
+            "wait": self.wait_seconds,
+            "elapsed": self.elapsed_seconds,
+            "output_size": self.output_size,
+            "rusage": self.rusage and self.rusage.as_dict(),
+            "cgroup": self.cgroup
+        }
+        if output:
+            info['output'] = self.output
+        return info
+
+
+class TaskRef(object):
+    """ Stand-in for a task from a stored record that is not in the current
+    crontab. """
+
+    active = 0
+    timeout_count = 0
+
+    def __init__(self, ident, cmd, key):
+        self.ident = ident
+        self.cmd = cmd
+        self.key = key
+
+    def __str__(self):
+        dots = shellish.beststr("…", '...')
+        cmd = textwrap.shorten(self.cmd, width=40, placeholder=dots)
+        return '<Task %d: cmd="%s">' % (self.ident, cmd)
+
+
+class ExecRecord(ExecView):
+    """ A finished execution loaded from a history store.  Provides the same
+    attributes as a finished `TaskExecContext`. """
+
+    __slots__ = ('rowid', 'task', 'ident', 'state', 'returncode', 'queued_ts',
+                 'started_ts', 'finished_ts', 'output', 'output_size',
+                 'output_file', 'rusage', 'cgroup')
+
+    def __init__(self, rowid, task, ident, state, returncode, queued_ts,
+                 started_ts, finished_ts, output, output_size, output_file,
+                 rusage):
+        self.rowid = rowid
+        self.task = task
+        self.ident = ident
+        self.state = state
+        self.returncode = returncode
+        self.queued_ts = queued_ts
+        self.started_ts = started_ts
+        self.finished_ts = finished_ts
+        self.output = output
+        self.output_size = output_size
+        self.output_file = output_file
+        self.rusage = rusage
+        self.cgroup = None  # Not stored
+
+    def __str__(self):
+        return '<TaskExecContext %d [%s]> for %s' % (self.ident, self.state,
+                                                     self.task)
+
+    @property
+    def elapsed_seconds(self):
+        if self.started_ts is None or self.finished_ts is None:
+            return 0
+        return self.finished_ts - self.started_ts
+
+    @property
+    def wait_seconds(self):
+        if self.queued_ts is None or self.started_ts is None:
+            return 0
+        return self.started_ts - self.queued_ts
+
+    @property
+    def timed_out(self):
+        return self.state == ExecState.timeout
+
+    def is_error(self):
+        return self.timed_out or not not self.returncode
+
+    def is_done(self):
+        return True
+
+
+class MemoryHistory(object):
+    """ Keep the most recent executions in memory only. """
+
+    def __init__(self, size=100):
+        self.recent = collections.deque(maxlen=size)
+        self.index = {}
+        self.tasks = {}
+        self.evicted = set()  # Still running when dropped from the cache.
+
+    def attach(self, tasks_by_id):
+        """ Resolve the task idents of stored executions against this (live)
+        mapping of the scheduler's tasks. """
+        self.tasks = tasks_by_id
+
+    def __len__(self):
+        return len(self.recent)
+
+    def __iter__(self):
+        """ Iterate the cached executions, newest first. """
+        return iter(self.recent)
+
+    @asyncio.coroutine
+    def setup(self, loop):
+        pass
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+    def add(self, context):
+        """ Track a new execution.  The oldest cached execution is dropped
+        (along with its spilled output) when the cache is full.  Spilled
+        output of one still running is removed once it is recorded. """
+        if len(self.recent) == self.recent.maxlen:
+            evicted = self.recent[-1]
+            del self.index[evicted.task.ident, evicted.ident]
+            if evicted.is_done():
+                evicted.discard_output()
+            else:
+                self.evicted.add(evicted)
+        self.recent.appendleft(context)
+        self.index[context.task.ident, context.ident] = context
+
+    def record(self, context):
+        """ Called once an execution is done. """
+        if context in self.evicted:
+            self.evicted.remove(context)
+            context.discard_output()
+
+    def get(self, task_ident, ident):
+        return self.index.get((task_ident, ident))
+
+    @asyncio.coroutine
+    def get_async(self, task_ident, ident):
+        """ `get` for callers that should not hold up the event loop. """
+        return self.get(task_ident, ident)
+
+    def query(self, task=None, failed=None, limit=50, offset=0):
+        """ Return up to `limit` executions, newest first, optionally
+        filtered by task ident and by failure.  Running executions never
+        match a `failed` filter. """
+        matches = []
+        for x in self.recent:
+            if task is not None and x.task.ident != task:
+                continue
+            if failed is not None and (not x.is_done() or
+                                       x.is_error() != failed):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            matches.append(x)
+            if len(matches) == limit:
+                break
+        return matches
+
+    @asyncio.coroutine
+    def query_async(self, task=None, failed=None, limit=50, offset=0):
+        """ `query` for callers that should not hold up the event loop. """
+        return self.query(task, failed, limit, offset)
+
+
+class SQLiteHistory(MemoryHistory):
+    """ Keep every execution in an SQLite database indexed by task, time and
+    failure.  Recent executions (including running ones) stay in an in-memory
+    cache.  Finished executions are written in batches from a dedicated
+    thread so the event loop never waits on disk; output is size capped and
+    compressed.  Queries run against the database, so pages of old history
+    can be read without loading anything else.  Only the `_async` lookups
+    read the database (in the writer thread); the plain ones see the cache.
+
+    Task and execution idents restart with cronredux, so stored executions
+    are looked up by the key (schedule and command) of the task instead. """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS executions ('
+        '    id INTEGER PRIMARY KEY,'
+        '    task INTEGER NOT NULL,'
+        '    ident INTEGER NOT NULL,'
+        '    cmd TEXT NOT NULL,'
+        '    task_key TEXT NOT NULL,'
+        '    state TEXT NOT NULL,'
+        '    failed INTEGER NOT NULL,'
+        '    returncode INTEGER,'
+        '    queued REAL,'
+        '    started REAL,'
+        '    finished REAL,'
+        '    output_size INTEGER,'
+        '    output_file TEXT,'
+        '    rusage TEXT,'
+        '    output BLOB)',
+        'CREATE INDEX IF NOT EXISTS executions_task_key '
+        '    ON executions (task_key, id)',
+        'CREATE INDEX IF NOT EXISTS executions_failed_task_key '
+        '    ON executions (failed, task_key, id)',
+        'CREATE INDEX IF NOT EXISTS executions_finished '
+        '    ON executions (finished)',
+    )
+    columns = ('task', 'ident', 'cmd', 'task_key', 'state', 'failed',
+               'returncode', 'queued', 'started', 'finished', 'output_size',
+               'output_file', 'rusage', 'output')
+    clip_marker = '\n[... %d chars clipped ...]\n'
+    prune_interval = 1000
+
+    def __init__(self, path, cache_size=100, max_output=65536,
+                 max_rows=1000000, compress_level=6):
+        super().__init__(cache_size)
+        self.path = path
+        self.max_output = max_output
+        self.max_rows = max_rows
+        self.compress_level = compress_level
+        self.pending = []
+        self.flushing = None
+        self.since_prune = 0
+        self.writer = None
+
+    @asyncio.coroutine
+    def setup(self, loop):
+        self.loop = loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        yield from loop.run_in_executor(self.executor, self.open_writer)
+
+    def open_writer(self):
+        """ Runs in the writer thread which owns its own connection. """
+        self.writer = sqlite3.connect(self.path)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+        with self.writer:
+            for x in self.schema:
+                self.writer.execute(x)
+
+    @asyncio.coroutine
+    def close(self):
+        """ Write out anything still pending.  The writer thread runs jobs in
+        order, so this also waits for any flush already in progress. """
+        rows, self.pending = self.pending, []
+        yield from self.loop.run_in_executor(self.executor, self.write, rows)
+        yield from self.loop.run_in_executor(self.executor,
+                                             self.writer.close)
+        self.executor.shutdown()
+
+    def record(self, context):
+        self.pending.append(self.pack(context))
+        super().record(context)
+        if self.flushing is None:
+            self.flush()
+
+    def flush(self):
+        """ Hand all pending rows to the writer thread.  Rows recorded while
+        a flush is running are picked up by the next one. """
+        rows, self.pending = self.pending, []
+        self.flushing = self.loop.run_in_executor(self.executor, self.write,
+                                                  rows)
+        self.flushing.add_done_callback(self.on_flushed)
+
+    def on_flushed(self, f):
+        self.flushing = None
+        try:
+            f.result()
+        except Exception as e:
+            shellish.vtmlprint('<b><red>History write failed:</red></b> %s' %
+                               e)
+        if self.pending:
+            self.flush()
+
+    def pack(self, context):
+        """ Convert a done execution into a row.  Compression happens in the
+        writer thread. """
+        output = context.output or ''
+        if len(output) > self.max_output:
+            half = self.max_output // 2
+            clipped = len(output) - half * 2
+            output = output[:half] + self.clip_marker % clipped + \
+                output[-half:]
+        rusage = context.rusage and json.dumps(context.rusage.as_dict())
+        return (context.task.ident, context.ident, context.task.cmd,
+                context.task.key, context.state.name, int(context.is_error()),
+                context.returncode, context.queued_ts, context.started_ts,
+                context.finished_ts, context.output_size, context.output_file,
+                rusage, output)
+
+    def write(self, rows):
+        if not rows:
+            return
+        rows = [x[:-1] + (zlib.compress(x[-1].encode(),
+                                        self.compress_level),)
+                for x in rows]
+        sql = 'INSERT INTO executions (%s) VALUES (%s)' % (
+            ', '.join(self.columns), ', '.join('?' * len(self.columns)))
+        with self.writer:
+            self.writer.executemany(sql, rows)
+        self.since_prune += len(rows)
+        if self.max_rows and self.since_prune >= self.prune_interval:
+            self.since_prune = 0
+            with self.writer:
+                cursor = self.writer.execute('SELECT MAX(id) FROM executions')
+                last = cursor.fetchone()[0]
+                self.writer.execute('DELETE FROM executions WHERE id <= ?',
+                                    (last - self.max_rows,))
+
+    def unpack(self, row):
+        (rowid, task_ident, ident, cmd, key, state, returncode, queued,
+         started, finished, output_size, output_file, rusage, output) = row
+        task = self.tasks.get(task_ident)
+        if task is None or task.key != key:
+            task = TaskRef(task_ident, cmd, key)
+        if rusage is not None:
+            rusage = procwatch.ResourceUsage(**json.loads(rusage))
+        if output is not None:
+            output = zlib.decompress(output).decode()
+        if output_file is not None and not os.path.exists(output_file):
+            output_file = None
+        return ExecRecord(rowid, task, ident, ExecState[state], returncode,
+                          queued, started, finished, output, output_size,
+                          output_file, rusage)
+
+    def select(self, where, args, limit=50, offset=0):
+        """ Runs in the writer thread. """
+        sql = ('SELECT id, task, ident, cmd, task_key, state, returncode, '
+               'queued, started, finished, output_size, output_file, rusage, '
+               'output FROM executions %s ORDER BY id DESC LIMIT ? OFFSET ?' %
+               where)
+        cursor = self.writer.execute(sql, tuple(args) + (limit, offset))
+        return [self.unpack(x) for x in cursor]
+
+    @asyncio.coroutine
+    def read(self, where, args, limit=50, offset=0):
+        """ Select in the writer thread after writing any pending rows, so
+        the result includes every recorded execution. """
+        rows, self.pending = self.pending, []
+
+        def job():
+            self.write(rows)
+            return self.select(where, args, limit, offset)
+        return (yield from self.loop.run_in_executor(self.executor, job))
+
+    def task_key(self, task_ident):
+        task = self.tasks.get(task_ident)
+        return task and task.key
+
+    @asyncio.coroutine
+    def get_async(self, task_ident, ident):
+        """ Look in the cache first and then for the newest stored execution
+        of the task's key with this ident. """
+        context = self.get(task_ident, ident)
+        if context is not None:
+            return context
+        found = yield from self.read('WHERE task_key = ? AND ident = ?',
+                                     (self.task_key(task_ident), ident),
+                                     limit=1)
+        return found[0] if found else None
+
+    @asyncio.coroutine
+    def query_async(self, task=None, failed=None, limit=50, offset=0):
+        """ Return up to `limit` stored executions, newest first.  Executions
+        that are still running are not included. """
+        where, args = self.filters(task, failed)
+        return (yield from self.read(where, args, limit, offset))
+
+    def filters(self, task, failed):
+        where = []
+        args = []
+        if failed is not None:
+            where.append('failed = ?')
+            args.append(int(failed))
+        if task is not None:
+            where.append('task_key = ?')
+            args.append(self.task_key(task))
+        return ('WHERE ' + ' AND '.join(where)) if where else '', args
+
+
+def load_durations(path):
+    """ Average run time in seconds of every command recorded in an
+    `SQLiteHistory` database. """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    db = sqlite3.connect(path)
+    try:
+        cursor = db.execute('SELECT cmd, AVG(finished - started) '
+                            'FROM executions WHERE finished IS NOT NULL '
+                            'AND started IS NOT NULL GROUP BY cmd')
+        return dict(cursor.fetchall())
+    finally:
+        db.close()
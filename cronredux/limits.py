@@ -0,0 +1,371 @@
+"""
+Per-task resource controls for spawned commands.
+
+A task can lower its CPU and I/O priority and set resource limits with crontab
+options.  The child is held at a small shell gate until these have been
+applied to it, and only then execs the command:
+
+    #: nice=10 ionice=idle rlimit_as=2G rlimit_cpu=600 rlimit_nofile=1024
+
+CPU and memory caps for the whole process tree need cgroup v2.  Each
+execution with `cpu_max` or `memory_max` gets a transient child cgroup, whose
+CPU and memory stats are read back when the job ends:
+
+    #: cpu_max=50% memory_max=512M
+
+When cgroups are not available or not writable the caps are skipped (with a
+warning) and the job runs without them.
+"""
+
+import ctypes
+import errno
+import os
+import platform
+import resource
+import sys
+
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+IOPRIO_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'riscv64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282
+}
+CPU_PERIOD = 100000  # usec
+# Prefix to a command's argv that waits for a line on stdin before exec'ing
+# it.  Leaves the command with an empty stdin.
+GATE = ('/bin/sh', '-c', 'read _; exec "$@"', 'sh')
+RLIMITS = {
+    "rlimit_as": resource.RLIMIT_AS,
+    "rlimit_cpu": resource.RLIMIT_CPU,
+    "rlimit_nofile": resource.RLIMIT_NOFILE
+}
+
+
+def text(value):
+    """ Option values must be given; a bare option key comes as True. """
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value
+
+
+def parse_size(value):
+    """ Bytes from a size like "512M" (binary units). """
+    value = text(value).strip().upper().rstrip('B')
+    scale = SIZE_UNITS.get(value[-1:], 1)
+    if scale != 1:
+        value = value[:-1]
+    size = int(float(value) * scale)
+    if size <= 0:
+        raise ValueError(value)
+    return size
+
+
+def parse_nice(value):
+    """ A niceness increment from 0 to 19; only root could go below 0. """
+    nice = int(text(value))
+    if not 0 <= nice <= 19:
+        raise ValueError(value)
+    return nice
+
+
+def parse_ionice(value):
+    """ An I/O scheduling class and level such as "idle" or
+    "best-effort:7".  Returns (class, level). """
+    name, sep, level = text(value).partition(':')
+    level = int(level) if sep else 4
+    if name not in IOPRIO_CLASSES or not 0 <= level <= 7:
+        raise ValueError(value)
+    return name, level
+
+
+def parse_cpu_max(value):
+    """ A cgroup cpu.max setting from a share of one CPU ("50%"), a number of
+    CPUs ("1.5") or a "QUOTA/PERIOD" in microseconds. """
+    value = text(value).strip()
+    if '/' in value:
+        quota, period = value.split('/')
+        if quota != 'max':
+            int(quota)
+        return '%s %d' % (quota, int(period))
+    if value.endswith('%'):
+        cpus = float(value[:-1]) / 100
+    else:
+        cpus = float(value)
+    if cpus <= 0:
+        raise ValueError(value)
+    return '%d %d' % (max(int(cpus * CPU_PERIOD), 1000), CPU_PERIOD)
+
+
+def load_ioprio_set():
+    """ Return a function setting the I/O priority of a process (by pid) or
+    None if the platform has no known ioprio_set syscall. """
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None or not sys.platform.startswith('linux'):
+        return None
+    try:
+        syscall = ctypes.CDLL(None, use_errno=True).syscall
+    except (OSError, AttributeError):
+        return None
+    return lambda pid, ioprio: syscall(nr, IOPRIO_WHO_PROCESS, pid, ioprio)
+
+
+ioprio_set = load_ioprio_set()
+
+
+class ResourceLimits(object):
+    """ The resource options of a task. """
+
+    __slots__ = ('nice', 'ionice', 'rlimits', 'cpu_max', 'memory_max')
+
+    def __init__(self, nice=None, ionice=None, rlimits=None, cpu_max=None,
+                 memory_max=None):
+        self.nice = nice
+        self.ionice = ionice
+        self.rlimits = rlimits or {}
+        self.cpu_max = cpu_max
+        self.memory_max = memory_max
+
+    @classmethod
+    def from_options(cls, options):
+        """ Limits from (parsed) task options or None if there are none. """
+        rlimits = dict((RLIMITS[x], options[x]) for x in RLIMITS
+                       if x in options)
+        limits = cls(options.get('nice'), options.get('ionice'), rlimits,
+                     options.get('cpu_max'), options.get('memory_max'))
+        return limits if limits.active else None
+
+    @property
+    def active(self):
+        return any(getattr(self, x) for x in self.__slots__)
+
+    @property
+    def cgroup(self):
+        """ True if a cgroup is needed to enforce these limits. """
+        return bool(self.cpu_max or self.memory_max)
+
+    def apply(self, pid, cgroup=None):
+        """ Apply the limits to the (gated) process `pid` and move it into
+        `cgroup`.  It is best effort; a process that can't have a limit runs
+        without it rather than not at all. """
+        if cgroup is not None:
+            try:
+                write_value(cgroup.procs_file, str(pid))
+            except OSError:
+                pass
+        if self.nice:
+            try:
+                nice = os.getpriority(os.PRIO_PROCESS, 0) + self.nice
+                os.setpriority(os.PRIO_PROCESS, pid, min(nice, 19))
+            except OSError:
+                pass
+        if self.ionice is not None and ioprio_set is not None:
+            name, level = self.ionice
+            ioprio_set(pid, IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT | level)
+        for key, value in self.rlimits.items():
+            hard = resource.getrlimit(key)[1]
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            try:
+                resource.prlimit(pid, key, (value, value))
+            except (OSError, ValueError):
+                pass
+
+
+def read_keyed(path):
+    """ Parse a flat keyed cgroup file like cpu.stat into a dict. """
+    try:
+        with open(path) as f:
+            return dict((k, int(v)) for k, v in (x.split() for x in f))
+    except (OSError, ValueError):
+        return {}
+
+
+def read_value(path):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_value(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+class Cgroup(object):
+    """ A transient cgroup holding one execution. """
+
+    def __init__(self, path):
+        self.path = path
+        self.procs_file = os.path.join(path, 'cgroup.procs')
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def stats(self):
+        """ CPU seconds and throttling, peak memory and OOM kills. """
+        cpu = read_keyed(self.file('cpu.stat'))
+        events = read_keyed(self.file('memory.events'))
+        peak = read_value(self.file('memory.peak'))
+        if peak is None:  # Kernels before 5.19.
+            peak = read_value(self.file('memory.current'))
+        return {
+            "cpu": cpu.get('usage_usec', 0) / 1e6,
+            "cpu_user": cpu.get('user_usec', 0) / 1e6,
+            "cpu_system": cpu.get('system_usec', 0) / 1e6,
+            "throttled": cpu.get('throttled_usec', 0) / 1e6,
+            "nr_throttled": cpu.get('nr_throttled', 0),
+            "memory_peak": peak,
+            "oom_kills": events.get('oom_kill', 0)
+        }
+
+    def remove(self):
+        """ Remove the cgroup, killing anything the job left running in it.
+        Returns False if it is not empty yet. """
+        try:
+            os.rmdir(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                raise
+            try:
+                write_value(self.file('cgroup.kill'), '1')
+            except OSError:
+                pass
+            return False
+        return True
+
+
+class CgroupManager(object):
+    """ Create a transient cgroup v2 child for each execution with CPU or
+    memory caps under `root`, by default our own cgroup.  Setup happens on
+    first use.  The cpu and memory controllers are enabled for the children;
+    since a cgroup with processes can't do that our process is moved into a
+    "supervisor" leaf first if need be.  Any failure leaves the manager
+    disabled with the reason in `error`. """
+
+    wanted = ('cpu', 'memory')
+
+    def __init__(self, root=None, mounts='/proc/self/mounts',
+                 self_cgroup='/proc/self/cgroup'):
+        self.root = root
+        self.mounts = mounts
+        self.self_cgroup = self_cgroup
+        self.path = None
+        self.controllers = ()
+        self.error = None
+        self.ready = False
+        self.created = 0
+        self.failed = 0
+        self.stale = []
+
+    def find_root(self):
+        """ Our own cgroup in the cgroup2 hierarchy. """
+        mount = None
+        with open(self.mounts) as f:
+            for line in f:
+                fields = line.split()
+                if fields[2] == 'cgroup2':
+                    mount = fields[1]
+                    break
+        if mount is None:
+            raise OSError('No cgroup2 filesystem mounted')
+        with open(self.self_cgroup) as f:
+            for line in f:
+                if line.startswith('0::'):
+                    return os.path.join(mount, line[3:].strip().lstrip('/'))
+        raise OSError('Not in a cgroup2 hierarchy')
+
+    def enable(self, path, controllers):
+        write_value(os.path.join(path, 'cgroup.subtree_control'),
+                    ' '.join('+' + x for x in controllers))
+
+    def setup(self):
+        """ Prepare the root cgroup.  Returns True if cgroups can be used. """
+        if self.ready:
+            return self.error is None
+        self.ready = True
+        try:
+            path = self.root or self.find_root()
+            with open(os.path.join(path, 'cgroup.controllers')) as f:
+                available = f.read().split()
+            controllers = [x for x in self.wanted if x in available]
+            if not controllers:
+                raise OSError('No cpu or memory controller in %s' % path)
+            try:
+                self.enable(path, controllers)
+            except OSError as e:
+                if e.errno != errno.EBUSY:
+                    raise
+                leaf = os.path.join(path, 'supervisor')
+                os.makedirs(leaf, exist_ok=True)
+                write_value(os.path.join(leaf, 'cgroup.procs'),
+                            str(os.getpid()))
+                self.enable(path, controllers)
+        except OSError as e:
+            self.error = str(e)
+            print('Cgroups unavailable, CPU and memory caps are not '
+                  'enforced: %s' % e, file=sys.stderr)
+            return False
+        self.path = path
+        self.controllers = tuple(controllers)
+        return True
+
+    def create(self, name, limits):
+        """ Make a cgroup for an execution with `limits` or return None if
+        that can't be done. """
+        if not self.setup():
+            self.failed += 1
+            return None
+        self.stale = [x for x in self.stale if not x.remove()]
+        cgroup = Cgroup(os.path.join(self.path, name))
+        try:
+            os.mkdir(cgroup.path)
+            if limits.cpu_max and 'cpu' in self.controllers:
+                write_value(cgroup.file('cpu.max'), limits.cpu_max)
+            if limits.memory_max and 'memory' in self.controllers:
+                write_value(cgroup.file('memory.max'),
+                            str(limits.memory_max))
+        except OSError as e:
+            self.failed += 1
+            print('Cgroup %s not created: %s' % (cgroup.path, e),
+                  file=sys.stderr)
+            try:
+                os.rmdir(cgroup.path)
+            except OSError:
+                pass
+            return None
+        self.created += 1
+        return cgroup
+
+    def finish(self, cgroup):
+        """ Collect the stats of a finished execution's cgroup and remove
+        it (later if something is still running in it). """
+        stats = cgroup.stats()
+        try:
+            if not cgroup.remove():
+                self.stale.append(cgroup)
+        except OSError as e:
+            print('Cgroup %s not removed: %s' % (cgroup.path, e),
+                  file=sys.stderr)
+        return stats
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "controllers": list(self.controllers),
+            "error": self.error,
+            "created": self.created,
+            "failed": self.failed,
+            "stale": len(self.stale)
+        }
@@ -0,0 +1,253 @@
+"""
+Buffered, asynchronous logging of task output.
+
+Output lines are handed to each `LogSink` along with a `LogMeta` describing
+the execution they came from.  Sinks only queue them; a background thread
+formats and writes them in batches so a large output or a slow stdout never
+stalls the event loop.  When a sink falls too far behind new entries are
+dropped and counted instead of growing the buffer without bound.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+import time
+import zlib
+
+LogMeta = collections.namedtuple('LogMeta', 'time, task, cmd, exec, exit')
+
+
+def plain_format(meta, line):
+    """ The classic "[cmd] [job:N] [exit:N] line" format.  The exit code is
+    "-" while output is being streamed. """
+    exitcode = '-' if meta.exit is None else meta.exit
+    return '[%s] [job:%d] [exit:%s] %s' % (meta.cmd, meta.exec, exitcode,
+                                           line)
+
+
+def json_format(meta, line):
+    """ One JSON object per line. """
+    return json.dumps({
+        "time": meta.time,
+        "task": meta.task,
+        "cmd": meta.cmd,
+        "exec": meta.exec,
+        "exit": meta.exit,
+        "line": line
+    })
+
+
+formatters = {
+    "plain": plain_format,
+    "json": json_format
+}
+
+
+class StreamWriter(object):
+    """ Write formatted lines to a file object such as stdout. """
+
+    def __init__(self, stream=None, formatter=plain_format):
+        self.stream = stream
+        self.formatter = formatter
+
+    def write(self, batch):
+        stream = self.stream or sys.stdout
+        fmt = self.formatter
+        stream.write(''.join(fmt(meta, x) + '\n'
+                             for meta, lines in batch for x in lines))
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class RotatingFile(object):
+    """ An append only file that is rotated to "name.1" ... "name.N" once it
+    would grow past `max_bytes`.  A `max_bytes` of 0 disables rotation. """
+
+    def __init__(self, path, max_bytes=0, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def write(self, data):
+        if self.max_bytes and self.size and \
+           self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+        self.file = open(self.path, 'ab')
+        self.size = 0
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TaskFileWriter(object):
+    """ Write each task's output to its own (rotating) file in `directory`.
+    Files are named after the command so they survive restarts and at most
+    `max_open` are kept open. """
+
+    max_open = 64
+
+    def __init__(self, directory, formatter=plain_format, max_bytes=0,
+                 backups=5):
+        self.directory = directory
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.files = collections.OrderedDict()
+
+    @staticmethod
+    def filename(cmd):
+        slug = re.sub(r'[^\w.-]+', '_', cmd).strip('_.')[:40]
+        return '%s-%08x.log' % (slug, zlib.crc32(cmd.encode()))
+
+    def get_file(self, cmd):
+        f = self.files.get(cmd)
+        if f is None:
+            path = os.path.join(self.directory, self.filename(cmd))
+            f = self.files[cmd] = RotatingFile(path, self.max_bytes,
+                                               self.backups)
+            while len(self.files) > self.max_open:
+                self.files.popitem(last=False)[1].close()
+        else:
+            self.files.move_to_end(cmd)
+        return f
+
+    def write(self, batch):
+        fmt = self.formatter
+        touched = set()
+        for meta, lines in batch:
+            f = self.get_file(meta.cmd)
+            for x in lines:
+                f.write((fmt(meta, x) + '\n').encode('utf-8', 'replace'))
+            touched.add(f)
+        for f in touched:
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+class LogSink(object):
+    """ Queue log entries and hand them to `writer` in batches of up to
+    `batch_size` entries on a dedicated thread.  An entry is a `LogMeta` and
+    an iterable of lines, which is only consumed by the writer.  At most
+    `max_pending` entries wait; beyond that new ones are dropped (see
+    `stats`). """
+
+    def __init__(self, writer, loop, name='stdout', max_pending=10000,
+                 batch_size=500, flush_delay=0.05):
+        self.writer = writer
+        self.loop = loop
+        self.name = name
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.timer = None
+        self.writing = None
+        self.in_flight = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.write_time = 0.0
+        self.max_lag = 0.0
+
+    def emit(self, meta, lines):
+        """ Queue `lines` for writing.  Returns False if they were dropped.
+        """
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        self.pending.append((time.monotonic(), meta, lines))
+        if self.timer is None and self.writing is None:
+            self.timer = self.loop.call_later(self.flush_delay, self.flush)
+        return True
+
+    def flush(self):
+        """ Start writing the next batch unless a write is in progress. """
+        self.timer = None
+        if self.writing is not None or not self.pending:
+            return
+        batch = []
+        now = time.monotonic()
+        while self.pending and len(batch) < self.batch_size:
+            queued, meta, lines = self.pending.popleft()
+            self.max_lag = max(self.max_lag, now - queued)
+            batch.append((meta, lines))
+        self.in_flight = len(batch)
+        self.writing = self.loop.run_in_executor(self.executor, self.write,
+                                                 batch)
+        self.writing.add_done_callback(self.on_written)
+
+    def write(self, batch):
+        """ Writer thread side of `flush`. """
+        start = time.monotonic()
+        self.writer.write(batch)
+        self.write_time += time.monotonic() - start
+
+    def on_written(self, f):
+        self.writing = None
+        self.batches += 1
+        try:
+            f.result()
+        except Exception as e:
+            self.errors += 1
+            print('Log sink %s write failed: %s' % (self.name, e),
+                  file=sys.stderr)
+        else:
+            self.written += self.in_flight
+        self.in_flight = 0
+        if self.pending:
+            self.flush()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "pending": len(self.pending) + self.in_flight,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "write_time": self.write_time,
+            "max_lag": self.max_lag
+        }
+
+    @asyncio.coroutine
+    def close(self):
+        """ Write everything still pending and close the writer. """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.writing is not None or self.pending:
+            if self.writing is None:
+                self.flush()
+            yield from asyncio.wait([self.writing], loop=self.loop)
+        yield from self.loop.run_in_executor(self.executor, self.writer.close)
+        self.executor.shutdown()
@@ -3,10 +3,18 @@ A newage cron service.
 """
 
 import asyncio
-import crontab
+import json
+import os
+import platform
 import shellish
+import signal
+import sys
+import tempfile
+import time
 import cronredux
-from cronredux import cronparser, notification, scheduler
+from cronredux import cluster, cronparser, cronspec, filewatch, history, \
+    limits, logsink, notification, pressure, procwatch, scheduler, simulate, \
+    workers
 from cronredux.diag import web
 
 
@@ -34,16 +42,143 @@ class CronReduxCommand(shellish.Command):
                           'slack icon emoji.')
         self.add_argument('--notify-exec', action='store_true',
                           help='Enable notifications for each task execution.')
-        self.add_argument('--XXX-slow-exec-warning', type=float, default=60,
+        self.add_argument('--notify-queue-size', type=int, default=1000,
+                          help='Max notifications waiting to be sent.')
+        self.add_argument('--notify-batch-size', type=int, default=20,
+                          help='Max notifications merged into one post.')
+        self.add_argument('--notify-overflow', default='summarize',
+                          choices=notification.SlackNotifier.overflow_policies,
+                          help='What to do with notifications that overflow '
+                          'the queue.')
+        self.add_argument('--notify-rate', type=float, default=1,
+                          help='Max Slack posts per second on average.  Use '
+                          '0 for no limit.')
+        self.add_argument('--notify-burst', type=int, default=5,
+                          help='Slack posts allowed in a burst above '
+                          '--notify-rate.  Must be at least 1.')
+        self.add_argument('--notify-digest-interval', type=float,
+                          default=3600, help='Seconds between "still '
+                          'failing" digests of a task that keeps failing the '
+                          'same way; repeats in between are not reported.  '
+                          'Use 0 to report every failure.')
+        self.add_argument('--slow-exec-warning', '--XXX-slow-exec-warning',
+                          type=float, default=60,
                           help='Time in seconds before a warning is generated '
-                          'about slow task execution.')
-        self.add_argument('--XXX-backlog-warning', type=float, default=60,
+                          'about slow task execution.  Use 0 to disable.')
+        self.add_argument('--backlog-warning', '--XXX-backlog-warning',
+                          type=float, default=60,
                           help='Time in seconds before a warning is generated '
-                          'about a delayed task execution due to a backlog.')
+                          'about a delayed task execution due to a backlog.  '
+                          'Use 0 to disable.')
         self.add_argument('--max-concurrency', type=int, default=10,
                           help='Max tasks that will be allowed to'
                           'run concurrently.')
+        self.add_argument('--adaptive-concurrency', action='store_true',
+                          help='Adjust the concurrency limit between '
+                          '--min-concurrency and --max-concurrency based on '
+                          'system pressure (Linux PSI or the load average).')
+        self.add_argument('--min-concurrency', type=int, default=1,
+                          help='Lower bound (and starting point) of the '
+                          'adaptive concurrency limit.')
+        self.add_argument('--pressure-target', type=float, default=20,
+                          help='CPU and I/O pressure (percent of time '
+                          'stalled) above which the adaptive concurrency '
+                          'limit is reduced.')
+        self.add_argument('--load-target', type=float, default=1.0,
+                          help='Load average per CPU above which the '
+                          'adaptive concurrency limit is reduced on hosts '
+                          'without pressure stall information.')
+        self.add_argument('--memory-pressure-target', type=float, default=1,
+                          help='Memory pressure (percent of time stalled) '
+                          'above which the adaptive concurrency limit is '
+                          'reduced.')
+        self.add_argument('--adaptive-interval', type=float, default=5,
+                          help='Seconds between adaptive concurrency '
+                          'adjustments.')
+        self.add_argument('--timeout', type=float, default=0,
+                          help='Default time in seconds a task may run before '
+                          'its process group is terminated.  Use 0 for no '
+                          'limit.')
+        self.add_argument('--kill-grace', type=float, default=10,
+                          help='Time in seconds between terminating a timed '
+                          'out task and killing it.')
+        self.add_argument('--cgroup-root', metavar='PATH',
+                          help='Cgroup v2 directory to create the cgroups of '
+                          'tasks with cpu_max or memory_max options in.  By '
+                          'default our own cgroup is used.')
+        self.add_argument('--no-cgroups', dest='cgroups',
+                          action='store_false', help='Never create cgroups; '
+                          'cpu_max and memory_max task options are ignored.')
+        self.add_argument('--cluster', metavar='URL', help='Share the '
+                          'crontab with the other nodes using this lease '
+                          'backend; "sqlite://PATH" or "file://DIR" for '
+                          'nodes on one host or "tcp://HOST:PORT" for a '
+                          '`cronredux coordinator`.  Each task runs on one '
+                          'node.')
+        self.add_argument('--cluster-node', metavar='NAME',
+                          help='Unique name of this node in the cluster.  '
+                          'The default is HOST:DIAG_PORT.')
+        self.add_argument('--cluster-ttl', type=float, default=15,
+                          help='Seconds without a heartbeat after which a '
+                          'node is considered dead and its tasks move.')
+        self.add_argument('--history-db', metavar='PATH',
+                          help='SQLite database for keeping the history of '
+                          'every task execution.  By default only recent '
+                          'history is kept in memory.')
+        self.add_argument('--history-cache', type=int, default=100,
+                          help='Number of recent task executions kept in '
+                          'memory.')
+        self.add_argument('--history-max-output', type=int, default=65536,
+                          help='Max characters of output stored per task '
+                          'execution in the history database.')
+        self.add_argument('--history-max-rows', type=int, default=1000000,
+                          help='Max task executions kept in the history '
+                          'database.  Use 0 for no limit.')
+        self.add_argument('--workers', type=int, default=2,
+                          help='Max worker processes for running Python '
+                          'callable ("py:module:function") tasks.')
+        self.add_argument('--worker-max-runs', type=int, default=100,
+                          help='Calls a Python worker process runs before it '
+                          'is replaced.')
+        self.add_argument('--worker-max-rss', type=int, default=0,
+                          metavar='MIB', help='Peak RSS in MiB after which '
+                          'a Python worker process is replaced.  Use 0 for '
+                          'no limit.')
+        self.add_argument('--concurrency-group', action='append',
+                          metavar='NAME=LIMIT', help='Max tasks of a '
+                          'concurrency group that will be allowed to run '
+                          'concurrently.  May be repeated.')
         self.add_argument('--allow-overlap', action='store_true')
+        self.add_argument('--stream-output', action='store_true',
+                          help='Log task output lines as they are produced '
+                          'instead of when the task finishes.')
+        self.add_argument('--output-head', type=int, default=65536,
+                          help='Bytes kept from the start of task output.')
+        self.add_argument('--output-tail', type=int, default=65536,
+                          help='Bytes kept from the end of task output.')
+        self.add_argument('--output-spill-dir', help='Directory to write the '
+                          'complete output of each task execution to.')
+        self.add_argument('--log-format', default='plain',
+                          choices=sorted(logsink.formatters),
+                          help='Format of task output lines logged to '
+                          'stdout and task log files.')
+        self.add_argument('--log-buffer', type=int, default=10000,
+                          help='Max task output entries waiting to be '
+                          'written by each log sink before new ones are '
+                          'dropped.')
+        self.add_argument('--task-log-dir', help='Directory to also write '
+                          'the output of each task to, one file per task.')
+        self.add_argument('--task-log-max-bytes', type=int,
+                          default=10 * 1024 * 1024, help='Size at which task '
+                          'log files are rotated.  Use 0 to never rotate.')
+        self.add_argument('--task-log-backups', type=int, default=5,
+                          help='Rotated task log files kept.')
+        self.add_argument('--no-watch', dest='watch', action='store_false',
+                          help='Do not reload the crontab when it changes '
+                          '(SIGHUP still reloads it).')
+        self.add_argument('--watch-poll-interval', type=float, default=2,
+                          help='Seconds between checks of the crontab file '
+                          'when inotify is not available.')
         self.add_argument('--plain', action='store_true')
 
     def run(self, args):
@@ -55,28 +190,123 @@ class CronReduxCommand(shellish.Command):
             shellish.vtmlprint("<b>Processing crontab file:</b> <red>%s</red>"
                                % args.crontab, plain=cronredux.PLAIN_OUTPUT)
         with args.crontab as f:
-            for spec, command in cronparser.parsef(f):
+            try:
+                entries = list(cronparser.entries(f))
+            except ValueError as e:
+                raise SystemExit('Invalid crontab: %s' % e)
+            for spec, command, options in entries:
                 if args.verbose:
                     shellish.vtmlprint("<b>Adding task:</b> <blue>%s</blue> %s"
                                        % (spec, command),
                                        plain=cronredux.PLAIN_OUTPUT)
-                tasks.append(scheduler.Task(crontab.CronTab(spec), command))
+                try:
+                    task = scheduler.Task(cronspec.intern(spec, command),
+                                          command, options)
+                except ValueError as e:
+                    raise SystemExit('Invalid crontab entry "%s %s": %s' % (
+                                     spec, command, e))
+                tasks.append(task)
         if args.slack_webhook:
-            notifier = notification.SlackNotifier(
-                args.slack_webhook,
-                channel=args.slack_channel,
-                username=args.slack_username,
-                icon_emoji=args.slack_icon_emoji)
+            try:
+                notifier = notification.SlackNotifier(
+                    args.slack_webhook,
+                    channel=args.slack_channel,
+                    username=args.slack_username,
+                    icon_emoji=args.slack_icon_emoji,
+                    max_queue=args.notify_queue_size,
+                    max_batch=args.notify_batch_size,
+                    overflow=args.notify_overflow,
+                    rate=args.notify_rate,
+                    burst=args.notify_burst,
+                    digest_interval=args.notify_digest_interval)
+            except ValueError as e:
+                raise SystemExit(e)
         else:
-            notifier = notification.PrintNotifier()
+            notifier = notification.PrintNotifier(
+                digest_interval=args.notify_digest_interval)
         loop = asyncio.get_event_loop()
-        sched = scheduler.Scheduler(tasks, args, notifier, loop)
+        watcher = procwatch.RusageChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.set_child_watcher(watcher)
+        if args.history_db:
+            store = history.SQLiteHistory(args.history_db,
+                                          cache_size=args.history_cache,
+                                          max_output=args.history_max_output,
+                                          max_rows=args.history_max_rows)
+        else:
+            store = history.MemoryHistory(args.history_cache)
+        pool = workers.WorkerPool(loop, size=args.workers,
+                                  max_runs=args.worker_max_runs,
+                                  max_rss=args.worker_max_rss * 1024 * 1024)
+        if args.adaptive_concurrency:
+            try:
+                adaptive = pressure.AdaptiveConcurrency(
+                    loop, args.min_concurrency, args.max_concurrency,
+                    interval=args.adaptive_interval,
+                    target=args.pressure_target,
+                    memory_target=args.memory_pressure_target,
+                    load_target=args.load_target)
+            except ValueError as e:
+                raise SystemExit(e)
+        else:
+            adaptive = None
+        formatter = logsink.formatters[args.log_format]
+        sinks = [logsink.LogSink(logsink.StreamWriter(formatter=formatter),
+                                 loop, max_pending=args.log_buffer)]
+        if args.task_log_dir:
+            os.makedirs(args.task_log_dir, exist_ok=True)
+            writer = logsink.TaskFileWriter(
+                args.task_log_dir, formatter,
+                max_bytes=args.task_log_max_bytes,
+                backups=args.task_log_backups)
+            sinks.append(logsink.LogSink(writer, loop, name='task-files',
+                                         max_pending=args.log_buffer))
+        if args.output_spill_dir:
+            try:
+                os.makedirs(args.output_spill_dir, exist_ok=True)
+                tempfile.TemporaryFile(dir=args.output_spill_dir).close()
+            except OSError as e:
+                raise SystemExit('Invalid output spill directory: %s' % e)
+        if args.cgroups:
+            cgroups = limits.CgroupManager(args.cgroup_root)
+        else:
+            cgroups = None
+        if args.cluster:
+            node = args.cluster_node or '%s:%d' % (platform.node(),
+                                                   args.diag_port)
+            try:
+                backend = cluster.open_backend(args.cluster, loop)
+            except (OSError, ValueError) as e:
+                raise SystemExit('Invalid cluster backend: %s' % e)
+            members = cluster.Cluster(node, backend, loop,
+                                      ttl=args.cluster_ttl)
+        else:
+            members = None
+        sched = scheduler.Scheduler(tasks, args, notifier, loop, store, pool,
+                                    adaptive, sinks, cgroups, members)
+        self.loop = loop
+        self.sched = sched
+        self.notifier = notifier
+        crontab_file = args.crontab.filename
+        if crontab_file != '-':
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+            if args.watch:
+                file_watcher = filewatch.FileWatcher(
+                    crontab_file, self.reload, loop,
+                    poll_interval=args.watch_poll_interval)
+                file_watcher.start()
+                if args.verbose:
+                    shellish.vtmlprint("<b>Watching crontab file:</b> %s "
+                                       "(%s)" % (crontab_file,
+                                                 file_watcher.mode),
+                                       plain=cronredux.PLAIN_OUTPUT)
         diag = web.DiagService(tasks,
                                args,
                                loop,
                                sched=sched,
                                plain=cronredux.PLAIN_OUTPUT)
         try:
+            loop.run_until_complete(store.setup(loop))
             loop.run_until_complete(notifier.setup(loop))
             loop.run_until_complete(diag.start())
             loop.create_task(sched.run())
@@ -88,11 +318,175 @@ class CronReduxCommand(shellish.Command):
                 shellish.vtmlprint("<b>Shutting Down</b>",
                                    plain=cronredux.PLAIN_OUTPUT)
                 loop.run_until_complete(diag.cleanup())
+            if members is not None:
+                loop.run_until_complete(members.close())
+            loop.run_until_complete(pool.close())
+            for sink in sinks:
+                loop.run_until_complete(sink.close())
+            loop.run_until_complete(notifier.close())
+            loop.run_until_complete(store.close())
+            loop.close()
+
+    def reload(self):
+        """ Re-read the crontab and apply only what changed.  A crontab that
+        fails to load is reported and the current tasks are kept. """
+        path = self.args.crontab.filename
+        try:
+            with open(path) as f:
+                entries = list(cronparser.entries(f))
+            added, removed = self.sched.update_tasks(entries)
+        except (OSError, ValueError) as e:
+            self.loop.create_task(self.notifier.error(
+                'Crontab reload failed', '%s: %s' % (path, e)))
+            return
+        if added or removed:
+            for task in added:
+                shellish.vtmlprint("<b>Adding task:</b> <blue>%s</blue> %s"
+                                   % (task.crontab, task.cmd),
+                                   plain=cronredux.PLAIN_OUTPUT)
+            for task in removed:
+                shellish.vtmlprint("<b>Removing task:</b> <blue>%s</blue> %s"
+                                   % (task.crontab, task.cmd),
+                                   plain=cronredux.PLAIN_OUTPUT)
+            self.loop.create_task(self.notifier.info(
+                'Crontab reloaded', '%d tasks added, %d removed.' % (
+                    len(added), len(removed))))
+
+
+class SimulateCommand(shellish.Command):
+    """ Simulate a crontab.
+
+    Replay the schedule on a virtual clock with each task taking an
+    estimated time to run and report whether it fits the concurrency
+    limits. """
+
+    name = "simulate"
+    start_formats = ('%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+    def setup_args(self, parser):
+        self.add_file_argument('crontab', help='Crontab file to read.')
+        self.add_argument('--start', help='Local time to start the '
+                          'simulation from as "YYYY-MM-DD [HH:MM]".  The '
+                          'default is midnight today.')
+        self.add_argument('--days', type=float, default=1,
+                          help='Days of schedule to simulate.')
+        self.add_argument('--durations', metavar='PATH', help='JSON file '
+                          'mapping commands to their run time in seconds.')
+        self.add_argument('--history-db', metavar='PATH',
+                          help='History database to take the average run '
+                          'time of each command from.  Durations given with '
+                          '--durations take precedence.')
+        self.add_argument('--default-duration', type=float, default=1,
+                          help='Run time in seconds of commands with no '
+                          'known duration.')
+        self.add_argument('--max-concurrency', type=int, default=10,
+                          help='Max tasks that will be allowed to run '
+                          'concurrently.')
+        self.add_argument('--concurrency-group', action='append',
+                          metavar='NAME=LIMIT', help='Max tasks of a '
+                          'concurrency group that will be allowed to run '
+                          'concurrently.  May be repeated.')
+        self.add_argument('--allow-overlap', action='store_true')
+        self.add_argument('--backlog-warning', type=float, default=60,
+                          help='Time in seconds before a task waiting for a '
+                          'free slot counts as a backlog warning.  Use 0 to '
+                          'disable.')
+        self.add_argument('--timeout', type=float, default=0,
+                          help='Default time in seconds a task may run.  Use '
+                          '0 for no limit.')
+        self.add_argument('--top', type=int, default=10, help='Number of '
+                          'busiest minutes and most skipped tasks to show.')
+        self.add_argument('--json', action='store_true', help='Print the '
+                          'report as JSON.')
+
+    def parse_start(self, value):
+        if value is None:
+            today = time.localtime()[:3]
+            return time.mktime(today + (0, 0, 0, 0, 0, -1))
+        for fmt in self.start_formats:
+            try:
+                return time.mktime(time.strptime(value, fmt))
+            except ValueError:
+                pass
+        raise SystemExit('Invalid start time: %s' % value)
+
+    def run(self, args):
+        durations = {}
+        if args.history_db:
+            try:
+                durations.update(history.load_durations(args.history_db))
+            except Exception as e:
+                raise SystemExit('Invalid history database: %s' % e)
+        if args.durations:
+            try:
+                with open(args.durations) as f:
+                    durations.update(json.load(f))
+            except (OSError, ValueError) as e:
+                raise SystemExit('Invalid durations file: %s' % e)
+        with args.crontab as f:
+            try:
+                entries = list(cronparser.entries(f))
+                tasks = simulate.build_tasks(entries, durations,
+                                             args.default_duration)
+            except ValueError as e:
+                raise SystemExit('Invalid crontab: %s' % e)
+        report = simulate.simulate(tasks, args, self.parse_start(args.start),
+                                   args.days * 86400)
+        if args.json:
+            print(json.dumps(report, indent=4))
+        else:
+            print(simulate.render(report, args.top))
+
+
+class CoordinatorCommand(shellish.Command):
+    """ Run a cluster coordinator.
+
+    Serve task leases to cronredux nodes started with
+    `--cluster tcp://HOST:PORT`.  Leases are kept in memory; nodes
+    re-register with their next heartbeat if the coordinator restarts. """
+
+    name = "coordinator"
+
+    def setup_args(self, parser):
+        self.add_argument('--listen', default='127.0.0.1:7908',
+                          metavar='HOST:PORT', help='Address to listen on.')
+
+    def run(self, args):
+        host, sep, port = args.listen.rpartition(':')
+        if not sep or not port.isdigit():
+            raise SystemExit('Invalid listen address: %s' % args.listen)
+        loop = asyncio.get_event_loop()
+        coordinator = cluster.Coordinator(loop)
+        try:
+            loop.run_until_complete(coordinator.start(host, int(port)))
+            shellish.vtmlprint('<b>Running coordinator</b>: %s' % args.listen,
+                               plain=cronredux.PLAIN_OUTPUT)
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if coordinator.server is not None:
+                loop.run_until_complete(coordinator.close())
             loop.close()
 
 
+subcommands = dict((x.name, x) for x in (SimulateCommand,
+                                         CoordinatorCommand))
+
+
 def main():
-    CronReduxCommand()()
+    """ Run a subcommand if the first argument names one, else the scheduler.
+    The crontab argument of the root command rules out subparsers, so an
+    existing file wins over a subcommand of the same name.  A crontab after
+    `--` is never taken for one; i.e. `cronredux -- simulate`. """
+    name = sys.argv[1] if len(sys.argv) > 1 else None
+    if name in subcommands and not os.path.exists(name):
+        command = subcommands[name]()
+        command.prog = 'cronredux %s' % name
+        command.get_or_create_session()
+        command(command.argparser.parse_args(sys.argv[2:]))
+    else:
+        CronReduxCommand()()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+"""
+Counters, gauges and histograms exported in the Prometheus text format.
+"""
+
+import bisect
+import math
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+                     .replace('"', r'\"')
+
+
+def fmt(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """ Base for a named family of samples keyed by label values.  Subclasses
+    set `type` and provide `samples()`, generating (suffix, label values,
+    extra labels, value) for each line rendered. """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def label_str(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in pairs)
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s %s' % (self.name, self.type)
+        for suffix, values, extra, value in self.samples():
+            yield '%s%s%s %s' % (self.name, suffix,
+                                 self.label_str(values, extra), fmt(value))
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield '', labels, (), value
+
+
+class Gauge(Metric):
+    """ A value read from `fn` at collection time.  `fn` returns a number or,
+    for labeled gauges, an iterable of (label values, number). """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        if self.labels:
+            for labels, value in self.fn():
+                yield '', labels, (), value
+        else:
+            yield '', (), (), self.fn()
+
+
+class Histogram(Metric):
+    """ Cumulative bucket counts with a sum and count per label set.  An
+    observation costs one bisect and a couple of increments. """
+
+    type = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                       10, 30, 60, 300, 900, 3600)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.series = {}
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        bounds = self.buckets + (math.inf,)
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for le, count in zip(bounds, counts):
+                cumulative += count
+                yield '_bucket', labels, (('le', fmt(float(le))),), cumulative
+            yield '_sum', labels, (), total
+            yield '_count', labels, (), cumulative
+
+
+class Registry(object):
+    """ Collection of metrics rendered together for a scrape. """
+
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self, prefix='cronredux_'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self.add(Gauge(name, help, fn, labels))
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for x in self.metrics:
+            lines.extend(x.render())
+        return '\n'.join(lines) + '\n'
+
+
+class LoopLagMonitor(object):
+    """ Measure event loop responsiveness by how late a periodic timer
+    fires. """
+
+    def __init__(self, loop, histogram=None, interval=1):
+        self.loop = loop
+        self.histogram = histogram
+        self.interval = interval
+        self.lag = 0
+        self.max_lag = 0
+        self.handle = None
+
+    def start(self):
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(self.expected, self.tick)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def tick(self):
+        self.lag = max(self.loop.time() - self.expected, 0)
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.histogram is not None:
+            self.histogram.observe(self.lag)
+        self.start()
@@ -4,19 +4,141 @@ Support for notifications.
 
 import aiohttp
 import asyncio
+import collections
 import json
 import shellish
 import time
 import cronredux
+from cronredux import clock
 
 
-class PrintNotifier(object):
+def localtime(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+
+class AlertState(object):
+    """ The current failure streak of a task. """
+
+    __slots__ = ('since', 'failures', 'signature', 'reported', 'suppressed')
+
+    def __init__(self, since):
+        self.since = since
+        self.failures = 0
+        self.signature = None
+        self.reported = None
+        self.suppressed = 0
+
+
+class Notifier(object):
+    """ Task outcome alerts on top of the `info`, `warning` and `error`
+    methods of a notifier.  Executions are reported with `failure` and
+    `success` and tracked per task:
+
+    * The first failure is sent as an error, as is any failure whose
+      signature differs from the one before it.
+    * Repeats of the same failure are suppressed and summed up in one
+      "Still failing" error every `digest_interval` seconds instead.
+    * The first success after a failure sends a "Recovered" message.
+
+    A `digest_interval` of 0 sends every failure. """
+
+    depth = 0  # Messages waiting to be sent.
+
+    def __init__(self, digest_interval=3600):
+        self.digest_interval = digest_interval
+        self.alerts = {}
+        self.suppressed = 0
+
+    @property
+    def failing(self):
+        return len(self.alerts)
+
+    @asyncio.coroutine
+    def failure(self, task, title, message='', raw='', footer=None,
+                signature=None):
+        """ Alert on a failed execution of `task`.  Failures are the same if
+        they have the same `signature`, which defaults to the whole message.
+        """
+        if signature is None:
+            signature = title, message, raw
+        now = clock.time()
+        state = self.alerts.get(task)
+        if state is None:
+            state = self.alerts[task] = AlertState(now)
+        state.failures += 1
+        if signature != state.signature or not self.digest_interval:
+            state.signature = signature
+        elif now - state.reported >= self.digest_interval:
+            title = 'Still failing: `%s`' % task
+            message = 'Failed %d times since %s; %d alerts suppressed.' % (
+                state.failures, localtime(state.since), state.suppressed)
+        else:
+            state.suppressed += 1
+            self.suppressed += 1
+            return
+        state.reported = now
+        state.suppressed = 0
+        yield from self.error(title, message, raw, footer)
+
+    @asyncio.coroutine
+    def success(self, task, footer=None):
+        """ Note a successful execution of `task`.  Returns True if it ended
+        a failure streak, which is announced. """
+        state = self.alerts.pop(task, None)
+        if state is None:
+            return False
+        yield from self.info('Recovered: `%s`' % task,
+                             'After failing %d times since %s.' % (
+                             state.failures, localtime(state.since)),
+                             footer=footer)
+        return True
+
+    def forget(self, task):
+        """ Drop the alert state of a task that is gone. """
+        self.alerts.pop(task, None)
+
+
+class TokenBucket(object):
+    """ Allow `rate` operations per second on average, in bursts of up to
+    `burst`. """
+
+    def __init__(self, rate, burst, loop):
+        self.rate = rate
+        self.burst = burst
+        self.loop = loop
+        self.tokens = burst
+        self.stamp = loop.time()
+        self.waited = 0.0
+
+    def refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    @asyncio.coroutine
+    def take(self):
+        """ Wait for a token and use it. """
+        self.refill()
+        while self.tokens < 1:
+            delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            yield from asyncio.sleep(delay, loop=self.loop)
+            self.refill()
+        self.tokens -= 1
+
+
+class PrintNotifier(Notifier):
     """ A basic interface for sending notifications to stdout. """
 
     @asyncio.coroutine
     def setup(self, loop):
         pass
 
+    @asyncio.coroutine
+    def close(self):
+        pass
+
     @asyncio.coroutine
     def info(self, title, message='', raw='', footer=None):
         shellish.vtmlprint("<b><blue>INFO: %s</blue></b>" % title,
@@ -54,16 +176,43 @@ class PrintNotifier(object):
                                plain=cronredux.PLAIN_OUTPUT)
 
 
-class SlackNotifier(object):
-    """ Send messages to a slack webhook. """
+class SlackNotifier(Notifier):
+    """ Send messages to a slack webhook.
+
+    Messages are put on a bounded queue and a background sender posts them,
+    merging whatever is pending into one multi-attachment post.  Callers
+    never wait on the webhook.  Posts are paced to `rate` per second (with
+    bursts of `burst`) to stay under the webhook's rate limit, so messages
+    arriving in the meantime go out together.  When the queue is full the
+    oldest message is dropped; with the "summarize" overflow policy the
+    dropped messages are reported in a summary attachment on the next post.
+    """
 
     default_username = 'Cronredux'
     default_icon_emoji = ':calendar:'
     max_raw_size = 700
+    max_summary_titles = 10
+    overflow_policies = ('drop-oldest', 'summarize')
 
     def __init__(self, webhook_url, channel=None, username=None,
-                 icon_emoji=None):
+                 icon_emoji=None, max_queue=1000, max_batch=20,
+                 overflow='summarize', pool_size=4, rate=1, burst=5,
+                 digest_interval=3600):
+        if overflow not in self.overflow_policies:
+            raise ValueError('Invalid overflow policy: %s' % overflow)
+        if rate < 0:
+            raise ValueError('Invalid notify rate: %s' % rate)
+        if burst < 1:
+            raise ValueError('Invalid notify burst: %s' % burst)
+        super().__init__(digest_interval)
         self.webhook = webhook_url
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.overflow = overflow
+        self.pool_size = pool_size
+        self.rate = rate
+        self.burst = burst
+        self.bucket = None
         self.default_payload = p = {}
         if channel is not None:
             p['channel'] = channel
@@ -71,22 +220,107 @@ class SlackNotifier(object):
                         self.default_username
         p['icon_emoji'] = icon_emoji if icon_emoji is not None else \
                         self.default_icon_emoji
+        self.queue = collections.deque()
+        self.dropped = 0
+        self.dropped_titles = []
+        self.sent = 0
+
+    @property
+    def depth(self):
+        return len(self.queue)
 
     @asyncio.coroutine
     def setup(self, loop):
         self.loop = loop
         headers = {'content-type': 'application/json'}
-        self.session = aiohttp.ClientSession(loop=loop, headers=headers)
-        self.lock = asyncio.Lock()
+        connector = aiohttp.TCPConnector(loop=loop, limit=self.pool_size)
+        self.session = aiohttp.ClientSession(loop=loop, headers=headers,
+                                             connector=connector)
+        self.pending = asyncio.Event(loop=loop)
+        self.idle = asyncio.Event(loop=loop)
+        self.idle.set()
+        if self.rate:
+            self.bucket = TokenBucket(self.rate, self.burst, loop)
+        self.sender = loop.create_task(self.send_loop())
+
+    @asyncio.coroutine
+    def close(self, timeout=10):
+        """ Give the sender a chance to drain the queue and then shutdown. """
+        try:
+            yield from asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            shellish.vtmlprint('<red>Slack queue not drained: %d messages '
+                               'lost.</red>' % len(self.queue),
+                               plain=cronredux.PLAIN_OUTPUT)
+        self.sender.cancel()
+        yield from self.session.close()
+
+    def enqueue(self, attachment):
+        """ Add an attachment to the send queue without waiting. """
+        if len(self.queue) >= self.max_queue:
+            dropped = self.queue.popleft()
+            if self.overflow == 'summarize':
+                self.dropped += 1
+                if len(self.dropped_titles) < self.max_summary_titles:
+                    self.dropped_titles.append(dropped['fallback'])
+            else:
+                shellish.vtmlprint('<red>Slack queue full; dropped: %s</red>'
+                                   % dropped['fallback'],
+                                   plain=cronredux.PLAIN_OUTPUT)
+        self.queue.append(attachment)
+        self.idle.clear()
+        self.pending.set()
+
+    def next_batch(self):
+        """ Take up to `max_batch` queued attachments plus an overflow
+        summary if any messages were dropped. """
+        count = min(len(self.queue), self.max_batch)
+        batch = [self.queue.popleft() for _ in range(count)]
+        if self.dropped:
+            text = '\n'.join(self.dropped_titles)
+            if self.dropped > len(self.dropped_titles):
+                text += '\n...'
+            batch.append({
+                "color": '#888888',
+                "pretext": '*%d notifications dropped (queue full)*' %
+                           self.dropped,
+                "fallback": '%d notifications dropped' % self.dropped,
+                "text": text,
+                "ts": time.time(),
+                "mrkdwn_in": ['text', 'pretext']
+            })
+            self.dropped = 0
+            self.dropped_titles = []
+        return batch
+
+    @asyncio.coroutine
+    def send_loop(self):
+        """ Background sender; the only place that waits on the webhook. """
+        while True:
+            yield from self.pending.wait()
+            self.pending.clear()
+            while self.queue or self.dropped:
+                if self.bucket is not None:
+                    yield from self.bucket.take()
+                batch = self.next_batch()
+                try:
+                    yield from self.post({"attachments": batch})
+                except Exception as e:
+                    shellish.vtmlprint('<b><red>Slack Post Failed:</red> '
+                                       '%s</b>' % e,
+                                       plain=cronredux.PLAIN_OUTPUT)
+                else:
+                    self.sent += len(batch)
+            self.idle.set()
 
     @asyncio.coroutine
     def post(self, data):
         payload = self.default_payload.copy()
         payload.update(data)
-        with (yield from self.lock):
-            while True:
-                resp = yield from self.session.post(self.webhook,
-                                                    data=json.dumps(payload))
+        while True:
+            resp = yield from self.session.post(self.webhook,
+                                                data=json.dumps(payload))
+            try:
                 if resp.status != 200:
                     content = yield from resp.json()
                     if resp.status == 429:  # rate limited
@@ -101,8 +335,9 @@ class SlackNotifier(object):
                                            '(%d) - %s</b>' % (resp.status,
                                            content),
                                            plain=cronredux.PLAIN_OUTPUT)
+            finally:
                 yield from resp.release()
-                break
+            break
 
     @asyncio.coroutine
     def log(self, level, color, title, message=None, raw=None, footer=None):
@@ -128,7 +363,7 @@ class SlackNotifier(object):
             payload['text'] = '\n'.join(text)
         if footer:
             payload['footer'] = footer
-        yield from self.post({"attachments": [payload]})
+        self.enqueue(payload)
 
     @asyncio.coroutine
     def info(self, *args, **kwargs):
@@ -0,0 +1,134 @@
+"""
+Bounded capture of task output.
+"""
+
+import collections
+import os
+import sys
+import tempfile
+
+
+class OutputCapture(object):
+    """ Collect the output of a task execution without holding all of it in
+    memory.  The first `head_size` bytes and the last `tail_size` bytes are
+    kept and everything in between is dropped (but counted).  If `spill_dir`
+    is set the complete output is also written to a temp file there; if that
+    fails the file is dropped and capture carries on without it.  An
+    optional `on_line` callback is fed each decoded line as it arrives. """
+
+    encoding = 'utf-8'
+    clip_marker = '\n[... %d bytes clipped ...]\n'
+
+    def __init__(self, head_size=65536, tail_size=65536, spill_dir=None,
+                 on_line=None, max_line=65536):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.on_line = on_line
+        self.max_line = max_line
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tail_len = 0
+        self.size = 0
+        self.partial = b''
+        self.spill = None
+        self.spill_path = None
+        if spill_dir is not None:
+            try:
+                self.spill = tempfile.NamedTemporaryFile(dir=spill_dir,
+                                                         prefix='cronredux-',
+                                                         suffix='.log',
+                                                         delete=False)
+            except OSError as e:
+                self.spill_failed(e)
+            else:
+                self.spill_path = self.spill.name
+
+    def spill_failed(self, error):
+        """ Give up on the spill file, keeping only the head and tail. """
+        print('Output spill failed, keeping head and tail only: %s' % error,
+              file=sys.stderr)
+        if self.spill is not None:
+            try:
+                self.spill.close()
+            except OSError:
+                pass
+            try:
+                os.unlink(self.spill_path)
+            except OSError:
+                pass
+        self.spill = None
+        self.spill_path = None
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.spill is not None:
+            try:
+                self.spill.write(data)
+            except OSError as e:
+                self.spill_failed(e)
+        if self.on_line is not None:
+            self.feed_lines(data)
+        room = self.head_size - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data and self.tail_size > 0:
+            self.tail.append(data)
+            self.tail_len += len(data)
+            while self.tail_len - len(self.tail[0]) >= self.tail_size:
+                self.tail_len -= len(self.tail.popleft())
+
+    def feed_lines(self, data):
+        """ Split newly written data into lines for the `on_line` callback.
+        Lines longer than `max_line` are broken up. """
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) >= self.max_line:
+            lines.append(self.partial)
+            self.partial = b''
+        for x in lines:
+            self.on_line(x.decode(self.encoding, 'replace'))
+
+    @property
+    def clipped(self):
+        """ Number of bytes dropped between the head and tail. """
+        return self.size - len(self.head) - min(self.tail_len, self.tail_size)
+
+    def close(self):
+        """ Flush any partial line and close the spill file. """
+        if self.on_line is not None and self.partial:
+            self.on_line(self.partial.decode(self.encoding, 'replace'))
+            self.partial = b''
+        if self.spill is not None:
+            try:
+                self.spill.close()
+            except OSError as e:
+                self.spill_failed(e)
+
+    def getvalue(self):
+        """ Return the captured output as a string.  Clipped output has a
+        marker between the head and tail. """
+        tail = b''.join(self.tail)[-self.tail_size:] if self.tail else b''
+        head = self.head.decode(self.encoding, 'replace')
+        tail = tail.decode(self.encoding, 'replace')
+        clipped = self.clipped
+        if clipped:
+            return head + self.clip_marker % clipped + tail
+        return head + tail
+
+    def lines(self):
+        """ Generate every line of output.  When a spill file is available
+        the complete output is read back from it, otherwise the clipped
+        value is used. """
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            with open(self.spill_path, encoding=self.encoding,
+                      errors='replace') as f:
+                for x in f:
+                    yield x.rstrip('\n')
+        else:
+            yield from self.getvalue().splitlines()
+
+    def __iter__(self):
+        return self.lines()
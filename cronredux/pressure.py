@@ -0,0 +1,233 @@
+"""
+Adapt the concurrency limit to system pressure.
+
+Linux PSI (/proc/pressure/*) reports the share of time tasks were stalled
+waiting on CPU, memory or I/O.  Where it is not available the 1 minute load
+average per CPU stands in for CPU pressure, with its own target and a longer
+cooldown since it reacts much more slowly.  Swap-out activity from
+/proc/vmstat is watched too so the host is backed off before it starts
+thrashing.
+"""
+
+import collections
+import os
+import time
+
+PSI_RESOURCES = ('cpu', 'memory', 'io')
+
+
+def read_psi(resource, root='/proc/pressure'):
+    """ Parse a PSI file into {"some": {"avg10": ...}, "full": {...}}.
+    Returns None if the kernel does not provide it. """
+    try:
+        with open(os.path.join(root, resource)) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    psi = {}
+    for line in lines:
+        kind, *fields = line.split()
+        psi[kind] = dict((k, float(v)) for k, v in
+                         (x.split('=', 1) for x in fields))
+    return psi
+
+
+def read_swapout(path='/proc/vmstat'):
+    """ Pages swapped out since boot or None if unknown. """
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith('pswpout '):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Sample(object):
+    """ One reading of system pressure.  `cpu`, `memory` and `io` are PSI
+    "some" avg10 percentages, `memory_full` is the PSI "full" avg10 and
+    `swapout` is pages swapped out per second.  Without PSI the `source` is
+    "loadavg" and `cpu` is the 1 minute load average per CPU. """
+
+    __slots__ = ('source', 'cpu', 'memory', 'memory_full', 'io', 'swapout')
+
+    def __init__(self, source, cpu=0.0, memory=0.0, memory_full=0.0, io=0.0,
+                 swapout=0.0):
+        self.source = source
+        self.cpu = cpu
+        self.memory = memory
+        self.memory_full = memory_full
+        self.io = io
+        self.swapout = swapout
+
+    def as_dict(self):
+        return dict((x, getattr(self, x)) for x in self.__slots__)
+
+
+class Sampler(object):
+    """ Take `Sample` readings from PSI or, failing that, the load average.
+    """
+
+    def __init__(self, root='/proc/pressure', vmstat='/proc/vmstat'):
+        self.root = root
+        self.vmstat = vmstat
+        self.cpus = os.cpu_count() or 1
+        self.loadavg = os.getloadavg
+        self.last_swap = None
+
+    def swap_rate(self):
+        pages = read_swapout(self.vmstat)
+        now = time.monotonic()
+        last, self.last_swap = self.last_swap, (now, pages)
+        if pages is None or last is None or last[1] is None or \
+           now <= last[0]:
+            return 0.0
+        return max(pages - last[1], 0) / (now - last[0])
+
+    def sample(self):
+        psi = dict((x, read_psi(x, self.root)) for x in PSI_RESOURCES)
+        swapout = self.swap_rate()
+        if psi['cpu'] is None:
+            return Sample('loadavg', cpu=self.loadavg()[0] / self.cpus,
+                          swapout=swapout)
+        memory = psi['memory'] or {}
+        return Sample(
+            'psi',
+            cpu=psi['cpu']['some']['avg10'],
+            memory=memory.get('some', {}).get('avg10', 0.0),
+            memory_full=memory.get('full', {}).get('avg10', 0.0),
+            io=(psi['io'] or {}).get('some', {}).get('avg10', 0.0),
+            swapout=swapout)
+
+
+class AdaptiveConcurrency(object):
+    """ AIMD control of a `dispatch.DispatchQueue` limit between `minimum`
+    and `maximum`.  Every `interval` seconds the pressure is sampled:
+
+    * Swapping or memory "full" stalls above `memory_target` halve the limit.
+    * CPU or I/O pressure above `target` (or memory "some" pressure above
+      `memory_target`) cut it by a quarter.  For load average samples the
+      CPU load per CPU is held to `load_target` instead.
+    * Otherwise, if work is waiting on a full queue, the limit goes up by one.
+
+    After a decrease no further decrease is made for `cooldown` seconds so
+    the (10 second average) pressure can reflect it, or `load_cooldown`
+    seconds for the (1 minute) load average.  Recent decisions are
+    kept for the diag service and `on_change` is called with each one that
+    changes the limit. """
+
+    decrease_factor = 0.75
+    memory_factor = 0.5
+
+    def __init__(self, loop, minimum, maximum, interval=5, target=20,
+                 memory_target=1, cooldown=10, load_target=1.0,
+                 load_cooldown=60, sampler=None, history=50):
+        if not 1 <= minimum <= maximum:
+            raise ValueError('Invalid concurrency bounds: %d-%d' % (
+                             minimum, maximum))
+        self.loop = loop
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.target = target
+        self.memory_target = memory_target
+        self.cooldown = cooldown
+        self.load_target = load_target
+        self.load_cooldown = load_cooldown
+        self.sampler = sampler or Sampler()
+        self.decisions = collections.deque(maxlen=history)
+        self.adjustments = collections.Counter()
+        self.last = None
+        self.last_decrease = None
+        self.queue = None
+        self.on_change = None
+        self.timer = None
+
+    def attach(self, queue, on_change=None):
+        """ Take over the limit of `queue`, starting from the minimum. """
+        self.queue = queue
+        self.on_change = on_change
+        queue.limit = self.minimum
+
+    def start(self):
+        self.timer = self.loop.call_later(self.interval, self.tick)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def tick(self):
+        self.timer = self.loop.call_later(self.interval, self.tick)
+        self.adjust(self.sampler.sample())
+
+    def decide(self, sample, now):
+        """ Return the new limit and the reason for it. """
+        limit = self.queue.limit
+        if sample.source == 'loadavg':
+            cpu_target, cooldown = self.load_target, self.load_cooldown
+        else:
+            cpu_target, cooldown = self.target, self.cooldown
+        cooling = self.last_decrease is not None and \
+            now - self.last_decrease < cooldown
+        if sample.swapout > 0 or sample.memory_full > self.memory_target:
+            if cooling:
+                return limit, 'memory pressure (cooling down)'
+            return int(limit * self.memory_factor), 'memory pressure'
+        over = [x for x, value, target in (
+            ('cpu', sample.cpu, cpu_target),
+            ('io', sample.io, self.target),
+            ('memory', sample.memory, self.memory_target)) if value > target]
+        if over:
+            reason = '%s pressure' % '/'.join(over)
+            if cooling:
+                return limit, reason + ' (cooling down)'
+            return int(limit * self.decrease_factor), reason
+        if len(self.queue) and self.queue.running >= limit:
+            return limit + 1, 'backlog'
+        return limit, 'steady'
+
+    def adjust(self, sample, now=None):
+        """ Apply one step of the control loop for `sample`. """
+        if now is None:
+            now = time.monotonic()
+        self.last = sample
+        old = self.queue.limit
+        new, reason = self.decide(sample, now)
+        new = min(max(new, self.minimum), self.maximum)
+        if new < old:
+            self.last_decrease = now
+            self.adjustments['down'] += 1
+        elif new > old:
+            self.adjustments['up'] += 1
+        else:
+            return old
+        self.queue.limit = new
+        decision = {
+            "time": time.time(),
+            "old": old,
+            "new": new,
+            "reason": reason,
+            "sample": sample.as_dict()
+        }
+        self.decisions.appendleft(decision)
+        if new > old:
+            self.queue.dispatch()
+        if self.on_change is not None:
+            self.on_change(decision)
+        return new
+
+    def stats(self):
+        queue = self.queue
+        return {
+            "limit": queue.limit if queue is not None else None,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "target": self.target,
+            "memory_target": self.memory_target,
+            "load_target": self.load_target,
+            "sample": self.last and self.last.as_dict(),
+            "adjustments": dict(self.adjustments),
+            "decisions": list(self.decisions)
+        }
@@ -0,0 +1,110 @@
+"""
+Child process reaping with resource accounting.
+"""
+
+import asyncio
+import collections
+import os
+
+
+class ResourceUsage(object):
+    """ CPU, memory and I/O usage of one or more process executions.  Adding
+    two instances sums the counters and keeps the larger max RSS. """
+
+    __slots__ = ('utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw',
+                 'nivcsw')
+
+    def __init__(self, utime=0.0, stime=0.0, maxrss=0, inblock=0, oublock=0,
+                 nvcsw=0, nivcsw=0):
+        self.utime = utime
+        self.stime = stime
+        self.maxrss = maxrss
+        self.inblock = inblock
+        self.oublock = oublock
+        self.nvcsw = nvcsw
+        self.nivcsw = nivcsw
+
+    @classmethod
+    def from_rusage(cls, ru):
+        return cls(utime=ru.ru_utime, stime=ru.ru_stime, maxrss=ru.ru_maxrss,
+                   inblock=ru.ru_inblock, oublock=ru.ru_oublock,
+                   nvcsw=ru.ru_nvcsw, nivcsw=ru.ru_nivcsw)
+
+    def __repr__(self):
+        return '<ResourceUsage cpu=%.3fs maxrss=%d>' % (self.cpu,
+                                                        self.maxrss)
+
+    def __add__(self, other):
+        if not isinstance(other, ResourceUsage):
+            return NotImplemented
+        return ResourceUsage(utime=self.utime + other.utime,
+                             stime=self.stime + other.stime,
+                             maxrss=max(self.maxrss, other.maxrss),
+                             inblock=self.inblock + other.inblock,
+                             oublock=self.oublock + other.oublock,
+                             nvcsw=self.nvcsw + other.nvcsw,
+                             nivcsw=self.nivcsw + other.nivcsw)
+
+    @property
+    def cpu(self):
+        """ Total (user + system) CPU seconds. """
+        return self.utime + self.stime
+
+    def as_dict(self):
+        return dict((x, getattr(self, x)) for x in self.__slots__)
+
+
+def exitcode(status):
+    """ Convert a wait status to a subprocess style returncode. """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    elif os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    else:
+        return status
+
+
+class RusageChildWatcher(asyncio.SafeChildWatcher):
+    """ A child watcher that reaps children with `os.wait4` so the resource
+    usage of each one is available after it exits.  Usage is held until it is
+    collected with `pop_rusage` (a bounded number are kept for children that
+    never get collected). """
+
+    max_unclaimed = 1024
+
+    def __init__(self):
+        super().__init__()
+        self.rusage = collections.OrderedDict()
+
+    def pop_rusage(self, pid):
+        return self.rusage.pop(pid, None)
+
+    def _do_waitpid(self, expected_pid):
+        assert expected_pid > 0
+        try:
+            pid, status, ru = os.wait4(expected_pid, os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped elsewhere; same handling as SafeChildWatcher.
+            pid = expected_pid
+            returncode = 255
+        else:
+            if pid == 0:
+                return  # still running
+            returncode = exitcode(status)
+            self.rusage[pid] = ResourceUsage.from_rusage(ru)
+            while len(self.rusage) > self.max_unclaimed:
+                self.rusage.popitem(last=False)
+        try:
+            callback, args = self._callbacks.pop(pid)
+        except KeyError:
+            pass
+        else:
+            callback(pid, returncode, *args)
+
+
+def pop_rusage(pid):
+    """ Return the `ResourceUsage` of an exited child if the active child
+    watcher records it, otherwise None. """
+    watcher = asyncio.get_child_watcher()
+    if isinstance(watcher, RusageChildWatcher):
+        return watcher.pop_rusage(pid)
@@ -5,166 +5,845 @@ Handle task monitoring and scheduling.
 import asyncio
 import collections
 import functools
+import heapq
 import itertools
+import os
 import pendulum
+import re
 import shellish
+import shlex
+import shutil
+import signal
 import subprocess
 import textwrap
+import time
 import traceback
+from cronredux import clock, cronparser, cronspec, dispatch, events, history, \
+    limits, logsink, metrics, output, procwatch, watchdog, workers
+from cronredux.history import ExecState
 
+# Anything the shell would expand, redirect or chain.  Quotes and backslash
+# escapes are fine; `shlex` splits those the way /bin/sh would.
+shell_syntax = re.compile(r'[|&;<>()$`*?\[\]{}~!#\n]|^\s*\w+=')
+shell_words = frozenset((
+    '.', ':', 'alias', 'break', 'case', 'cd', 'command', 'continue', 'eval',
+    'exec', 'exit', 'export', 'for', 'function', 'if', 'read', 'return', 'set',
+    'shift', 'source', 'time', 'trap', 'ulimit', 'umask', 'unset', 'until',
+    'wait', 'while'))
 
-class TaskExecContext(object):
+
+def flag(value):
+    """ Convert a yes/no style option value to a bool. """
+    if isinstance(value, bool):
+        return value
+    value = value.lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    elif value in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError(value)
+
+
+def exec_argv(cmd, force=False):
+    """ Tokenize `cmd` for running without a shell.  Returns None if the
+    command needs one; i.e. it uses shell syntax or builtins, or the program
+    can't be found on the PATH.  With `force` shell syntax is not checked for
+    and is passed through as literal arguments. """
+    if not force and shell_syntax.search(cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not argv or argv[0] in shell_words:
+        return None
+    path = shutil.which(argv[0])
+    if path is None:
+        return None
+    argv[0] = path
+    return argv
+
+
+class TaskExecContext(history.ExecView):
     """ A data structure representing a task execution.  Status and info about
     an invocation is kept here and these instances are used to track activity.
-    """
+    An execution ends in the "finish" state or, if it was killed for running
+    past its deadline, the "timeout" state.
+
+    Times are kept as raw monotonic clock readings plus the wall clock offset
+    taken at creation; see `history.ExecView` for the display forms. """
+
+    __slots__ = ('ident', 'task', 'loop', 'state', 'clock', 'due', 'groups',
+                 'queued_at', 'started_at', 'finished_at', 'returncode',
+                 'output',
+                 'output_size', 'output_file', 'rusage', 'cgroup', 'alarm',
+                 'timeout_alarm', 'timed_out', 'process', 'reader')
 
     def __init__(self, task, loop):
-        self.started = None
-        self.finished = None
-        self.returncode = None
-        self.output = ''
-        self.state = 'init'
         self.ident = next(task.context_identer)
         self.task = task
         self.loop = loop
+        self.state = ExecState.init
+        self.clock = clock.time() - clock.monotonic()
+        self.due = None  # Scheduled fire time (epoch)
+        self.groups = ()  # Concurrency groups held while dispatched
+        self.queued_at = None
+        self.started_at = None
+        self.finished_at = None
+        self.returncode = None
+        self.output = ''
+        self.output_size = 0
+        self.output_file = None
+        self.rusage = None
+        self.cgroup = None  # Stats of the execution's cgroup, if it had one
+        self.alarm = None
+        self.timeout_alarm = None
+        self.timed_out = False
+        self.process = None
+        self.reader = None
 
     def __str__(self):
         return '<TaskExecContext %d [%s]> for %s' % (self.ident, self.state,
                                                      self.task)
 
+    def set_queued(self):
+        assert self.state == ExecState.init
+        self.queued_at = clock.monotonic()
+        self.state = ExecState.queued
+
     def set_start(self):
-        assert self.state == 'init'
-        self.started = pendulum.now()
-        self.state = 'start'
+        assert self.state in (ExecState.init, ExecState.queued)
+        self.started_at = clock.monotonic()
+        self.state = ExecState.start
 
     def set_finish(self, returncode, output):
-        assert self.state == 'start'
-        self.finished = pendulum.now()
-        self.state = 'finish'
+        assert self.state == ExecState.start
+        self.finished_at = clock.monotonic()
+        if self.timed_out:
+            self.state = ExecState.timeout
+        else:
+            self.state = ExecState.finish
         self.output = output
         self.returncode = returncode
 
+    def walltime(self, mono):
+        return None if mono is None else self.clock + mono
+
     @property
-    def elapsed(self):
-        """ Increments for active tasks and when finished gives the total
-        execution time. """
-        if self.started is None:
-            return pendulum.Interval()
-        if self.finished is None:
-            return pendulum.now() - self.started
-        else:
-            return self.finished - self.started
+    def queued_ts(self):
+        return self.walltime(self.queued_at)
+
+    @property
+    def started_ts(self):
+        return self.walltime(self.started_at)
+
+    @property
+    def finished_ts(self):
+        return self.walltime(self.finished_at)
+
+    @property
+    def elapsed_seconds(self):
+        if self.started_at is None:
+            return 0
+        end = self.finished_at
+        return (clock.monotonic() if end is None else end) - self.started_at
+
+    @property
+    def wait_seconds(self):
+        if self.queued_at is None:
+            return 0
+        end = self.started_at
+        return (clock.monotonic() if end is None else end) - self.queued_at
 
     def is_error(self):
-        if self.state != 'finish':
+        if not self.state.done:
             raise TypeError('Task is still running')
-        return not not self.returncode
+        return self.timed_out or not not self.returncode
 
     def is_done(self):
-        return self.state == 'finished'
+        return self.state.done
+
+    def kill(self, sig):
+        """ Signal the process group of a running execution. """
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def discard_output(self):
+        """ Remove the spilled output file, if any. """
+        if self.output_file is not None:
+            try:
+                os.unlink(self.output_file)
+            except FileNotFoundError:
+                pass
+            self.output_file = None
 
     @asyncio.coroutine
-    def run_task(self):
-        self.set_start()
-        process, output = yield from self.task(self.loop)
-        self.set_finish(process.returncode, output.decode())
+    def run_task(self, capture, pool=None, cgroups=None):
+        """ Run the (started) task feeding its output into an
+        `output.OutputCapture`.  Only the (clipped) captured value is kept on
+        the context. """
+        self.output_file = capture.spill_path
+        try:
+            returncode, self.rusage = yield from self.task(self, capture,
+                                                           pool, cgroups)
+        finally:
+            capture.close()
+            self.output_file = capture.spill_path  # None if spilling failed.
+            self.process = self.reader = None
+        self.output_size = capture.size
+        self.set_finish(returncode, capture.getvalue())
+        if self.timed_out:
+            self.task.timeout_count += 1
 
 
 class Task(object):
     """ Encapsulate a repeated task. """
 
+    __slots__ = ('ident', 'context_identer', 'crontab', 'cmd', 'options',
+                 'limit', 'priority', 'groups', 'schedule', 'active',
+                 'run_count', 'timeout_count', 'run_time', 'rusage', 'argv',
+                 'call', 'limits')
+
     identer = itertools.count()
+    read_size = 65536
+    option_types = {
+        "group": str,
+        "limit": int,
+        "priority": int,
+        "slow_warning": float,
+        "backlog_warning": float,
+        "timeout": float,
+        "exec": flag,
+        "nice": limits.parse_nice,
+        "ionice": limits.parse_ionice,
+        "rlimit_as": limits.parse_size,
+        "rlimit_cpu": int,
+        "rlimit_nofile": int,
+        "cpu_max": limits.parse_cpu_max,
+        "memory_max": limits.parse_size,
+    }
 
-    def __init__(self, crontab, cmd):
+    def __init__(self, crontab, cmd, options=None):
         self.ident = next(self.identer)
         self.context_identer = itertools.count()
         self.crontab = crontab
         self.cmd = cmd
-        self.last_eta = crontab.next(default_utc=False)
+        if isinstance(cmd, cronparser.PythonCall):
+            self.call = cmd
+        else:
+            self.call = None
+        self.set_options(self.parse_options(options or {}))
+        self.schedule = None
+        self.active = 0
         self.run_count = 0
-        self.elapsed = pendulum.Interval()
+        self.timeout_count = 0
+        self.run_time = 0.0
+        self.rusage = procwatch.ResourceUsage()
+
+    @classmethod
+    def parse_options(cls, options):
+        """ Validate and convert the options from a crontab entry.  Only
+        flags may be given as a bare key (which comes as True). """
+        parsed = {}
+        for key, value in options.items():
+            convert = cls.option_types.get(key)
+            if convert is None:
+                raise ValueError('Invalid task option: %s' % key)
+            try:
+                if value is True and convert is not flag:
+                    raise ValueError(value)
+                parsed[key] = convert(value)
+            except ValueError:
+                raise ValueError('Invalid value for task option %s: %s' % (
+                                 key, '(none)' if value is True else value))
+        return parsed
+
+    def set_options(self, options):
+        """ Apply (parsed) options. """
+        self.options = options
+        self.limit = options.get('limit')
+        self.priority = options.get('priority', 0)
+        self.groups = self.parse_groups(options.get('group', ''))
+        self.limits = limits.ResourceLimits.from_options(options)
+        mode = options.get('exec')
+        if self.call is not None or mode is False:
+            self.argv = None
+        else:
+            self.argv = exec_argv(self.cmd, force=mode)
+
+    @staticmethod
+    def parse_groups(value):
+        """ Parse a group option like "db:2,io" into a dict of group names
+        and their (optional) limits. """
+        groups = {}
+        for x in value.split(','):
+            if not x:
+                continue
+            name, sep, limit = x.partition(':')
+            groups[name] = int(limit) if sep else None
+        return groups
 
     def __str__(self):
         dots = shellish.beststr("…", '...')
         cmd = textwrap.shorten(self.cmd, width=40, placeholder=dots)
         return '<Task %d: cmd="%s">' % (self.ident, cmd)
 
+    @property
+    def elapsed(self):
+        """ Total run time of every execution. """
+        return pendulum.Interval(seconds=self.run_time)
+
+    @property
+    def key(self):
+        """ Identifies the crontab entry across restarts, unlike `ident`. """
+        return '%s %s' % (self.crontab.canonical(), self.cmd)
+
     def next_run(self):
         """ Estimated time of next run. """
-        return pendulum.Interval(seconds=self.crontab.next(default_utc=False))
+        now = clock.time()
+        if self.schedule is not None and self.schedule.eta is not None:
+            eta = self.schedule.eta
+        else:
+            eta = self.crontab.next(now)
+        if eta is None:
+            return None
+        return pendulum.Interval(seconds=max(eta - now, 0))
 
     @asyncio.coroutine
-    def __call__(self, loop):
-        start = pendulum.now()
-        ps = yield from asyncio.create_subprocess_shell(
-            self.cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            loop=loop)
-        output = (yield from ps.communicate())[0]
-        self.elapsed += pendulum.now() - start
+    def __call__(self, context, capture, pool=None, cgroups=None):
+        """ Run the task, streaming its combined stdout/stderr into `capture`
+        as it is produced.  Python calls run on `pool`, a
+        `workers.WorkerPool`; commands with CPU or memory caps run in a cgroup
+        from `cgroups`, a `limits.CgroupManager`.  Returns the returncode and
+        resource usage (None if it was not recorded). """
+        start = clock.monotonic()
+        if self.call is not None:
+            returncode, rusage = yield from pool.run(self.call, context,
+                                                     capture)
+        else:
+            returncode, rusage = yield from self.spawn(context, capture,
+                                                       cgroups)
+        self.run_time += clock.monotonic() - start
         self.run_count += 1
-        return ps, output
+        if rusage is not None:
+            self.rusage += rusage
+        return returncode, rusage
+
+    @asyncio.coroutine
+    def spawn(self, context, capture, cgroups=None):
+        """ Run the command in its own process group with the task's resource
+        limits.  Simple commands are exec'd directly with the argv prepared
+        at load time; the rest go through /bin/sh. """
+        cgroup = None
+        if self.limits is not None and self.limits.cgroup and \
+           cgroups is not None:
+            cgroup = cgroups.create('cronredux-%d-%d-%d' % (
+                os.getpid(), self.ident, context.ident), self.limits)
+        output, stdout = os.pipe()
+        try:
+            ps = None
+            if self.limits is not None:
+                ps = yield from self.spawn_gated(context, cgroup, stdout)
+            elif self.argv is not None:
+                try:
+                    ps = yield from asyncio.create_subprocess_exec(
+                        *self.argv,
+                        stdout=stdout,
+                        stderr=subprocess.STDOUT,
+                        start_new_session=True,
+                        loop=context.loop)
+                except OSError:
+                    pass  # Program went missing; let the shell report it.
+            if ps is None:
+                ps = yield from asyncio.create_subprocess_shell(
+                    self.cmd,
+                    stdout=stdout,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                    loop=context.loop)
+        except BaseException:
+            os.close(output)
+            if cgroup is not None:
+                context.cgroup = cgroups.finish(cgroup)
+            raise
+        finally:
+            os.close(stdout)
+        try:
+            context.process = ps
+            context.reader = context.loop.create_task(self.read_output(
+                open(output, 'rb', buffering=0), capture, context.loop))
+            # The pipe is ours rather than the Process's so that waiting on
+            # the exit does not also wait for grandchildren holding it open.
+            yield from ps.wait()
+            try:
+                yield from context.reader
+            except asyncio.CancelledError:
+                pass  # Killed; a stray grandchild may still hold the pipe.
+        finally:
+            if cgroup is not None:
+                context.cgroup = cgroups.finish(cgroup)
+        return ps.returncode, procwatch.pop_rusage(ps.pid)
+
+    @asyncio.coroutine
+    def spawn_gated(self, context, cgroup, stdout):
+        """ Start the command held at `limits.GATE` and release it once its
+        limits are applied.  A preexec_fn would apply them in the child,
+        but that is not safe in a process with threads. """
+        argv = self.argv or ('/bin/sh', '-c', self.cmd)
+        gate, release = os.pipe()
+        try:
+            ps = yield from asyncio.create_subprocess_exec(
+                *(limits.GATE + tuple(argv)),
+                stdin=gate,
+                stdout=stdout,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+                loop=context.loop)
+        except BaseException:
+            os.close(release)
+            raise
+        finally:
+            os.close(gate)
+        try:
+            self.limits.apply(ps.pid, cgroup)
+        finally:
+            os.write(release, b'\n')
+            os.close(release)
+        return ps
+
+    @asyncio.coroutine
+    def read_output(self, pipe, capture, loop):
+        """ Copy `pipe` into `capture` until EOF, closing it when done or
+        cancelled. """
+        stream = asyncio.StreamReader(loop=loop)
+        try:
+            transport, _ = yield from loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(stream, loop=loop), pipe)
+        except BaseException:
+            pipe.close()
+            raise
+        try:
+            while True:
+                data = yield from stream.read(self.read_size)
+                if not data:
+                    break
+                capture.write(data)
+        finally:
+            transport.close()
+
+
+class ConcurrencyGroup(object):
+    """ A named limit on concurrent executions shared by a set of tasks. """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+
+    def __str__(self):
+        return '<ConcurrencyGroup %s: %d/%d>' % (self.name, self.active,
+                                                 self.limit)
 
-    def ready(self):
-        """ Returns true when this task should be run.  If this function is not
-        called as or more frequently than the cron period then it will skip or
-        even never return true.  It is advised to call this at least double the
-        minimum cron period of 1 minute, e.g. 30 seconds. """
-        next_eta = self.crontab.next(default_utc=False)
-        r = self.last_eta < next_eta  # rollover occurred == ready
-        self.last_eta = next_eta
-        return r
+
+class Schedule(object):
+    """ The set of tasks sharing one (interned) cron spec.  The spec is only
+    evaluated once per fire time and all of its tasks are released together.
+    """
+
+    identer = itertools.count()
+
+    def __init__(self, crontab):
+        self.ident = next(self.identer)
+        self.crontab = crontab
+        self.tasks = []
+        self.eta = None
+
+    def reschedule(self, now):
+        """ Compute and return the absolute time (epoch seconds) of the first
+        run strictly after `now`.  None is returned if it never runs. """
+        self.eta = self.crontab.next(now)
+        return self.eta
 
 
 class Scheduler(object):
-    """ Manage execution and scheduling of tasks. """
+    """ Manage execution and scheduling of tasks.  `version` is bumped on
+    every change of scheduling or execution state so readers can tell when
+    what they last saw is stale. """
+
+    max_sleep = 60
 
-    def __init__(self, tasks, args, notifier, loop):
+    def __init__(self, tasks, args, notifier, loop, store=None, pool=None,
+                 adaptive=None, sinks=None, cgroups=None, cluster=None):
         self.tasks = tasks
         self.args = args
         self.notifier = notifier
         self.loop = loop
-        self.workers_sem = asyncio.Semaphore(self.args.max_concurrency)
+        self.queue = dispatch.DispatchQueue(self.args.max_concurrency,
+                                            self.start_task)
+        self.watchdog = watchdog.Watchdog(loop)
         self.wakeup = asyncio.Event(loop=loop)
-        self.active = []
-        self.history = collections.deque(maxlen=100)
+        self.active = collections.OrderedDict()
+        if store is None:
+            store = history.MemoryHistory()
+        self.history = store
+        self.tasks_by_id = dict((x.ident, x) for x in tasks)
+        store.attach(self.tasks_by_id)
+        if pool is None:
+            pool = workers.WorkerPool(loop)
+        self.workers = pool
+        self.adaptive = adaptive
+        if sinks is None:
+            sinks = [logsink.LogSink(logsink.StreamWriter(), loop)]
+        self.log_sinks = sinks
+        self.cgroups = cgroups
+        if adaptive is not None:
+            adaptive.attach(self.queue, self.on_concurrency_change)
+        self.cluster = cluster
+        if cluster is not None:
+            cluster.set_tasks(tasks)
+            cluster.on_change = self.on_cluster_change
+            cluster.on_drop = self.on_cluster_drop
+        self.version = 0
+        self.events = events.EventBus(loop)
+        self.deadlines = []
+        self.schedules = {}
+        self.groups = {}
+        for task in tasks:
+            self.add_schedule(task)
+        self.setup_groups()
+        self.setup_metrics()
+
+    def setup_groups(self):
+        """ Create the concurrency groups referenced by tasks.  Limits given
+        on the command line take precedence over those in the crontab and a
+        group with no limit anywhere is bounded by --max-concurrency. """
+        limits = {}
+        for task in self.tasks:
+            for name, limit in task.groups.items():
+                if limit is not None:
+                    limits[name] = limit
+                else:
+                    limits.setdefault(name, None)
+        for x in self.args.concurrency_group or ():
+            name, limit = x.split('=', 1)
+            limits[name] = int(limit)
+        for name, limit in limits.items():
+            if limit is None:
+                limit = self.args.max_concurrency
+            group = self.groups.get(name)
+            if group is None:
+                self.groups[name] = ConcurrencyGroup(name, limit)
+            else:
+                group.limit = limit
+
+    def setup_metrics(self):
+        """ Instruments updated as tasks run plus gauges read at scrape
+        time. """
+        self.metrics = m = metrics.Registry()
+        task_labels = ('task', 'cmd')
+        self.executions_total = m.counter(
+            'executions_total', 'Finished task executions by outcome.',
+            task_labels + ('outcome',))
+        self.skipped_total = m.counter(
+            'skipped_total', 'Task runs skipped because the task was still '
+            'active.', task_labels)
+        self.duration_seconds = m.histogram(
+            'execution_duration_seconds', 'Task execution run time.',
+            task_labels)
+        self.lag_seconds = m.histogram(
+            'schedule_lag_seconds', 'Time from the scheduled fire time to '
+            'the start of an execution.')
+        self.loop_lag = metrics.LoopLagMonitor(self.loop, m.histogram(
+            'event_loop_lag_seconds', 'Delay of a periodic event loop timer.',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)))
+        m.gauge('event_loop_lag_last_seconds', 'Most recent event loop lag.',
+                lambda: self.loop_lag.lag)
+        m.gauge('running', 'Running task executions.',
+                lambda: self.queue.running)
+        m.gauge('queued', 'Task executions waiting for a free slot.',
+                lambda: len(self.queue))
+        m.gauge('oldest_queued_seconds', 'Wait of the oldest queued task '
+                'execution.', lambda: self.queue.oldest_wait)
+        m.gauge('concurrency_limit', 'Max concurrent task executions.',
+                lambda: self.queue.limit)
+        m.gauge('concurrency_saturation', 'Fraction of the concurrency limit '
+                'in use.', lambda: self.queue.running / self.queue.limit
+                if self.queue.limit else 1)
+        self.concurrency_adjustments_total = m.counter(
+            'concurrency_adjustments_total', 'Changes of the concurrency '
+            'limit by the adaptive controller.', ('direction',))
+        m.gauge('pressure', 'System pressure (PSI some avg10 percent, or '
+                'the load average per CPU for cpu without PSI) seen by the '
+                'adaptive concurrency controller.',
+                self.pressure_samples, labels=('resource',))
+        m.gauge('group_running', 'Running task executions by concurrency '
+                'group.', lambda: (((x.name,), x.active)
+                                   for x in self.groups.values()),
+                labels=('group',))
+        m.gauge('group_limit', 'Concurrency group limits.',
+                lambda: (((x.name,), x.limit) for x in self.groups.values()),
+                labels=('group',))
+        m.gauge('workers', 'Python worker processes.',
+                lambda: self.workers.count)
+        m.gauge('workers_busy', 'Python worker processes running a call.',
+                lambda: len(self.workers.busy))
+        m.gauge('log_pending', 'Task output entries waiting to be written '
+                'by each log sink.', lambda: (((x.name,), x.stats()['pending'])
+                                              for x in self.log_sinks),
+                labels=('sink',))
+        m.gauge('log_dropped', 'Task output entries dropped by each log '
+                'sink because it fell behind.',
+                lambda: (((x.name,), x.dropped) for x in self.log_sinks),
+                labels=('sink',))
+        m.gauge('notification_queue_depth', 'Notifications waiting to be '
+                'sent.', lambda: self.notifier.depth)
+        m.gauge('failing_tasks', 'Tasks whose last execution failed.',
+                lambda: self.notifier.failing)
+        m.gauge('alerts_suppressed', 'Repeated failure alerts folded into '
+                'a digest.', lambda: self.notifier.suppressed)
+        if self.cluster is not None:
+            cluster = self.cluster
+            m.gauge('cluster_nodes', 'Live nodes in the cluster.',
+                    lambda: len(cluster.ring.nodes))
+            m.gauge('cluster_owned_tasks', 'Tasks owned by this node.',
+                    lambda: sum(1 for x in self.tasks
+                                if cluster.owner(x) == cluster.node))
+            m.gauge('cluster_claims', 'Run slots claimed by outcome.',
+                    lambda: [(('won',), cluster.claimed),
+                             (('lost',), cluster.lost),
+                             (('failover',), cluster.failovers)],
+                    labels=('outcome',))
+
+    def call_modules(self):
+        """ Modules the Python tasks need, for preloading in workers. """
+        return set(x.call.module for x in self.tasks if x.call is not None)
+
+    def pressure_samples(self):
+        sample = self.adaptive and self.adaptive.last
+        if sample is None:
+            return ()
+        return [((x,), getattr(sample, x)) for x in ('cpu', 'memory', 'io')]
+
+    @staticmethod
+    def task_labels(task):
+        return str(task.ident), task.cmd
+
+    def add_schedule(self, task):
+        """ Attach the task to the schedule for its cron spec.  Returns the
+        schedule if it is new. """
+        schedule = self.schedules.get(task.crontab)
+        created = schedule is None
+        if created:
+            schedule = self.schedules[task.crontab] = Schedule(task.crontab)
+        schedule.tasks.append(task)
+        task.schedule = schedule
+        return schedule if created else None
+
+    def remove_schedule(self, task):
+        """ Detach the task from its schedule, dropping the schedule once it
+        has no tasks.  A dropped schedule's deadline is ignored when it comes
+        up. """
+        schedule = task.schedule
+        schedule.tasks.remove(task)
+        task.schedule = None
+        if not schedule.tasks:
+            del self.schedules[schedule.crontab]
+
+    def update_tasks(self, entries):
+        """ Switch to a new set of crontab entries, given as (spec, command,
+        options) tuples.  Entries are matched to the current tasks by spec
+        and command; matched tasks keep their identity, stats and schedule
+        (their options are updated) so only added and removed entries cost
+        anything.  Executions already queued or running are left alone.
+        Every entry is validated first so an invalid one raises ValueError
+        without changing anything.  Returns the added and removed tasks. """
+        parsed = [(cronspec.intern(spec, command), command, options,
+                   Task.parse_options(options))
+                  for spec, command, options in entries]
+        current = collections.defaultdict(collections.deque)
+        for task in self.tasks:
+            current[task.crontab, task.cmd].append(task)
+        tasks = []
+        added = []
+        for crontab, command, raw, options in parsed:
+            matches = current.get((crontab, command))
+            if matches:
+                task = matches.popleft()
+                if options != task.options:  # Skip a needless PATH lookup.
+                    task.set_options(options)
+            else:
+                task = Task(crontab, command, raw)
+                added.append(task)
+            tasks.append(task)
+        removed = [x for matches in current.values() for x in matches]
+        for task in removed:
+            self.remove_schedule(task)
+            del self.tasks_by_id[task.ident]
+            self.notifier.forget(task)
+        now = clock.time()
+        for task in added:
+            self.tasks_by_id[task.ident] = task
+            schedule = self.add_schedule(task)
+            if schedule is not None:
+                self.schedule(schedule, now)
+        self.tasks[:] = tasks
+        if self.cluster is not None:
+            self.cluster.set_tasks(tasks)
+        self.setup_groups()
+        modules = self.call_modules()
+        if modules:
+            self.workers.start(modules)
+        self.version += 1
+        self.wakeup.set()
+        return added, removed
+
+    def schedule(self, schedule, now):
+        """ Put the schedule in the deadline heap keyed on its next run time.
+        """
+        eta = schedule.reschedule(now)
+        if eta is not None:
+            heapq.heappush(self.deadlines, (eta, schedule.ident, schedule))
+
+    def load_histogram(self, hours=24, now=None):
+        """ Preview of task starts by minute of the hour over the next
+        `hours` hours.  Returns 60 (peak, mean) pairs; the most starts in
+        any one minute and the average per hour. """
+        if now is None:
+            now = clock.time()
+        starts = collections.Counter()
+        for fires in cronspec.batch_window([x.crontab for x in self.tasks],
+                                           now, now + hours * 3600):
+            starts.update(fires)
+        peak = [0] * 60
+        total = [0] * 60
+        for ts, count in starts.items():
+            minute = time.localtime(ts).tm_min
+            peak[minute] = max(peak[minute], count)
+            total[minute] += count
+        return [(x, y / hours) for x, y in zip(peak, total)]
 
     def is_active(self, task):
-        """ Scan task exec list looking for this task. """
-        for x in self.active:
-            if x.task is task:
-                return True
-        return False
+        return task.active > 0
+
+    def task_limit(self, task):
+        """ Max outstanding (queued or running) executions allowed for a
+        task, or None if it is unbounded. """
+        if task.limit is not None:
+            return task.limit
+        return None if self.args.allow_overlap else 1
+
+    def task_groups(self, task):
+        return [self.groups[x] for x in task.groups]
 
     @asyncio.coroutine
     def run(self):
-        """ Babysit the task scheduling process. """
+        """ Babysit the task scheduling process.  Schedules are kept in a
+        heap ordered by their next run time so we only ever look at the ones
+        that are due and otherwise sleep until the earliest deadline. """
+        now = clock.time()
+        for schedule in self.schedules.values():
+            if schedule.eta is None:  # Else queued by an earlier reload.
+                self.schedule(schedule, now)
+        self.loop_lag.start()
+        if self.adaptive is not None:
+            self.adaptive.start()
+        if self.cluster is not None:
+            yield from self.cluster.start()
+        modules = self.call_modules()
+        if modules:
+            self.workers.start(modules)
         while True:
-            for task in self.tasks:
-                if task.ready():
-                    if not self.args.allow_overlap and self.is_active(task):
-                        yield from self.notifier.warning('Skipping `%s`' %
-                                                         task,
-                                                         'Previous task is '
-                                                         'still active.')
+            now = clock.time()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                due, _, schedule = heapq.heappop(self.deadlines)
+                if self.schedules.get(schedule.crontab) is not schedule:
+                    continue  # Dropped by a crontab reload.
+                # Reschedule from now rather than the missed deadline so a
+                # late wakeup runs the tasks once instead of replaying a burst.
+                self.schedule(schedule, now)
+                self.version += 1
+                for task in schedule.tasks:
+                    if self.cluster is not None:
+                        self.cluster.submit(task, due, self.fire)
                     else:
-                        yield from self.workers_sem.acquire()
-                        yield from self.enqueue_task(task)
+                        yield from self.fire(task, due)
+            if self.deadlines:
+                # Cap the sleep so wall clock adjustments are noticed.
+                timeout = min(self.deadlines[0][0] - clock.time(),
+                              self.max_sleep)
+            else:
+                timeout = self.max_sleep
             try:
-                yield from asyncio.wait_for(self.wakeup.wait(), 1)
+                yield from asyncio.wait_for(self.wakeup.wait(),
+                                            max(timeout, 0))
             except asyncio.TimeoutError:
                 pass
             else:
                 self.wakeup.clear()
 
     @asyncio.coroutine
-    def enqueue_task(self, task):
-        """ Create (and return) the task status and run the task in the
-        background. """
+    def fire(self, task, due):
+        """ Start the run of a task due at `due` unless it would overlap
+        more active executions than the task allows. """
+        limit = self.task_limit(task)
+        if limit is not None and task.active >= limit:
+            self.skipped_total.inc(self.task_labels(task))
+            self.events.publish('skip', {
+                "task": task.ident,
+                "cmd": task.cmd,
+                "label": str(task)
+            })
+            yield from self.notifier.warning('Skipping `%s`' % task,
+                                             'Previous task is still '
+                                             'active.')
+        else:
+            yield from self.enqueue_task(task, due)
+
+    @asyncio.coroutine
+    def enqueue_task(self, task, due=None):
+        """ Create (and return) the task status and put it on the dispatch
+        queue to be run in the background once a slot is free. """
         context = TaskExecContext(task, self.loop)
-        self.active.append(context)
-        self.history.appendleft(context)
+        context.due = due
+        task.active += 1
+        self.history.add(context)
+        self.version += 1
+        context.set_queued()
+        self.publish(context)
+        threshold = task.options.get('backlog_warning',
+                                     self.args.backlog_warning)
+        if threshold:
+            context.alarm = self.watchdog.add(threshold, self.on_backlog,
+                                              context)
+        context.groups = self.task_groups(task)
+        self.queue.put(context, task.priority, context.groups)
+        return context
+
+    def start_task(self, context):
+        """ Called by the dispatch queue when a slot is free for this
+        execution. """
+        if context.alarm is not None:
+            context.alarm.cancel()
+        threshold = context.task.options.get('slow_warning',
+                                             self.args.slow_exec_warning)
+        if threshold:
+            context.alarm = self.watchdog.add(threshold, self.on_slow,
+                                              context)
+        timeout = context.task.options.get('timeout', self.args.timeout)
+        if timeout:
+            context.timeout_alarm = self.watchdog.add(timeout,
+                                                      self.on_timeout,
+                                                      context)
+        context.set_start()
+        self.active[context] = None
+        self.version += 1
+        self.publish(context)
+        if context.due is not None:
+            self.lag_seconds.observe(max(clock.time() - context.due, 0))
         f = self.loop.create_task(self.task_runner(context))
         f.add_done_callback(functools.partial(self.on_task_done, context))
 
@@ -174,18 +853,131 @@ class Scheduler(object):
         if self.args.notify_exec:
             yield from self.notifier.info('Starting: `%s`' % context.task,
                                           footer='Exec #%d' % context.ident)
-        yield from context.run_task()
+        if self.args.stream_output:
+            on_line = functools.partial(self.log_line, context)
+        else:
+            on_line = None
+        capture = output.OutputCapture(head_size=self.args.output_head,
+                                       tail_size=self.args.output_tail,
+                                       spill_dir=self.args.output_spill_dir,
+                                       on_line=on_line)
+        yield from context.run_task(capture, self.workers, self.cgroups)
         footer = 'Exec #%d - Duration %s' % (context.ident,
                                              context.elapsed)
-        if context.returncode:
-            yield from self.notifier.error('Failed: `%s`' % context.task,
-                                           raw=context.output, footer=footer)
-        elif self.args.notify_exec:
-            yield from self.notifier.info('Succeeded: `%s`' % context.task,
-                                          raw=context.output, footer=footer)
-        for x in context.output.splitlines():
-            print('[%s] [job:%d] [exit:%d] %s' % (context.task.cmd,
-                  context.ident, context.returncode, x))
+        # Output often has timestamps in it, so repeats of a failure are
+        # recognized by how it failed.
+        if context.timed_out:
+            yield from self.notifier.failure(
+                context.task, 'Timed out: `%s`' % context.task,
+                raw=context.output, footer=footer, signature='timeout')
+        elif context.returncode:
+            yield from self.notifier.failure(
+                context.task, 'Failed: `%s`' % context.task,
+                raw=context.output, footer=footer,
+                signature=context.returncode)
+        else:
+            recovered = yield from self.notifier.success(context.task,
+                                                         footer=footer)
+            if self.args.notify_exec and not recovered:
+                yield from self.notifier.info('Succeeded: `%s`' %
+                                              context.task,
+                                              raw=context.output,
+                                              footer=footer)
+        if not self.args.stream_output:
+            self.log_lines(context, capture)
+
+    def log_lines(self, context, lines):
+        """ Queue lines of task output on every log sink.  `lines` is
+        iterated later by each sink's writer thread (a finished
+        `OutputCapture` reads back its spill file there).  The exit code is
+        unknown while output is being streamed. """
+        task = context.task
+        meta = logsink.LogMeta(clock.time(), task.ident, task.cmd,
+                               context.ident, context.returncode)
+        for sink in self.log_sinks:
+            sink.emit(meta, lines)
+
+    def log_line(self, context, line):
+        self.log_lines(context, (line,))
+
+    def on_concurrency_change(self, decision):
+        """ The adaptive controller moved the concurrency limit. """
+        self.version += 1
+        direction = 'up' if decision['new'] > decision['old'] else 'down'
+        self.concurrency_adjustments_total.inc((direction,))
+        if self.events.subscribers:
+            self.events.publish('concurrency', decision)
+        if self.args.verbose:
+            print('Concurrency limit %(old)d -> %(new)d: %(reason)s' %
+                  decision)
+
+    def on_cluster_change(self, old, new):
+        """ Nodes joined or left the cluster, moving task ownership. """
+        self.version += 1
+        if self.events.subscribers:
+            self.events.publish('cluster', {"old": list(old),
+                                            "nodes": list(new)})
+        if self.args.verbose:
+            shellish.vtmlprint('<b>Cluster nodes:</b> %s' % ', '.join(new))
+
+    @asyncio.coroutine
+    def on_cluster_drop(self, task, due, error):
+        """ A run was not made because its slot couldn't be claimed.
+        Alerts go through the failure digest so an outage of the lease
+        backend doesn't send one for every run. """
+        yield from self.notifier.failure(
+            task, 'Dropped run: `%s`' % task, 'The run due at %s could not '
+            'be claimed from the cluster: %s' % (
+                time.strftime('%H:%M', time.localtime(due)), error),
+            signature='unclaimed')
+
+    def publish(self, context):
+        """ Send a live event named after the execution's new state. """
+        if self.events.subscribers:
+            info = context.as_dict()
+            info['label'] = str(context)
+            info['snippet'] = context.output[:20]
+            self.events.publish(context.state.name, info)
+
+    def on_backlog(self, context):
+        """ Watchdog alarm for an execution stuck in the dispatch queue. """
+        context.alarm = None
+        self.loop.create_task(self.notifier.warning(
+            'Backlogged: `%s`' % context.task,
+            'Waiting to run for %s; %d executions queued.' % (
+            context.wait, len(self.queue)),
+            footer='Exec #%d' % context.ident))
+
+    def on_slow(self, context):
+        """ Watchdog alarm for an execution running longer than expected. """
+        context.alarm = None
+        self.loop.create_task(self.notifier.warning(
+            'Slow: `%s`' % context.task,
+            'Still running after %s.' % context.elapsed,
+            footer='Exec #%d' % context.ident))
+
+    def on_timeout(self, context):
+        """ Watchdog alarm for an execution past its timeout.  The process
+        group is asked to terminate and then killed if it is still around
+        after the grace period. """
+        if context.process is None:  # Not spawned yet; check back shortly.
+            context.timeout_alarm = self.watchdog.add(1, self.on_timeout,
+                                                      context)
+            return
+        context.timed_out = True
+        context.kill(signal.SIGTERM)
+        context.timeout_alarm = self.watchdog.add(self.args.kill_grace,
+                                                  self.on_kill, context)
+        self.loop.create_task(self.notifier.warning(
+            'Timeout: `%s`' % context.task,
+            'Terminated after %s.' % context.elapsed,
+            footer='Exec #%d' % context.ident))
+
+    def on_kill(self, context):
+        context.timeout_alarm = None
+        context.kill(signal.SIGKILL)
+        if context.reader is not None:
+            context.reader.cancel()
 
     def on_task_done(self, context, f):
         try:
@@ -194,6 +986,24 @@ class Scheduler(object):
             traceback.print_exc()
             raise SystemExit("Unrecoverable Error: %s" % e)
         finally:
-            self.active.remove(context)
-            self.workers_sem.release()
+            for alarm in (context.alarm, context.timeout_alarm):
+                if alarm is not None:
+                    alarm.cancel()
+            context.alarm = context.timeout_alarm = None
+            if context.is_done():
+                self.history.record(context)
+                labels = self.task_labels(context.task)
+                if context.timed_out:
+                    outcome = 'timeout'
+                elif context.returncode:
+                    outcome = 'failure'
+                else:
+                    outcome = 'success'
+                self.executions_total.inc(labels + (outcome,))
+                self.duration_seconds.observe(context.elapsed_seconds, labels)
+                self.publish(context)
+            self.version += 1
+            del self.active[context]
+            context.task.active -= 1
+            self.queue.release(context.groups)
             self.wakeup.set()
@@ -0,0 +1,287 @@
+"""
+Replay a crontab on a virtual clock.
+
+The real `Scheduler` runs on an event loop whose clock only moves when there
+is nothing left to do, jumping straight to the next timer.  Tasks don't run;
+each one sleeps for an estimate of how long it takes.  A day of schedule
+replays in seconds and the report shows whether the crontab fits its
+concurrency limits: peak concurrency, queueing delay, skipped overlaps and
+the load on each minute of the hour.
+"""
+
+import argparse
+import asyncio
+import collections
+import selectors
+import time
+from cronredux import clock, cronspec, notification, scheduler
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """ Poll without blocking and advance `clock` by however long the loop
+    wanted to sleep instead.  While `busy()` is true (work is running on
+    other threads) it waits for real, as time can't skip ahead of it. """
+
+    def __init__(self, clock, busy=lambda: False):
+        super().__init__()
+        self.clock = clock
+        self.busy = busy
+
+    def select(self, timeout=None):
+        if self.busy():
+            return super().select(timeout)
+        ready = super().select(0)
+        if not ready and timeout:
+            self.clock.advance(timeout)
+        return ready
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """ An event loop timed by a `clock.VirtualClock`. """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.executor_calls = 0
+        super().__init__(VirtualSelector(clock, lambda: self.executor_calls))
+
+    def time(self):
+        return self.clock.monotonic()
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.executor_calls += 1
+        future.add_done_callback(self.executor_done)
+        return future
+
+    def executor_done(self, future):
+        self.executor_calls -= 1
+
+
+class SimTask(scheduler.Task):
+    """ A task that takes `duration` seconds to do nothing.  A `timeout`
+    cuts it short like the watchdog would. """
+
+    __slots__ = ('duration', 'timeout')
+
+    def __init__(self, crontab, cmd, options=None, duration=1):
+        super().__init__(crontab, cmd, options)
+        self.call = None
+        self.duration = duration
+        self.timeout = self.options.get('timeout', 0)
+
+    @asyncio.coroutine
+    def spawn(self, context, capture, cgroups=None):
+        duration = self.duration
+        if self.timeout and duration > self.timeout:
+            duration = self.timeout
+            context.timed_out = True
+        yield from asyncio.sleep(duration, loop=context.loop)
+        return 0, None
+
+
+class CountingNotifier(notification.Notifier):
+    """ Count notifications by the first word of their title instead of
+    sending them. """
+
+    def __init__(self):
+        super().__init__()
+        self.counts = collections.Counter()
+
+    @asyncio.coroutine
+    def setup(self, loop):
+        pass
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+    @asyncio.coroutine
+    def info(self, title, message='', raw='', footer=None):
+        self.counts[title.split(None, 1)[0].rstrip(':')] += 1
+
+    warning = error = info
+
+
+class Simulator(scheduler.Scheduler):
+    """ A `Scheduler` that keeps statistics on what it dispatches.  Load is
+    sampled as executions start, so the peak of a minute is the most that
+    were running when one of its executions started. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = []
+        self.peak = 0
+        self.peak_time = None
+        self.minutes = collections.defaultdict(lambda: [0, 0])
+
+    def start_task(self, context):
+        super().start_task(context)
+        now = clock.time()
+        running = self.queue.running
+        self.waits.append(context.wait_seconds)
+        if running > self.peak:
+            self.peak = running
+            self.peak_time = now
+        load = self.minutes[int(now // 60)]
+        load[0] += 1
+        load[1] = max(load[1], running)
+
+    def report(self, start, end, drained):
+        """ Summarize the executions dispatched between `start` and `end`.
+        `drained` is when the last one finished. """
+        hours = max(end - start, 60) / 3600
+        limit = self.args.max_concurrency
+        waits = sorted(self.waits)
+        delayed = [x for x in waits if x > 0]
+        outcomes = collections.Counter()
+        for labels, count in self.executions_total.values.items():
+            outcomes[labels[-1]] += count
+        skipped = sorted(((count, labels) for labels, count in
+                          self.skipped_total.values.items()), reverse=True)
+        by_minute = [[0, 0] for i in range(60)]
+        for minute, (starts, peak) in self.minutes.items():
+            load = by_minute[time.localtime(minute * 60).tm_min]
+            load[0] += starts
+            load[1] = max(load[1], peak)
+        return {
+            "start": start,
+            "end": end,
+            "drained": drained,
+            "limit": limit,
+            "tasks": len(self.tasks),
+            "executions": len(waits),
+            "timeouts": outcomes['timeout'],
+            "peak_concurrency": self.peak,
+            "peak_time": self.peak_time,
+            "saturated_minutes": sum(1 for _, peak in self.minutes.values()
+                                     if peak >= limit),
+            "wait": {
+                "delayed": len(delayed),
+                "mean": sum(waits) / len(waits) if waits else 0,
+                "p95": percentile(waits, 95),
+                "max": waits[-1] if waits else 0
+            },
+            "skipped": sum(x[0] for x in skipped),
+            "skipped_tasks": [{
+                "task": int(labels[0]),
+                "cmd": labels[1],
+                "skipped": count
+            } for count, labels in skipped],
+            "notifications": dict(self.notifier.counts),
+            "minutes": [{
+                "minute": i,
+                "starts": starts / hours,
+                "peak": peak
+            } for i, (starts, peak) in enumerate(by_minute)]
+        }
+
+
+defaults = {
+    "max_concurrency": 10,
+    "concurrency_group": None,
+    "allow_overlap": False,
+    "backlog_warning": 60,
+    "slow_exec_warning": 0,
+    "timeout": 0,
+    "kill_grace": 10,
+    "notify_exec": False,
+    "stream_output": False,
+    "output_head": 0,
+    "output_tail": 0,
+    "output_spill_dir": None,
+    "verbose": False
+}
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of sorted `values`. """
+    if not values:
+        return 0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def build_tasks(entries, durations, default_duration=1):
+    """ Make a `SimTask` for each crontab entry, taking its duration from
+    the `durations` dict of command to seconds when it is there. """
+    return [SimTask(cronspec.intern(spec, command), command, options,
+                    durations.get(command, default_duration))
+            for spec, command, options in entries]
+
+
+def simulate(tasks, args, start, seconds):
+    """ Run the scheduler over `seconds` of schedule from `start` (epoch
+    seconds) and return its report.  `args` holds scheduler settings such as
+    `max_concurrency`; those missing take the values in `defaults`.
+    Executions still queued or running at the end are allowed to finish. """
+    settings = dict(defaults)
+    settings.update(vars(args))
+    for task in tasks:
+        if 'timeout' not in task.options:
+            task.timeout = settings['timeout']
+    settings['timeout'] = 0  # Tasks time themselves out.
+    # Start a second early so a run due at `start` is included and one due
+    # at the end is not.
+    virtual = clock.VirtualClock(start - 1)
+    loop = VirtualEventLoop(virtual)
+    previous = clock.use(virtual)
+    try:
+        sched = Simulator(tasks, argparse.Namespace(**settings),
+                          CountingNotifier(), loop, sinks=[])
+        runner = loop.create_task(sched.run())
+        loop.call_soon(sched.loop_lag.stop)
+        loop.run_until_complete(asyncio.sleep(seconds, loop=loop))
+        runner.cancel()
+        loop.run_until_complete(asyncio.wait([runner], loop=loop))
+        while sched.active or len(sched.queue):
+            sched.wakeup.clear()
+            loop.run_until_complete(sched.wakeup.wait())
+        # The clock runs a second behind the window; work done by its end
+        # drained at the end rather than a second before it.
+        end = start + seconds
+        return sched.report(start, end, max(clock.time(), end))
+    finally:
+        clock.use(previous)
+        loop.close()
+
+
+def localtime(ts):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))
+
+
+def render(report, top=10):
+    """ Format a report for the terminal with the `top` busiest minutes of
+    the hour. """
+    wait = report['wait']
+    lines = [
+        'Simulated %s to %s: %d tasks, %d executions' % (
+            localtime(report['start']), localtime(report['end']),
+            report['tasks'], report['executions']),
+        '',
+        'Concurrency limit:   %d' % report['limit'],
+        'Peak concurrency:    %d%s' % (report['peak_concurrency'], (
+            ' at %s' % localtime(report['peak_time'])
+            if report['peak_time'] is not None else '')),
+        'Minutes at limit:    %d' % report['saturated_minutes'],
+        'Queueing delay:      %d delayed, mean %.1fs, p95 %.1fs, max %.1fs' %
+        (wait['delayed'], wait['mean'], wait['p95'], wait['max']),
+        'Skipped overlaps:    %d' % report['skipped'],
+        'Timeouts:            %d' % report['timeouts'],
+        'Backlog warnings:    %d' % report['notifications'].get(
+            'Backlogged', 0),
+        'Drained after end:   %.0fs' % (report['drained'] - report['end'])
+    ]
+    for x in report['skipped_tasks'][:top]:
+        lines.append('    %6d  %s' % (x['skipped'], x['cmd']))
+    busiest = sorted(report['minutes'], key=lambda x: (x['peak'],
+                                                       x['starts']),
+                     reverse=True)[:top]
+    busiest = [x for x in busiest if x['starts']]
+    if busiest:
+        width = max(x['peak'] for x in busiest)
+        lines.extend(['', 'Busiest minutes of the hour:',
+                      '    minute  starts/hour  peak'])
+        for x in busiest:
+            bar = '#' * int(round(x['peak'] / width * 30)) if width else ''
+            lines.append('    :%02d     %11.1f  %4d  %s' % (
+                x['minute'], x['starts'], x['peak'], bar))
+    return '\n'.join(lines)
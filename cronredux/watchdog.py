@@ -0,0 +1,75 @@
+"""
+Deadline alarms for task executions.
+"""
+
+import heapq
+import itertools
+
+
+class Alarm(object):
+    """ Handle for a pending watchdog deadline. """
+
+    __slots__ = ('when', 'callback', 'args')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.callback = None
+        self.args = None
+
+    @property
+    def cancelled(self):
+        return self.callback is None
+
+
+class Watchdog(object):
+    """ Run callbacks when deadlines pass.  Every deadline lives in a single
+    heap served by one loop timer armed for the earliest entry, so any number
+    of watched executions cost nothing until a deadline is reached.
+    Cancelled alarms are dropped when they reach the top of the heap. """
+
+    resolution = 0.001  # loop timers may run up to this early
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.heap = []
+        self.seq = itertools.count()
+        self.timer = None
+        self.timer_when = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, delay, callback, *args):
+        """ Call `callback(*args)` after `delay` seconds unless the returned
+        alarm is cancelled first. """
+        alarm = Alarm(self.loop.time() + delay, callback, args)
+        heapq.heappush(self.heap, (alarm.when, next(self.seq), alarm))
+        if self.timer_when is None or alarm.when < self.timer_when:
+            self.arm()
+        return alarm
+
+    def arm(self):
+        """ Point the loop timer at the earliest live deadline. """
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = self.timer_when = None
+        if self.heap:
+            self.timer_when = self.heap[0][0]
+            self.timer = self.loop.call_at(self.timer_when, self.fire)
+
+    def fire(self):
+        self.timer = self.timer_when = None
+        now = self.loop.time() + self.resolution
+        while self.heap and self.heap[0][0] <= now:
+            alarm = heapq.heappop(self.heap)[2]
+            if not alarm.cancelled:
+                callback, args = alarm.callback, alarm.args
+                alarm.cancel()
+                callback(*args)
+        self.arm()
@@ -0,0 +1,315 @@
+"""
+Pre-forked worker processes for running Python callables.
+
+A "py:module:function" task skips interpreter startup and imports by running
+in one of a pool of long-lived workers.  Each worker runs one call at a time
+with its stdout and stderr (at the file descriptor level, so subprocesses and
+C extensions are captured too) redirected into a pipe that is relayed back to
+the scheduler as it is produced.
+
+The worker side of this module runs with `python -m cronredux.workers
+[modules to preload...]`.  Requests are JSON lines on stdin and replies are
+frames on stdout; a one byte type and a length followed by the payload.  An
+"o" frame is output and an "r" frame is the (JSON) result ending a call.
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import threading
+import traceback
+from cronredux import procwatch
+
+FRAME_HEADER = struct.Struct('!cI')
+
+
+class Worker(object):
+    """ Scheduler side handle of a worker process. """
+
+    def __init__(self, process, generation):
+        self.process = process
+        self.generation = generation
+        self.runs = 0
+        self.maxrss = 0
+        self.retire = False
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    @asyncio.coroutine
+    def read_frame(self):
+        header = yield from self.process.stdout.readexactly(FRAME_HEADER.size)
+        kind, size = FRAME_HEADER.unpack(header)
+        return kind, (yield from self.process.stdout.readexactly(size))
+
+    @asyncio.coroutine
+    def call(self, call, capture):
+        """ Run a `cronparser.PythonCall` feeding its output into `capture`.
+        Returns the result dict sent by the worker. """
+        request = {
+            "module": call.module,
+            "function": call.function,
+            "args": call.args
+        }
+        self.process.stdin.write(json.dumps(request).encode() + b'\n')
+        while True:
+            kind, payload = yield from self.read_frame()
+            if kind == b'o':
+                capture.write(payload)
+            elif kind == b'r':
+                result = json.loads(payload.decode())
+                self.runs += 1
+                self.maxrss = result['rusage']['maxrss']
+                self.retire = result['retire']
+                return result
+            else:
+                raise ValueError('Invalid worker frame: %r' % kind)
+
+    @asyncio.coroutine
+    def stop(self):
+        """ Ask the worker to exit by closing its stdin. """
+        if self.alive:
+            self.process.stdin.close()
+        yield from self.process.wait()
+        procwatch.pop_rusage(self.pid)
+
+
+class WorkerPool(object):
+    """ Up to `size` worker processes shared by every Python task.  Workers
+    are started ahead of time (see `start`) with the modules of the current
+    tasks imported, and are replaced after `max_runs` calls or once their
+    peak RSS passes `max_rss` bytes (0 for no limit).  Calls wait for a free
+    worker when all of them are busy. """
+
+    python = sys.executable
+
+    def __init__(self, loop, size=2, max_runs=100, max_rss=0):
+        self.loop = loop
+        self.size = size
+        self.max_runs = max_runs
+        self.max_rss = max_rss
+        self.preload = ()
+        self.generation = 0
+        self.count = 0
+        self.idle = asyncio.Queue(loop=loop)
+        self.busy = set()
+        self.recycled = 0
+        self.closed = False
+
+    def start(self, modules=()):
+        """ Fork the pool with `modules` imported in every worker.  Calling
+        it again replaces the workers (idle ones now and busy ones when their
+        call is done) so they pick up fresh code. """
+        self.preload = tuple(sorted(modules))
+        self.generation += 1
+        while not self.idle.empty():
+            worker = self.idle.get_nowait()
+            if worker is not None:
+                self.retire(worker)
+        while self.count < self.size:
+            self.count += 1
+            self.loop.create_task(self.spawn())
+
+    @asyncio.coroutine
+    def spawn(self):
+        """ Start a worker and add it to the idle queue.  The caller has
+        already counted it.  If it fails a None is queued instead, waking a
+        caller of `acquire` to retry the spawn (and see the error) rather
+        than wait for a worker that isn't coming. """
+        try:
+            process = yield from asyncio.create_subprocess_exec(
+                self.python, '-m', __name__, *self.preload,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                start_new_session=True,
+                loop=self.loop)
+        except Exception:
+            self.count -= 1
+            self.idle.put_nowait(None)
+            raise
+        self.idle.put_nowait(Worker(process, self.generation))
+
+    def retire(self, worker):
+        self.count -= 1
+        self.recycled += 1
+        self.loop.create_task(worker.stop())
+        if not self.closed and self.count < self.size:
+            self.count += 1
+            self.loop.create_task(self.spawn())
+
+    @asyncio.coroutine
+    def acquire(self):
+        while True:
+            if self.idle.empty() and self.count < self.size:
+                self.count += 1
+                yield from self.spawn()
+            worker = yield from self.idle.get()
+            if worker is None:
+                continue  # A spawn failed.
+            if worker.alive and worker.generation == self.generation:
+                self.busy.add(worker)
+                return worker
+            self.retire(worker)
+
+    def release(self, worker):
+        self.busy.discard(worker)
+        if not worker.alive or worker.retire or \
+           worker.generation != self.generation or \
+           worker.runs >= self.max_runs or \
+           (self.max_rss and worker.maxrss * 1024 > self.max_rss):
+            self.retire(worker)
+        else:
+            self.idle.put_nowait(worker)
+
+    @asyncio.coroutine
+    def run(self, call, context, capture):
+        """ Run `call` for a `TaskExecContext` on a free worker.  The worker
+        is the context's process while it runs, so timeouts signal it (and
+        anything it started) like any other task.  Returns the returncode and
+        resource usage. """
+        worker = yield from self.acquire()
+        context.process = worker.process
+        context.reader = self.loop.create_task(worker.call(call, capture))
+        try:
+            result = yield from context.reader
+        except (asyncio.CancelledError, asyncio.IncompleteReadError):
+            # Killed or crashed; the worker is gone with whatever it was doing.
+            yield from worker.process.wait()
+            return worker.process.returncode, None
+        finally:
+            self.release(worker)
+        return result['returncode'], \
+            procwatch.ResourceUsage(**result['rusage'])
+
+    @asyncio.coroutine
+    def close(self):
+        self.closed = True
+        workers = list(self.busy)
+        while not self.idle.empty():
+            workers.append(self.idle.get_nowait())
+        workers = [x for x in workers if x is not None]
+        for x in self.busy:
+            x.process.kill()
+        for x in workers:
+            yield from x.stop()
+
+
+send_lock = threading.Lock()
+
+
+def send(fd, kind, payload):
+    data = FRAME_HEADER.pack(kind, len(payload)) + payload
+    with send_lock:
+        while data:
+            data = data[os.write(fd, data):]
+
+
+def pump(src, dst):
+    """ Relay output from the call's pipe as "o" frames until EOF. """
+    while True:
+        data = os.read(src, 65536)
+        if not data:
+            break
+        send(dst, b'o', data)
+    os.close(src)
+
+
+def exit_status(code):
+    """ Convert a return value or `SystemExit.code` the way `sys.exit`
+    would. """
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def usage_delta(before, after):
+    return {
+        "utime": after.ru_utime - before.ru_utime,
+        "stime": after.ru_stime - before.ru_stime,
+        "maxrss": after.ru_maxrss,
+        "inblock": after.ru_inblock - before.ru_inblock,
+        "oublock": after.ru_oublock - before.ru_oublock,
+        "nvcsw": after.ru_nvcsw - before.ru_nvcsw,
+        "nivcsw": after.ru_nivcsw - before.ru_nivcsw
+    }
+
+
+def invoke(request):
+    """ Import and call the target of a request.  Positional args are passed
+    to it and also set as `sys.argv[1:]`. """
+    target = '%s:%s' % (request['module'], request['function'])
+    sys.argv = [target] + request['args']
+    try:
+        fn = importlib.import_module(request['module'])
+        for x in request['function'].split('.'):
+            fn = getattr(fn, x)
+        return exit_status(fn(*request['args']))
+    except SystemExit as e:
+        return exit_status(e.code)
+    except BaseException:
+        traceback.print_exc()
+        return 1
+
+
+def execute(request, control, devnull, stderr):
+    """ Run one request with fds 1 and 2 feeding a pump thread.  Returns the
+    returncode and whether the worker must exit because something the call
+    started is still holding its output pipe open. """
+    r, w = os.pipe()
+    pumper = threading.Thread(target=pump, args=(r, control), daemon=True)
+    pumper.start()
+    os.dup2(w, 1)
+    os.dup2(w, 2)
+    os.close(w)
+    try:
+        returncode = invoke(request)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(devnull, 1)
+        os.dup2(stderr, 2)
+    pumper.join(1)
+    return returncode, pumper.is_alive()
+
+
+def serve(preload):
+    """ Worker main loop.  The control channel takes over stdout so stray
+    writes between calls can't corrupt it. """
+    control = os.dup(1)
+    stderr = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            traceback.print_exc()
+    for line in sys.stdin.buffer:
+        request = json.loads(line.decode())
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        returncode, tainted = execute(request, control, devnull, stderr)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        send(control, b'r', json.dumps({
+            "returncode": returncode,
+            "rusage": usage_delta(before, after),
+            "retire": tainted
+        }).encode())
+        if tainted:
+            break
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1:])
@@ -28,6 +28,9 @@ setup(
     packages=find_packages(),
     test_suite='test',
     install_requires=requirements,
+    extras_require={
+        'bench': ['crontab==0.22.1'],
+    },
     entry_points={
         'console_scripts': ['cronredux=cronredux.main:main'],
     },
@@ -0,0 +1,115 @@
+"""
+Diag JSON API tests.
+"""
+
+import argparse
+import asyncio
+import socket
+import types
+import unittest
+import aiohttp
+from aiohttp import web
+from cronredux import cronspec, notification, scheduler
+from cronredux.diag import api
+
+
+class JSONAPITests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        spec = cronspec.intern('* * * * *')
+        self.tasks = [scheduler.Task(spec, 'true'),
+                      scheduler.Task(spec, 'false', {"limit": '2'})]
+        args = argparse.Namespace(max_concurrency=1, concurrency_group=None,
+                                  allow_overlap=False, backlog_warning=0)
+        self.sched = scheduler.Scheduler(self.tasks, args,
+                                         notification.PrintNotifier(),
+                                         self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_api(self, test):
+        @asyncio.coroutine
+        def runner():
+            app = web.Application()
+            api.JSONAPI(self.sched).add_routes(app.router)
+            app_runner = web.AppRunner(app)
+            yield from app_runner.setup()
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:%d/api/v1' % sock.getsockname()[1]
+            yield from web.SockSite(app_runner, sock).start()
+            session = aiohttp.ClientSession()
+            try:
+                yield from test(session, url)
+            finally:
+                yield from session.close()
+                yield from app_runner.cleanup()
+        self.loop.run_until_complete(runner())
+
+    def test_tasks(self):
+        @asyncio.coroutine
+        def test(session, url):
+            resp = yield from session.get(url + '/tasks')
+            data = yield from resp.json()
+            self.assertEqual([x['cmd'] for x in data], ['true', 'false'])
+            resp = yield from session.get(url + '/tasks/%d' %
+                                          self.tasks[1].ident)
+            data = yield from resp.json()
+            self.assertEqual(data['options'], {"limit": 2})
+            resp = yield from session.get(url + '/tasks/999999')
+            self.assertEqual(resp.status, 404)
+        self.run_api(test)
+
+    def test_etag(self):
+        @asyncio.coroutine
+        def test(session, url):
+            resp = yield from session.get(url + '/tasks')
+            etag = resp.headers['ETag']
+            yield from resp.read()
+            resp = yield from session.get(url + '/tasks', headers={
+                "If-None-Match": etag})
+            self.assertEqual(resp.status, 304)
+            yield from self.sched.enqueue_task(self.tasks[0])
+            resp = yield from session.get(url + '/tasks', headers={
+                "If-None-Match": etag})
+            self.assertEqual(resp.status, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            data = yield from resp.json()
+            self.assertEqual(data[0]['active'], 1)
+            for path in ('/load', '/concurrency', '/cluster'):
+                resp = yield from session.get(url + path)
+                self.assertEqual(resp.status, 200)
+                self.assertNotIn('ETag', resp.headers)
+                yield from resp.read()
+        self.sched.start_task = lambda context: None
+        self.sched.queue.start = self.sched.start_task
+        self.run_api(test)
+
+    def test_etag_restart(self):
+        """ A restarted service doesn't reuse the ETags of the last one even
+        though its version counter starts over. """
+        request = types.SimpleNamespace(path_qs='/api/v1/tasks')
+        self.assertNotEqual(api.JSONAPI(self.sched).etag(request),
+                            api.JSONAPI(self.sched).etag(request))
+
+    def test_execs_and_active(self):
+        @asyncio.coroutine
+        def test(session, url):
+            for i in range(3):
+                yield from self.sched.enqueue_task(self.tasks[1])
+            resp = yield from session.get(url + '/execs', params={
+                "task": self.tasks[1].ident, "limit": 2})
+            data = yield from resp.json()
+            self.assertEqual([x['id'] for x in data['execs']], [2, 1])
+            resp = yield from session.get(url + '/active')
+            data = yield from resp.json()
+            self.assertEqual(len(data['queued']), 3)
+            self.assertEqual(data['queued'][0]['state'], 'queued')
+            resp = yield from session.get(url + '/execs', params={
+                "limit": 'x'})
+            self.assertEqual(resp.status, 400)
+        self.sched.queue.limit = 0
+        self.run_api(test)
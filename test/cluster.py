@@ -0,0 +1,266 @@
+"""
+Cluster sharding and lease tests.
+"""
+
+import asyncio
+import collections
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from cronredux import clock, cluster, cronspec, scheduler, simulate
+
+
+class HashRingTests(unittest.TestCase):
+
+    keys = ['task %d' % i for i in range(3000)]
+
+    def test_balance(self):
+        ring = cluster.HashRing(['a', 'b', 'c'])
+        counts = collections.Counter(ring.owner(x) for x in self.keys)
+        self.assertEqual(set(counts), {'a', 'b', 'c'})
+        for count in counts.values():
+            self.assertGreater(count, 600)
+        self.assertIsNone(cluster.HashRing().owner('x'))
+
+    def test_spelling(self):
+        """ Nodes agree on task keys however the schedule is spelled. """
+        keys = []
+        for spec in ('@hourly', '0 * * * *'):
+            node = cluster.Cluster('a', None, None)
+            task = scheduler.Task(cronspec.CronSpec(spec), 'job')
+            node.set_tasks([task])
+            keys.append(node.keys[task])
+        self.assertEqual(keys[0], keys[1])
+
+    def test_node_loss(self):
+        """ Only the keys of the departed node change owner. """
+        before = cluster.HashRing(['a', 'b', 'c'])
+        after = cluster.HashRing(['a', 'c'])
+        for key in self.keys:
+            if before.owner(key) != 'b':
+                self.assertEqual(after.owner(key), before.owner(key))
+
+
+class LeaseTests(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.clock = clock.VirtualClock(1000000)
+        self.previous = clock.use(self.clock)
+        self.loop = asyncio.new_event_loop()
+        self.backend = self.make_backend()
+
+    def tearDown(self):
+        self.wait(self.backend.close())
+        self.loop.close()
+        clock.use(self.previous)
+        self.tmpdir.cleanup()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_membership(self):
+        self.assertEqual(self.wait(self.backend.heartbeat('a', 15)), ['a'])
+        self.assertEqual(self.wait(self.backend.heartbeat('b', 15)),
+                         ['a', 'b'])
+        self.clock.advance(10)
+        self.assertEqual(self.wait(self.backend.heartbeat('b', 15)),
+                         ['a', 'b'])
+        self.clock.advance(10)
+        self.assertEqual(self.wait(self.backend.heartbeat('b', 15)), ['b'])
+        self.wait(self.backend.heartbeat('a', 15))
+        self.wait(self.backend.leave('a'))
+        self.assertEqual(self.wait(self.backend.heartbeat('b', 15)), ['b'])
+
+    def test_claim(self):
+        claim = self.backend.claim
+        self.assertTrue(self.wait(claim('x@60', 'a', 30)))
+        self.assertFalse(self.wait(claim('x@60', 'b', 30)))
+        self.assertTrue(self.wait(claim('x@120', 'b', 30)))
+        self.clock.advance(31)
+        self.wait(self.backend.heartbeat('a', 15))
+        self.assertTrue(self.wait(claim('x@60', 'b', 30)))
+
+
+class SQLiteLeaseTests(LeaseTests, unittest.TestCase):
+
+    def make_backend(self):
+        path = os.path.join(self.tmpdir.name, 'leases.db')
+        return cluster.SQLiteLeases(path, self.loop)
+
+
+class FileLeaseTests(LeaseTests, unittest.TestCase):
+
+    def make_backend(self):
+        return cluster.FileLeases(self.tmpdir.name, self.loop)
+
+    def test_published_expiry(self):
+        """ A lease is never visible with a stale mtime and no temporary
+        files are left behind. """
+        self.assertTrue(self.wait(self.backend.claim('x@60', 'a', 30)))
+        self.wait(self.backend.heartbeat('a', 15))
+        for name, ttl in (('claims', 30), ('nodes', 15)):
+            directory = os.path.join(self.tmpdir.name, name)
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            mtime = os.stat(os.path.join(directory, files[0])).st_mtime
+            self.assertAlmostEqual(mtime, clock.time() + ttl, places=3)
+
+    def test_node_grace(self):
+        """ Recently expired node leases are ignored but kept. """
+        self.wait(self.backend.heartbeat('a', 15))
+        self.clock.advance(20)
+        self.assertEqual(self.wait(self.backend.heartbeat('b', 15)), ['b'])
+        nodes = os.path.join(self.tmpdir.name, 'nodes')
+        self.assertEqual(len(os.listdir(nodes)), 2)
+        self.clock.advance(cluster.FileLeases.node_grace)
+        self.wait(self.backend.heartbeat('b', 15))
+        self.assertEqual(os.listdir(nodes), ['b'])
+
+
+class TCPLeaseTests(LeaseTests, unittest.TestCase):
+
+    def make_backend(self):
+        self.coordinator = cluster.Coordinator(self.loop)
+        self.wait(self.coordinator.start('127.0.0.1', 0))
+        port = self.coordinator.server.sockets[0].getsockname()[1]
+        return cluster.open_backend('tcp://127.0.0.1:%d' % port, self.loop)
+
+    def tearDown(self):
+        self.wait(self.coordinator.close())
+        super().tearDown()
+
+    def test_error(self):
+        self.assertRaises(ValueError, self.wait,
+                          self.backend.request(op='bogus'))
+        self.assertEqual(self.wait(self.backend.heartbeat('a', 15)), ['a'])
+
+
+class BrokenLeases(object):
+
+    @asyncio.coroutine
+    def heartbeat(self, node, ttl):
+        raise ConnectionError('backend down')
+
+    claim = heartbeat
+
+    @asyncio.coroutine
+    def leave(self, node):
+        pass
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+
+class ClusterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.clock = clock.VirtualClock(1000000)
+        self.previous = clock.use(self.clock)
+        self.loop = simulate.VirtualEventLoop(self.clock)
+        spec = cronspec.intern('* * * * *')
+        self.tasks = [scheduler.Task(spec, 'task %d' % i) for i in range(20)]
+        self.nodes = {}
+        for name in ('a', 'b'):
+            node = cluster.Cluster(name, cluster.FileLeases(
+                self.tmpdir.name, self.loop), self.loop)
+            node.set_tasks(self.tasks)
+            self.nodes[name] = node
+        self.fired = []
+
+    def tearDown(self):
+        for node in self.nodes.values():
+            self.loop.run_until_complete(node.close())
+        self.loop.close()
+        clock.use(self.previous)
+        self.tmpdir.cleanup()
+
+    def start(self):
+        for node in self.nodes.values():
+            self.loop.run_until_complete(node.start())
+        self.loop.run_until_complete(self.nodes['a'].heartbeat())
+
+    def fire(self, name):
+        @asyncio.coroutine
+        def fire(task, due):
+            self.fired.append((name, task, due))
+        return fire
+
+    def tick(self, nodes):
+        due = clock.time()
+        for name in nodes:
+            for task in self.tasks:
+                self.nodes[name].submit(task, due, self.fire(name))
+        self.loop.run_until_complete(asyncio.sleep(60, loop=self.loop))
+        fired = [x for x in self.fired if x[2] == due]
+        self.assertEqual(sorted(x[1].ident for x in fired),
+                         sorted(x.ident for x in self.tasks))
+        return fired
+
+    def test_sharding(self):
+        self.start()
+        a, b = self.nodes['a'], self.nodes['b']
+        self.assertEqual(a.ring.nodes, ('a', 'b'))
+        self.assertEqual(b.ring.nodes, ('a', 'b'))
+        fired = self.tick('ab')
+        for name, task, due in fired:
+            self.assertEqual(a.owner(task), name)
+        self.assertEqual(set(x[0] for x in fired), {'a', 'b'})
+        self.assertEqual(a.claimed + b.claimed, len(self.tasks))
+        self.assertEqual(a.failovers + b.failovers, 0)
+
+    def test_failover(self):
+        self.start()
+        a, b = self.nodes['a'], self.nodes['b']
+        orphans = sum(1 for x in self.tasks if a.owner(x) == 'a')
+        a.heartbeats.cancel()  # Dies without leaving.
+        fired = self.tick('b')
+        self.assertEqual(set(x[0] for x in fired), {'b'})
+        self.assertEqual(b.failovers, orphans)
+        self.assertEqual(b.ring.nodes, ('b',))
+        shards = b.shards()
+        self.assertEqual(len(shards['b']), len(self.tasks))
+
+    def test_close(self):
+        """ Closing drops runs still waiting out a takeover delay. """
+        self.start()
+        a = self.nodes.pop('a')
+        task = next(x for x in self.tasks if a.owner(x) == 'b')
+        a.submit(task, clock.time(), self.fire('a'))
+        self.loop.run_until_complete(asyncio.sleep(1, loop=self.loop))
+        self.assertEqual(len(a.dispatches), 1)
+        self.loop.run_until_complete(a.close())
+        self.assertEqual(a.dispatches, set())
+        self.assertTrue(a.heartbeats.done())
+        self.loop.run_until_complete(asyncio.sleep(60, loop=self.loop))
+        self.assertEqual(self.fired, [])
+        self.assertEqual(a.errors, 0)
+
+    def test_backend_down(self):
+        """ Errors are logged at most once a minute and dropped runs are
+        reported. """
+        node = cluster.Cluster('c', BrokenLeases(), self.loop)
+        node.set_tasks(self.tasks[:1])
+        dropped = []
+
+        @asyncio.coroutine
+        def on_drop(task, due, error):
+            dropped.append((task, due))
+        node.on_drop = on_drop
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            for i in range(10):
+                self.loop.run_until_complete(node.heartbeat())
+                self.clock.advance(10)
+            self.loop.run_until_complete(node.dispatch(
+                self.tasks[0], 60, self.fire('c')))
+        self.assertEqual(node.errors, 11)
+        lines = [x for x in err.getvalue().splitlines()
+                 if x.startswith('Cluster ')]
+        self.assertEqual(len(lines), 2)
+        self.assertIn('5 more errors', lines[1])
+        self.assertEqual(dropped, [(self.tasks[0], 60)])
+        self.assertEqual(self.fired, [])
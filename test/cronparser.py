@@ -30,6 +30,10 @@ class ParserTests(unittest.TestCase):
             with self.subTest(x):
                 self.assertEqual(cronparser.parseline('%s %s' % x), x)
 
+    def test_parse_hashed_spec(self):
+        self.assertEqual(cronparser.parseline('H(0-29)/10 H * * * command'),
+                         ('H(0-29)/10 H * * *', 'command'))
+
     def test_parse_alias_spec(self):
         valid = [
             ('@daily', 'command'),
@@ -38,7 +42,44 @@ class ParserTests(unittest.TestCase):
             with self.subTest(x):
                 self.assertEqual(cronparser.parseline('%s %s' % x), x)
 
+    def test_parse_python_call(self):
+        spec, command = cronparser.parseline('@daily py:pkg.mod:main a "b c"')
+        self.assertIsInstance(command, cronparser.PythonCall)
+        self.assertEqual(command, 'py:pkg.mod:main a "b c"')
+        self.assertEqual((command.module, command.function, command.args),
+                         ('pkg.mod', 'main', ('a', 'b c')))
+        self.assertNotIsInstance(cronparser.parseline('* * * * * py')[1],
+                                 cronparser.PythonCall)
+        self.assertRaises(ValueError, cronparser.parseline,
+                          '* * * * * py:nofunction')
+
     def test_parse_string(self):
         s = '\n\n* * * * * command\n\n'
         self.assertEqual(list(cronparser.parses(s)),
                          [('* * * * *', 'command')])
+
+    def test_parse_options(self):
+        self.assertEqual(cronparser.parseoptions(' group=db:2  limit=1 exec'),
+                         {"group": 'db:2', "limit": '1', "exec": True})
+
+    def test_entries(self):
+        s = '\n'.join([
+            '#: group=db',
+            '#: limit=2',
+            '',
+            '* * * * * one',
+            '# a comment',
+            '@daily two',
+            '#: exec',
+            '0 * * * * three',
+        ])
+        self.assertEqual(list(cronparser.entries(s.splitlines())), [
+            ('* * * * *', 'one', {"group": 'db', "limit": '2'}),
+            ('@daily', 'two', {}),
+            ('0 * * * *', 'three', {"exec": True}),
+        ])
+        self.assertEqual(list(cronparser.parses(s)), [
+            ('* * * * *', 'one'),
+            ('@daily', 'two'),
+            ('0 * * * *', 'three'),
+        ])
@@ -0,0 +1,128 @@
+"""
+Compiled cron spec tests
+"""
+
+import datetime
+import unittest
+from cronredux import cronspec
+
+
+def ts(*args):
+    return datetime.datetime(*args).timestamp()
+
+
+class CronSpecTests(unittest.TestCase):
+
+    def test_invalid(self):
+        cases = [
+            '* * * *',
+            '* * * * * *',
+            '60 * * * *',
+            '* 24 * * *',
+            '* * 0 * *',
+            '* * * 13 *',
+            '* * * * 8',
+            '*/0 * * * *',
+            '5-1 * * * *',
+            'x * * * *',
+        ]
+        for case in cases:
+            with self.subTest(case):
+                self.assertRaises(ValueError, cronspec.CronSpec, case)
+
+    def test_fields(self):
+        spec = cronspec.CronSpec('*/15 8-10 1,15 jan-mar mon-fri')
+        self.assertEqual(spec.minutes, 1 | 1 << 15 | 1 << 30 | 1 << 45)
+        self.assertEqual(spec.hours, 1 << 8 | 1 << 9 | 1 << 10)
+        self.assertEqual(spec.days, 1 << 1 | 1 << 15)
+        self.assertEqual(spec.months, 1 << 1 | 1 << 2 | 1 << 3)
+        self.assertEqual(spec.weekdays, 0b0111110)
+
+    def test_sunday_alias(self):
+        self.assertEqual(cronspec.CronSpec('0 0 * * 7'),
+                         cronspec.CronSpec('0 0 * * 0'))
+        self.assertEqual(cronspec.CronSpec('0 0 * * sat-sun').weekdays,
+                         1 | 1 << 6)
+
+    def test_alias(self):
+        self.assertEqual(cronspec.CronSpec('@daily'),
+                         cronspec.CronSpec('0 0 * * *'))
+        self.assertEqual(cronspec.CronSpec('@hourly'),
+                         cronspec.CronSpec('0 * * * *'))
+
+    def test_next(self):
+        cases = [
+            ('* * * * *', ts(2018, 1, 1, 0, 0, 30), ts(2018, 1, 1, 0, 1)),
+            ('* * * * *', ts(2018, 1, 1, 0, 1), ts(2018, 1, 1, 0, 2)),
+            ('*/5 * * * *', ts(2018, 1, 1, 0, 3), ts(2018, 1, 1, 0, 5)),
+            ('0 * * * *', ts(2018, 1, 1, 23, 30), ts(2018, 1, 2, 0, 0)),
+            ('30 12 * * *', ts(2018, 1, 1, 13), ts(2018, 1, 2, 12, 30)),
+            ('@monthly', ts(2018, 12, 15), ts(2019, 1, 1)),
+            ('0 0 29 2 *', ts(2018, 3, 1), ts(2020, 2, 29)),
+            ('0 0 * * mon', ts(2018, 1, 1, 12), ts(2018, 1, 8)),
+            ('0 0 L * *', ts(2018, 2, 1), ts(2018, 2, 28)),
+            ('0 0 * * L5', ts(2018, 1, 1), ts(2018, 1, 26)),
+        ]
+        for spec, after, expected in cases:
+            with self.subTest(spec=spec, after=after):
+                self.assertEqual(cronspec.CronSpec(spec).next(after),
+                                 expected)
+
+    def test_never(self):
+        self.assertIsNone(cronspec.CronSpec('0 0 30 2 *').next())
+
+    def test_next_n(self):
+        spec = cronspec.CronSpec('0 */6 * * *')
+        self.assertEqual(spec.next_n(3, ts(2018, 1, 1)), [
+            ts(2018, 1, 1, 6), ts(2018, 1, 1, 12), ts(2018, 1, 1, 18)])
+
+    def test_window(self):
+        spec = cronspec.CronSpec('0 0 * * *')
+        self.assertEqual(spec.window(ts(2018, 1, 1), ts(2018, 1, 3)), [
+            ts(2018, 1, 2), ts(2018, 1, 3)])
+
+    def test_batch(self):
+        specs = [cronspec.CronSpec(x) for x in ('@hourly', '0 * * * *',
+                                                '@daily')]
+        after = ts(2018, 1, 1, 0, 30)
+        res = cronspec.batch_next_n(specs, 2, after)
+        self.assertEqual(res[0], [ts(2018, 1, 1, 1), ts(2018, 1, 1, 2)])
+        self.assertIs(res[0], res[1])
+        self.assertEqual(res[2], [ts(2018, 1, 2), ts(2018, 1, 3)])
+        res = cronspec.batch_window(specs, after, ts(2018, 1, 1, 3))
+        self.assertEqual(len(res[0]), 3)
+        self.assertEqual(res[2], [])
+
+    def test_intern(self):
+        a = cronspec.intern('0 * * * *')
+        self.assertIs(cronspec.intern('0  *  * * *'), a)
+        self.assertIs(cronspec.intern('@hourly'), a)
+        self.assertIsNot(cronspec.intern('*/5 * * * *'), a)
+
+    def test_canonical(self):
+        a = cronspec.CronSpec('@hourly')
+        b = cronspec.CronSpec('0 * * * 0-7')
+        self.assertNotEqual(str(a), str(b))
+        self.assertEqual(a.canonical(), b.canonical())
+        self.assertNotEqual(a.canonical(),
+                            cronspec.CronSpec('0 * L * *').canonical())
+
+    def test_hashed(self):
+        a = cronspec.intern('H/15 H(2-5) * * *', 'backup.sh')
+        self.assertIs(cronspec.intern('h/15  H(2-5) * * *', 'backup.sh '), a)
+        minutes = list(cronspec._bits(a.minutes))
+        self.assertEqual(len(minutes), 4)
+        self.assertEqual([x - minutes[0] for x in minutes], [0, 15, 30, 45])
+        self.assertTrue(2 <= a.hours.bit_length() - 1 <= 5)
+        specs = set(cronspec.intern('H * * * *', 'job %d' % i)
+                    for i in range(20))
+        self.assertGreater(len(specs), 5)
+        days = cronspec.intern('0 0 H * H', 'x')
+        self.assertTrue(days.days.bit_length() - 1 <= 28)
+        self.assertTrue(days.weekdays.bit_length() - 1 <= 6)
+
+    def test_hashed_invalid(self):
+        self.assertRaises(ValueError, cronspec.intern, 'H * * * *')
+        for spec in ('H(5) * * * *', 'H(9-2) * * * *', 'Hx * * * *'):
+            with self.subTest(spec):
+                self.assertRaises(ValueError, cronspec.intern, spec, 'x')
@@ -0,0 +1,85 @@
+"""
+Dispatch queue tests
+"""
+
+import unittest
+from cronredux import clock, dispatch
+
+
+class Group(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+
+
+class DispatchQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.queue = dispatch.DispatchQueue(2, self.started.append)
+
+    def test_limit(self):
+        for x in 'abc':
+            self.queue.put(x)
+        self.assertEqual(self.started, ['a', 'b'])
+        self.assertEqual(len(self.queue), 1)
+        self.queue.release()
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        self.assertEqual(self.queue.running, 2)
+        self.assertEqual(self.queue.dispatched, 3)
+
+    def test_priority_and_fifo(self):
+        self.queue.limit = 0
+        self.queue.put('low1', priority=5)
+        self.queue.put('high', priority=-1)
+        self.queue.put('normal1')
+        self.queue.put('low2', priority=5)
+        self.queue.put('normal2')
+        self.assertEqual([x for x, _ in self.queue.waiting()],
+                         ['high', 'normal1', 'normal2', 'low1', 'low2'])
+        self.queue.limit = 10
+        self.queue.dispatch()
+        self.assertEqual(self.started, ['high', 'normal1', 'normal2', 'low1',
+                                        'low2'])
+
+    def test_groups(self):
+        db = Group(1)
+        self.queue.put('db1', groups=[db])
+        self.queue.put('db2', groups=[db])
+        self.queue.put('other')
+        # db2 is blocked on its group but must not block "other".
+        self.assertEqual(self.started, ['db1', 'other'])
+        self.assertEqual(db.active, 1)
+        self.queue.release()
+        self.assertEqual(self.started, ['db1', 'other'])
+        self.queue.release([db])
+        self.assertEqual(self.started, ['db1', 'other', 'db2'])
+        self.assertEqual(db.active, 1)
+
+    def test_stats(self):
+        self.queue.put('a')
+        stats = self.queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['dispatched'], 1)
+
+    def test_oldest_wait(self):
+        """ The oldest entry is tracked regardless of dispatch order. """
+        previous = clock.use(clock.VirtualClock(1000))
+        try:
+            self.queue.limit = 0
+            self.assertEqual(self.queue.oldest_wait, 0)
+            self.queue.put('low', priority=5)
+            clock.current.advance(10)
+            self.queue.put('high', priority=-1)
+            clock.current.advance(5)
+            self.assertEqual(self.queue.stats()['oldest_wait'], 15)
+            self.queue.limit = 1
+            self.queue.dispatch()
+            self.assertEqual(self.started, ['high'])
+            self.assertEqual(self.queue.oldest_wait, 15)
+            self.queue.release()
+            self.assertEqual(self.queue.oldest_wait, 0)
+        finally:
+            clock.use(previous)
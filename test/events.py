@@ -0,0 +1,51 @@
+"""
+Event bus tests.
+"""
+
+import asyncio
+import unittest
+from cronredux import events
+
+
+class EventBusTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.bus = events.EventBus(self.loop, buffer_size=3)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_fanout(self):
+        a = self.bus.subscribe()
+        b = self.bus.subscribe()
+        self.bus.publish('start', {"id": 1})
+        expected = [b'id: 1\nevent: start\ndata: {"id": 1}\n\n']
+        self.assertEqual(self.loop.run_until_complete(a.get()), expected)
+        self.assertEqual(self.loop.run_until_complete(b.get()), expected)
+
+    def test_no_subscribers(self):
+        self.bus.publish('start', {"id": 1})
+        sub = self.bus.subscribe()
+        self.assertEqual(self.loop.run_until_complete(sub.get(0.01)), [])
+
+    def test_slow_consumer_dropped(self):
+        slow = self.bus.subscribe()
+        fast = self.bus.subscribe()
+        for i in range(3):
+            self.bus.publish('start', {"id": i})
+        self.assertEqual(len(self.loop.run_until_complete(fast.get())), 3)
+        self.bus.publish('finish', {"id": 0})
+        self.assertTrue(slow.dropped)
+        self.assertIsNone(self.loop.run_until_complete(slow.get()))
+        self.assertEqual(self.bus.subscribers, {fast})
+        self.assertEqual(self.bus.dropped, 1)
+
+    def test_wakeup(self):
+        sub = self.bus.subscribe()
+        self.loop.call_later(0.01, self.bus.publish, 'skip', {})
+        messages = self.loop.run_until_complete(sub.get(5))
+        self.assertEqual(len(messages), 1)
+        self.bus.close()
+        self.assertIsNone(self.loop.run_until_complete(sub.get(5)))
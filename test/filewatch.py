@@ -0,0 +1,76 @@
+"""
+File watcher tests.
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from cronredux import filewatch
+
+
+class FileWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'crontab')
+        with open(self.path, 'w') as f:
+            f.write('* * * * * true\n')
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.close()
+        self.tmpdir.cleanup()
+
+    def callback(self):
+        self.calls += 1
+
+    def edit(self, replace=False):
+        if replace:
+            tmp = self.path + '.new'
+            with open(tmp, 'w') as f:
+                f.write('*/5 * * * * true\n')
+            os.rename(tmp, self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write('0 * * * * false\n')
+
+    def run_watcher(self, watcher, steps):
+        watcher.settle = 0.01
+        watcher.start()
+        self.mode = watcher.mode
+        try:
+            for step in steps:
+                self.loop.call_soon(step)
+                self.loop.run_until_complete(asyncio.sleep(0.2))
+        finally:
+            watcher.stop()
+
+    def test_poll(self):
+        watcher = filewatch.FileWatcher(self.path, self.callback, self.loop,
+                                        poll_interval=0.02)
+        watcher.start_inotify = lambda: False
+        self.run_watcher(watcher, [self.edit, lambda: self.edit(True)])
+        self.assertEqual(self.mode, 'poll')
+        self.assertEqual(self.calls, 2)
+
+    @unittest.skipIf(filewatch.load_inotify() is None, 'No inotify')
+    def test_inotify(self):
+        watcher = filewatch.FileWatcher(self.path, self.callback, self.loop)
+        self.run_watcher(watcher, [lambda: None, self.edit,
+                                   lambda: self.edit(True)])
+        self.assertEqual(self.mode, 'inotify')
+        self.assertEqual(self.calls, 2)
+
+    def test_debounce(self):
+        watcher = filewatch.FileWatcher(self.path, self.callback, self.loop)
+
+        def burst():
+            for i in range(5):
+                watcher.changed()
+        watcher.start_inotify = lambda: False
+        watcher.poll_interval = 60
+        self.run_watcher(watcher, [burst])
+        self.assertEqual(self.calls, 1)
@@ -0,0 +1,238 @@
+"""
+Execution history store tests.
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from cronredux import clock, cronspec, history, procwatch, scheduler
+
+
+def finished(task, returncode=0, output='', loop=None):
+    context = scheduler.TaskExecContext(task, loop)
+    context.set_queued()
+    context.set_start()
+    context.rusage = procwatch.ResourceUsage(utime=1.5, maxrss=10)
+    context.set_finish(returncode, output)
+    return context
+
+
+class MemoryHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        spec = cronspec.intern('* * * * *')
+        self.tasks = [scheduler.Task(spec, 'true'),
+                      scheduler.Task(spec, 'false')]
+
+    def test_bounded(self):
+        store = history.MemoryHistory(3)
+        contexts = [finished(self.tasks[0]) for i in range(5)]
+        for x in contexts:
+            store.add(x)
+        self.assertEqual(list(store), contexts[:-4:-1])
+
+    def test_evict_running(self):
+        """ Spilled output of an execution evicted while running is removed
+        once it is recorded. """
+        store = history.MemoryHistory(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            running = scheduler.TaskExecContext(self.tasks[0], None)
+            running.output_file = os.path.join(tmp, 'spill.log')
+            open(running.output_file, 'w').close()
+            store.add(running)
+            store.add(finished(self.tasks[1]))
+            self.assertTrue(os.path.exists(running.output_file))
+            path = running.output_file
+            running.set_start()
+            running.set_finish(0, '')
+            store.record(running)
+            self.assertFalse(os.path.exists(path))
+            self.assertIsNone(running.output_file)
+
+    def test_query(self):
+        store = history.MemoryHistory()
+        for i in range(6):
+            store.add(finished(self.tasks[i % 2], returncode=i % 2))
+        failures = store.query(task=self.tasks[1].ident, failed=True,
+                               limit=2)
+        self.assertEqual([x.returncode for x in failures], [1, 1])
+        self.assertEqual(len(store.query(failed=False, offset=2)), 1)
+        self.assertEqual(len(store.query(failed=True)), 3)
+        newest = store.query(limit=1)[0]
+        self.assertIs(store.get(newest.task.ident, newest.ident), newest)
+
+
+class SQLiteHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history.db')
+        spec = cronspec.intern('* * * * *')
+        self.tasks = [scheduler.Task(spec, 'true'),
+                      scheduler.Task(spec, 'false')]
+
+    def tearDown(self):
+        self.loop.close()
+        self.tmpdir.cleanup()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def open_store(self, **kwargs):
+        store = history.SQLiteHistory(self.path, **kwargs)
+        store.attach(dict((x.ident, x) for x in self.tasks))
+        self.loop.run_until_complete(store.setup(self.loop))
+        return store
+
+    def fill(self, store, count):
+        for i in range(count):
+            context = finished(self.tasks[i % 2], returncode=i % 2,
+                               output='out %d' % i)
+            store.add(context)
+            store.record(context)
+
+    def test_persist(self):
+        store = self.open_store(cache_size=2)
+        self.fill(store, 10)
+        self.loop.run_until_complete(store.close())
+        store = self.open_store()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(len(self.wait(store.query_async())), 10)
+        failures = self.wait(store.query_async(task=self.tasks[1].ident,
+                                              failed=True, limit=3))
+        self.assertEqual([x.output for x in failures],
+                         ['out 9', 'out 7', 'out 5'])
+        self.assertEqual(failures[0].rusage.utime, 1.5)
+        self.assertIs(failures[0].task, self.tasks[1])
+        page = self.wait(store.query_async(failed=True, limit=3, offset=3))
+        self.assertEqual([x.output for x in page], ['out 3', 'out 1'])
+        record = self.wait(store.get_async(failures[0].task.ident,
+                                          failures[0].ident))
+        self.assertEqual(record.output, 'out 9')
+        self.assertTrue(record.is_error())
+        self.loop.run_until_complete(store.close())
+
+    def test_restart(self):
+        """ Stored history follows the schedule and command, not the task
+        ident, which changes when cronredux restarts. """
+        store = self.open_store()
+        self.fill(store, 4)
+        self.loop.run_until_complete(store.close())
+        spec = cronspec.intern('* * * * *')
+        self.tasks = [scheduler.Task(spec, 'false'),
+                      scheduler.Task(spec, 'true')]
+        store = self.open_store()
+        records = self.wait(store.query_async(task=self.tasks[0].ident))
+        self.assertEqual([x.output for x in records], ['out 3', 'out 1'])
+        record = self.wait(store.get_async(self.tasks[0].ident, 1))
+        self.assertEqual(record.output, 'out 3')
+        self.loop.run_until_complete(store.close())
+
+    def test_same_command(self):
+        """ Entries running the same command on different schedules keep
+        their own history. """
+        self.tasks[1] = scheduler.Task(cronspec.intern('@hourly'), 'true')
+        store = self.open_store()
+        self.fill(store, 4)
+        self.loop.run_until_complete(store.close())
+        store = self.open_store()
+        records = self.wait(store.query_async(task=self.tasks[1].ident))
+        self.assertEqual([x.output for x in records], ['out 3', 'out 1'])
+        self.assertTrue(all(x.task is self.tasks[1] for x in records))
+        self.assertIsNone(self.wait(store.get_async(self.tasks[1].ident, 2)))
+        self.loop.run_until_complete(store.close())
+
+    def test_async_lookups(self):
+        """ The async lookups include rows not written yet. """
+        store = self.open_store()
+        context = finished(self.tasks[1], returncode=1, output='late')
+        store.pending.append(store.pack(context))
+        failures = self.wait(store.query_async(failed=True))
+        self.assertEqual(len(failures), 1)
+        record = self.loop.run_until_complete(store.get_async(
+            self.tasks[1].ident, context.ident))
+        self.assertEqual(record.output, 'late')
+        self.loop.run_until_complete(store.close())
+
+    def test_output_cap(self):
+        store = self.open_store(max_output=10)
+        context = finished(self.tasks[0], output='a' * 50 + 'b' * 50)
+        store.record(context)
+        self.loop.run_until_complete(store.close())
+        store = self.open_store()
+        output = self.wait(store.query_async())[0].output
+        self.assertTrue(output.startswith('aaaaa\n'))
+        self.assertTrue(output.endswith('\nbbbbb'))
+        self.assertIn('90 chars clipped', output)
+        self.loop.run_until_complete(store.close())
+
+    def test_prune(self):
+        store = self.open_store(max_rows=4)
+        store.prune_interval = 1
+        self.fill(store, 10)
+        self.loop.run_until_complete(store.close())
+        store = self.open_store()
+        self.assertEqual(len(self.wait(store.query_async())), 4)
+        self.loop.run_until_complete(store.close())
+
+    def test_unknown_task(self):
+        store = self.open_store()
+        spec = cronspec.intern('* * * * *')
+        other = scheduler.Task(spec, 'echo gone')
+        store.record(finished(other))
+        self.loop.run_until_complete(store.close())
+        store = self.open_store()
+        record = self.wait(store.query_async())[0]
+        self.assertIsInstance(record.task, history.TaskRef)
+        self.assertEqual(record.task.cmd, 'echo gone')
+        self.loop.run_until_complete(store.close())
+
+    def test_timestamps(self):
+        """ Stored executions give back the wall clock times and durations
+        of the context. """
+        store = self.open_store()
+        virtual = clock.VirtualClock(1000)
+        previous = clock.use(virtual)
+        try:
+            context = scheduler.TaskExecContext(self.tasks[0], None)
+            virtual.advance(10)
+            context.set_queued()
+            virtual.advance(2)
+            context.set_start()
+            virtual.advance(5)
+            context.set_finish(0, '')
+        finally:
+            clock.use(previous)
+        store.record(context)
+        self.loop.run_until_complete(store.close())
+        store = self.open_store()
+        record = self.wait(store.query_async())[0]
+        self.assertEqual((record.queued_ts, record.started_ts,
+                          record.finished_ts), (1010, 1012, 1017))
+        self.assertEqual((record.wait_seconds, record.elapsed_seconds),
+                         (2, 5))
+        self.assertEqual(record.as_dict(), context.as_dict())
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.loop.run_until_complete(store.close())
+
+    def test_load_durations(self):
+        store = self.open_store()
+        virtual = clock.VirtualClock(0)
+        previous = clock.use(virtual)
+        try:
+            for seconds in (10, 20):
+                context = scheduler.TaskExecContext(self.tasks[0], None)
+                context.set_queued()
+                context.set_start()
+                virtual.advance(seconds)
+                context.set_finish(0, '')
+                store.record(context)
+        finally:
+            clock.use(previous)
+        self.loop.run_until_complete(store.close())
+        self.assertEqual(history.load_durations(self.path), {"true": 15})
+        self.assertRaises(FileNotFoundError, history.load_durations,
+                          self.path + '.missing')
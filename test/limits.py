@@ -0,0 +1,146 @@
+"""
+Task resource limit tests.
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+from cronredux import cronspec, limits, output, scheduler
+
+
+class ParseTests(unittest.TestCase):
+
+    def test_size(self):
+        self.assertEqual(limits.parse_size('512M'), 512 << 20)
+        self.assertEqual(limits.parse_size('1.5g'), 3 << 29)
+        self.assertEqual(limits.parse_size('4096'), 4096)
+        for x in ('0', '-1K', 'lots', True):
+            self.assertRaises(ValueError, limits.parse_size, x)
+
+    def test_ionice(self):
+        self.assertEqual(limits.parse_ionice('idle'), ('idle', 4))
+        self.assertEqual(limits.parse_ionice('best-effort:7'),
+                         ('best-effort', 7))
+        for x in ('fast', 'idle:8', 'idle:x', True):
+            self.assertRaises(ValueError, limits.parse_ionice, x)
+
+    def test_cpu_max(self):
+        self.assertEqual(limits.parse_cpu_max('50%'), '50000 100000')
+        self.assertEqual(limits.parse_cpu_max('2'), '200000 100000')
+        self.assertEqual(limits.parse_cpu_max('max/50000'), 'max 50000')
+        self.assertEqual(limits.parse_cpu_max('25000/50000'), '25000 50000')
+        for x in ('0', 'x%', '1/2/3', True):
+            self.assertRaises(ValueError, limits.parse_cpu_max, x)
+
+    def test_task_options(self):
+        spec = cronspec.intern('* * * * *')
+        self.assertIsNone(scheduler.Task(spec, 'true').limits)
+        task = scheduler.Task(spec, 'true', {"nice": '5', "rlimit_cpu": '9',
+                                             "memory_max": '1G'})
+        self.assertEqual(task.limits.nice, 5)
+        self.assertEqual(task.limits.memory_max, 1 << 30)
+        self.assertTrue(task.limits.cgroup)
+        for options in ({"nice": '-5'}, {"nice": True},
+                        {"memory_max": True}):
+            self.assertRaises(ValueError, scheduler.Task, spec, 'true',
+                              options)
+
+
+class ApplyTests(unittest.TestCase):
+
+    def test_apply(self):
+        """ Limits applied to a gated process are in place when it execs. """
+        rlimits = {limits.RLIMITS['rlimit_nofile']: 64}
+        ps = subprocess.Popen(limits.GATE + ('sh', '-c', 'ulimit -n; nice'),
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        limits.ResourceLimits(nice=3, rlimits=rlimits).apply(ps.pid)
+        out = ps.communicate(b'\n')[0]
+        nofile, nice = out.decode().split()
+        self.assertEqual(nofile, '64')
+        self.assertEqual(int(nice), os.nice(0) + 3)
+
+
+class CgroupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.write('cgroup.controllers', 'cpuset cpu io memory pids\n')
+        self.write('cgroup.subtree_control', '')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        asyncio.get_child_watcher().attach_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.root, name), 'w') as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return f.read()
+
+    def test_create(self):
+        manager = limits.CgroupManager(self.root)
+        limit = limits.ResourceLimits(cpu_max='50000 100000',
+                                      memory_max=1 << 20)
+        cgroup = manager.create('job', limit)
+        self.assertEqual(self.read('cgroup.subtree_control'),
+                         '+cpu +memory')
+        self.assertEqual(self.read('job/cpu.max'), '50000 100000')
+        self.assertEqual(self.read('job/memory.max'), '1048576')
+        self.write('job/cpu.stat', 'usage_usec 1500000\nuser_usec 1000000\n'
+                   'system_usec 500000\nnr_throttled 3\n'
+                   'throttled_usec 250000\n')
+        self.write('job/memory.current', '4096\n')
+        self.write('job/memory.events', 'oom 1\noom_kill 1\n')
+        stats = cgroup.stats()
+        self.assertEqual(stats['cpu'], 1.5)
+        self.assertEqual(stats['throttled'], 0.25)
+        self.assertEqual(stats['memory_peak'], 4096)
+        self.assertEqual(stats['oom_kills'], 1)
+        self.assertEqual(manager.stats()['created'], 1)
+
+    def test_find_root(self):
+        self.write('mounts', 'proc /proc proc rw 0 0\n'
+                   'cgroup2 /sys/fs/cgroup cgroup2 rw 0 0\n')
+        self.write('cgroup', '0::/system.slice/cronredux.service\n')
+        manager = limits.CgroupManager(
+            mounts=os.path.join(self.root, 'mounts'),
+            self_cgroup=os.path.join(self.root, 'cgroup'))
+        self.assertEqual(manager.find_root(),
+                         '/sys/fs/cgroup/system.slice/cronredux.service')
+
+    def test_unavailable(self):
+        self.write('cgroup.controllers', 'pids\n')
+        manager = limits.CgroupManager(self.root)
+        limit = limits.ResourceLimits(memory_max=1 << 20)
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertIsNone(manager.create('a', limit))
+            self.assertIsNone(manager.create('b', limit))
+        self.assertEqual(err.getvalue().count('Cgroups unavailable'), 1)
+        self.assertIn('No cpu or memory controller', manager.error)
+        self.assertEqual(manager.failed, 2)
+
+    def test_task(self):
+        """ Limits apply to a task even if its cgroup can't be made. """
+        task = scheduler.Task(cronspec.intern('* * * * *'), 'sh -c "ulimit '
+                              '-n"', {"rlimit_nofile": '32',
+                                      "memory_max": '64M'})
+        context = scheduler.TaskExecContext(task, self.loop)
+        context.set_queued()
+        context.set_start()
+        manager = limits.CgroupManager(os.path.join(self.root, 'missing'))
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.loop.run_until_complete(context.run_task(
+                output.OutputCapture(), cgroups=manager))
+        self.assertEqual(context.output, '32\n')
+        self.assertIsNone(context.cgroup)
+        self.assertIsNotNone(manager.error)
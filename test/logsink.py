@@ -0,0 +1,84 @@
+"""
+Log sink tests.
+"""
+
+import asyncio
+import io
+import json
+import os
+import tempfile
+import unittest
+from cronredux import logsink
+
+META = logsink.LogMeta(1.5, 3, 'echo hi', 7, None)
+
+
+class FormatTests(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(logsink.plain_format(META, 'hi'),
+                         '[echo hi] [job:7] [exit:-] hi')
+        self.assertEqual(logsink.plain_format(META._replace(exit=2), 'x'),
+                         '[echo hi] [job:7] [exit:2] x')
+
+    def test_json(self):
+        self.assertEqual(json.loads(logsink.json_format(META, 'hi')), {
+            "time": 1.5, "task": 3, "cmd": 'echo hi', "exec": 7,
+            "exit": None, "line": 'hi'})
+
+
+class TaskFileWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_rotate(self):
+        writer = logsink.TaskFileWriter(self.tmpdir.name, max_bytes=100,
+                                        backups=2)
+        for i in range(10):
+            writer.write([(META, ['line %d' % i])])
+        writer.write([(META._replace(cmd='other'), ['x'])])
+        writer.close()
+        name = logsink.TaskFileWriter.filename('echo hi')
+        self.assertTrue(name.startswith('echo_hi-'))
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted([
+            name, name + '.1', name + '.2',
+            logsink.TaskFileWriter.filename('other')]))
+        with open(os.path.join(self.tmpdir.name, name)) as f:
+            self.assertTrue(f.read().endswith('line 9\n'))
+
+
+class LogSinkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_batches(self):
+        sink = logsink.LogSink(logsink.StreamWriter(self.stream), self.loop,
+                               batch_size=2, flush_delay=0)
+        for i in range(5):
+            self.assertTrue(sink.emit(META, ['a%d' % i, 'b%d' % i]))
+        self.loop.run_until_complete(sink.close())
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[-1], '[echo hi] [job:7] [exit:-] b4')
+        stats = sink.stats()
+        self.assertEqual((stats['written'], stats['batches'],
+                          stats['pending']), (5, 3, 0))
+
+    def test_backpressure(self):
+        sink = logsink.LogSink(logsink.StreamWriter(self.stream), self.loop,
+                               max_pending=3)
+        results = [sink.emit(META, ['x']) for i in range(5)]
+        self.assertEqual(results, [True] * 3 + [False] * 2)
+        self.assertEqual(sink.stats()['dropped'], 2)
+        self.loop.run_until_complete(sink.close())
+        self.assertEqual(len(self.stream.getvalue().splitlines()), 3)
@@ -0,0 +1,67 @@
+"""
+Metrics tests.
+"""
+
+import unittest
+from cronredux import metrics
+
+
+class FakeLoop(object):
+
+    def __init__(self):
+        self.now = 0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        self.timers.append((when, callback))
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_counter(self):
+        registry = metrics.Registry()
+        c = registry.counter('runs_total', 'Runs.', ('task',))
+        c.inc(('a',))
+        c.inc(('a',))
+        c.inc(('b"\n',), 3)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP cronredux_runs_total Runs.',
+            '# TYPE cronredux_runs_total counter',
+            'cronredux_runs_total{task="a"} 2',
+            'cronredux_runs_total{task="b\\"\\n"} 3',
+        ])
+
+    def test_histogram(self):
+        registry = metrics.Registry(prefix='')
+        h = registry.histogram('lag', 'Lag.', buckets=(1, 5))
+        for x in (0.5, 1, 3, 10):
+            h.observe(x)
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'lag_bucket{le="1"} 2',
+            'lag_bucket{le="5"} 3',
+            'lag_bucket{le="+Inf"} 4',
+            'lag_sum 14.5',
+            'lag_count 4',
+        ])
+
+    def test_gauge(self):
+        registry = metrics.Registry(prefix='')
+        registry.gauge('depth', 'Depth.', lambda: 7)
+        registry.gauge('group', 'Group.', lambda: [(('db',), 2)],
+                       labels=('name',))
+        lines = registry.render().splitlines()
+        self.assertIn('depth 7', lines)
+        self.assertIn('group{name="db"} 2', lines)
+
+    def test_loop_lag(self):
+        loop = FakeLoop()
+        monitor = metrics.LoopLagMonitor(loop, interval=1)
+        monitor.start()
+        when, callback = loop.timers.pop()
+        loop.now = when + 0.25
+        callback()
+        self.assertEqual(monitor.lag, 0.25)
+        self.assertEqual(loop.timers[-1][0], 2.25)
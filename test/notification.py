@@ -0,0 +1,240 @@
+"""
+Notification tests against a local stub webhook.
+"""
+
+import asyncio
+import json
+import socket
+import unittest
+from aiohttp import web
+from cronredux import clock, notification
+
+
+class StubWebhook(object):
+    """ A local HTTP server that records slack style webhook posts. """
+
+    def __init__(self, loop, rate_limit=0, delay=0):
+        self.loop = loop
+        self.rate_limit = rate_limit
+        self.delay = delay
+        self.posts = []
+
+    @asyncio.coroutine
+    def start(self):
+        app = web.Application()
+        app.router.add_route('POST', '/hook', self.handler)
+        self.runner = web.AppRunner(app)
+        yield from self.runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d/hook' % sock.getsockname()[1]
+        site = web.SockSite(self.runner, sock)
+        yield from site.start()
+
+    @asyncio.coroutine
+    def stop(self):
+        yield from self.runner.cleanup()
+
+    @asyncio.coroutine
+    def handler(self, request):
+        if self.delay:
+            yield from asyncio.sleep(self.delay)
+        if self.rate_limit:
+            self.rate_limit -= 1
+            return web.json_response({"retry_after": 0.01}, status=429)
+        self.posts.append(json.loads((yield from request.text())))
+        return web.Response(text='ok')
+
+
+class SlackNotifierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_stub(self, test, notifier_kwargs=None, **stub_kwargs):
+        stub = StubWebhook(self.loop, **stub_kwargs)
+
+        @asyncio.coroutine
+        def runner():
+            yield from stub.start()
+            notifier = notification.SlackNotifier(stub.url,
+                                                  **notifier_kwargs or {})
+            yield from notifier.setup(self.loop)
+            try:
+                yield from test(notifier)
+                yield from notifier.close()
+            finally:
+                yield from stub.stop()
+            return notifier
+        notifier = self.loop.run_until_complete(runner())
+        return stub, notifier
+
+    def test_single(self):
+        @asyncio.coroutine
+        def test(notifier):
+            yield from notifier.info('hello', 'world')
+        stub, notifier = self.run_stub(test)
+        self.assertEqual(len(stub.posts), 1)
+        attachment = stub.posts[0]['attachments'][0]
+        self.assertEqual(attachment['fallback'], 'hello')
+        self.assertEqual(attachment['text'], 'world')
+        self.assertEqual(stub.posts[0]['username'], 'Cronredux')
+
+    def test_does_not_block(self):
+        @asyncio.coroutine
+        def test(notifier):
+            start = self.loop.time()
+            for i in range(5):
+                yield from notifier.error('msg %d' % i)
+            self.assertLess(self.loop.time() - start, 0.5)
+        stub, notifier = self.run_stub(test, delay=0.5)
+        titles = [x['fallback'] for post in stub.posts
+                  for x in post['attachments']]
+        self.assertEqual(titles, ['msg %d' % i for i in range(5)])
+
+    def test_batching(self):
+        @asyncio.coroutine
+        def test(notifier):
+            for i in range(5):
+                yield from notifier.info('msg %d' % i)
+        stub, notifier = self.run_stub(test,
+                                       notifier_kwargs={"max_batch": 2})
+        self.assertEqual([len(x['attachments']) for x in stub.posts],
+                         [2, 2, 1])
+
+    def test_rate_limit_retry(self):
+        @asyncio.coroutine
+        def test(notifier):
+            yield from notifier.warning('retry me')
+        stub, notifier = self.run_stub(test, rate_limit=2)
+        self.assertEqual(len(stub.posts), 1)
+        self.assertEqual(stub.posts[0]['attachments'][0]['fallback'],
+                         'retry me')
+
+    def test_overflow_summarize(self):
+        @asyncio.coroutine
+        def test(notifier):
+            for i in range(10):
+                notifier.enqueue({"fallback": 'msg %d' % i})
+        stub, notifier = self.run_stub(test, notifier_kwargs={
+            "max_queue": 3,
+            "max_batch": 10,
+            "overflow": 'summarize'
+        })
+        attachments = stub.posts[0]['attachments']
+        self.assertEqual([x['fallback'] for x in attachments[:3]],
+                         ['msg 7', 'msg 8', 'msg 9'])
+        self.assertEqual(attachments[3]['fallback'],
+                         '7 notifications dropped')
+
+    def test_overflow_drop_oldest(self):
+        @asyncio.coroutine
+        def test(notifier):
+            for i in range(10):
+                notifier.enqueue({"fallback": 'msg %d' % i})
+        stub, notifier = self.run_stub(test, notifier_kwargs={
+            "max_queue": 3,
+            "max_batch": 10,
+            "overflow": 'drop-oldest'
+        })
+        self.assertEqual([x['fallback'] for x in stub.posts[0]['attachments']],
+                         ['msg 7', 'msg 8', 'msg 9'])
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, notification.SlackNotifier, 'url',
+                          overflow='nope')
+
+    def test_invalid_rate(self):
+        """ A burst below 1 would never let a post through. """
+        for burst in (0, -1):
+            self.assertRaises(ValueError, notification.SlackNotifier, 'url',
+                              burst=burst)
+        self.assertRaises(ValueError, notification.SlackNotifier, 'url',
+                          rate=-1)
+        notification.SlackNotifier('url', rate=0)  # No limit.
+
+
+class RecordingNotifier(notification.Notifier):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    @asyncio.coroutine
+    def info(self, title, message='', raw='', footer=None):
+        self.sent.append(title)
+
+    warning = error = info
+
+
+class AlertTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.clock = clock.VirtualClock(0)
+        self.previous = clock.use(self.clock)
+
+    def tearDown(self):
+        clock.use(self.previous)
+        self.loop.close()
+
+    def report_failure(self, notifier, signature=1, task='job'):
+        self.loop.run_until_complete(notifier.failure(
+            task, 'Failed: `%s`' % task, signature=signature))
+        self.clock.advance(60)
+
+    def test_digest(self):
+        notifier = RecordingNotifier(digest_interval=600)
+        for i in range(25):
+            self.report_failure(notifier)
+        self.assertEqual(notifier.sent, ['Failed: `job`'] +
+                         ['Still failing: `job`'] * 2)
+        self.assertEqual(notifier.suppressed, 22)
+        self.assertEqual(notifier.failing, 1)
+
+    def test_new_failure(self):
+        notifier = RecordingNotifier()
+        for signature in (1, 1, 2, 2, 1):
+            self.report_failure(notifier, signature)
+        self.assertEqual(notifier.sent, ['Failed: `job`'] * 3)
+
+    def test_recovered(self):
+        notifier = RecordingNotifier()
+        self.report_failure(notifier)
+        self.report_failure(notifier, task='other')
+        self.assertTrue(self.loop.run_until_complete(
+            notifier.success('job')))
+        self.assertFalse(self.loop.run_until_complete(
+            notifier.success('job')))
+        self.assertEqual(notifier.sent[-1], 'Recovered: `job`')
+        notifier.forget('other')
+        self.assertEqual(notifier.failing, 0)
+
+    def test_no_digest(self):
+        notifier = RecordingNotifier(digest_interval=0)
+        for i in range(3):
+            self.report_failure(notifier)
+        self.assertEqual(len(notifier.sent), 3)
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_rate(self):
+        loop = asyncio.new_event_loop()
+        bucket = notification.TokenBucket(20, 2, loop)
+
+        @asyncio.coroutine
+        def take(count):
+            for i in range(count):
+                yield from bucket.take()
+        start = loop.time()
+        loop.run_until_complete(take(2))
+        self.assertLess(loop.time() - start, 0.05)
+        loop.run_until_complete(take(3))
+        self.assertGreater(loop.time() - start, 0.14)
+        loop.close()
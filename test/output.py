@@ -0,0 +1,99 @@
+"""
+Output capture tests
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from cronredux import output
+
+
+class OutputCaptureTests(unittest.TestCase):
+
+    def test_small(self):
+        capture = output.OutputCapture()
+        capture.write(b'abc\n')
+        capture.write(b'def\n')
+        capture.close()
+        self.assertEqual(capture.getvalue(), 'abc\ndef\n')
+        self.assertEqual(capture.size, 8)
+        self.assertEqual(capture.clipped, 0)
+        self.assertEqual(list(capture.lines()), ['abc', 'def'])
+
+    def test_clipped(self):
+        capture = output.OutputCapture(head_size=4, tail_size=4)
+        for x in range(100):
+            capture.write(b'%04d' % x)
+        capture.close()
+        self.assertEqual(capture.size, 400)
+        self.assertEqual(capture.clipped, 392)
+        self.assertEqual(capture.getvalue(), '0000' + capture.clip_marker %
+                         392 + '0099')
+
+    def test_no_tail(self):
+        for head_size in (0, 4):
+            capture = output.OutputCapture(head_size=head_size, tail_size=0)
+            capture.write(b'abcdefgh')
+            capture.write(b'ijkl')
+            self.assertEqual(capture.clipped, 12 - head_size)
+            self.assertEqual(capture.getvalue(), 'abcd'[:head_size] +
+                             capture.clip_marker % (12 - head_size))
+
+    def test_on_line(self):
+        lines = []
+        capture = output.OutputCapture(on_line=lines.append, max_line=8)
+        capture.write(b'one\ntw')
+        self.assertEqual(lines, ['one'])
+        capture.write(b'o\nthree')
+        self.assertEqual(lines, ['one', 'two'])
+        capture.write(b'threethree')
+        self.assertEqual(lines, ['one', 'two', 'threethreethree'])
+        capture.write(b'four')
+        capture.close()
+        self.assertEqual(lines, ['one', 'two', 'threethreethree', 'four'])
+
+    def test_invalid_utf8(self):
+        capture = output.OutputCapture()
+        capture.write(b'\xff\n')
+        capture.close()
+        self.assertEqual(capture.getvalue(), '�\n')
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = output.OutputCapture(head_size=2, tail_size=2,
+                                           spill_dir=tmp)
+            capture.write(b'line 1\nline 2\nline 3\n')
+            capture.close()
+            self.assertTrue(os.path.exists(capture.spill_path))
+            self.assertEqual(list(capture.lines()), ['line 1', 'line 2',
+                                                     'line 3'])
+
+    def test_spill_dir_missing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            missing = os.path.join(tmp, 'missing')
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                capture = output.OutputCapture(spill_dir=missing)
+            capture.write(b'abc\n')
+            capture.close()
+        self.assertIn('Output spill failed', err.getvalue())
+        self.assertIsNone(capture.spill_path)
+        self.assertEqual(list(capture.lines()), ['abc'])
+
+    @unittest.skipUnless(os.path.exists('/dev/full'), 'needs /dev/full')
+    def test_spill_write_error(self):
+        """ A full disk drops the spill file but not the captured output. """
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = output.OutputCapture(spill_dir=tmp)
+            path = capture.spill_path
+            capture.spill.close()
+            capture.spill = open('/dev/full', 'wb', buffering=0)
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                capture.write(b'abc\n')
+                capture.write(b'def\n')
+            capture.close()
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(err.getvalue().count('Output spill failed'), 1)
+        self.assertIsNone(capture.spill_path)
+        self.assertEqual(capture.getvalue(), 'abc\ndef\n')
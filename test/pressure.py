@@ -0,0 +1,99 @@
+"""
+Adaptive concurrency tests.
+"""
+
+import os
+import tempfile
+import unittest
+from cronredux import dispatch, pressure
+
+
+class PSITests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.tmpdir.name, name), 'w') as f:
+            f.write(text)
+
+    def test_read_psi(self):
+        self.write('memory', 'some avg10=1.50 avg60=0.20 avg300=0.00 '
+                   'total=123\nfull avg10=0.75 avg60=0.00 avg300=0.00 '
+                   'total=45\n')
+        psi = pressure.read_psi('memory', self.tmpdir.name)
+        self.assertEqual(psi['some']['avg10'], 1.5)
+        self.assertEqual(psi['full']['total'], 45)
+        self.assertIsNone(pressure.read_psi('cpu', self.tmpdir.name))
+
+    def test_sampler(self):
+        self.write('cpu', 'some avg10=30.00 avg60=0.00 avg300=0.00 total=0\n')
+        self.write('vmstat', 'pswpin 5\npswpout 100\n')
+        sampler = pressure.Sampler(self.tmpdir.name,
+                                   os.path.join(self.tmpdir.name, 'vmstat'))
+        sample = sampler.sample()
+        self.assertEqual(sample.source, 'psi')
+        self.assertEqual((sample.cpu, sample.memory, sample.io),
+                         (30, 0, 0))
+        self.assertEqual(sample.swapout, 0)
+        os.remove(os.path.join(self.tmpdir.name, 'cpu'))
+        sampler.cpus = 4
+        sampler.loadavg = lambda: (2.0, 1.0, 0.5)
+        sample = sampler.sample()
+        self.assertEqual(sample.source, 'loadavg')
+        self.assertEqual(sample.cpu, 0.5)
+
+
+class AdaptiveConcurrencyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.queue = dispatch.DispatchQueue(1, self.started.append)
+        self.changes = []
+        self.ctl = pressure.AdaptiveConcurrency(None, 2, 8, cooldown=10)
+        self.ctl.attach(self.queue, self.changes.append)
+
+    def test_increase_on_backlog(self):
+        for i in range(4):
+            self.queue.put(i)
+        self.assertEqual(self.queue.limit, 2)
+        self.assertEqual(self.ctl.adjust(pressure.Sample('psi'), now=0), 3)
+        self.assertEqual(self.started, [0, 1, 2])
+        self.assertEqual(self.changes[0]['reason'], 'backlog')
+        for x in self.started:
+            self.queue.release()
+        self.assertEqual(self.ctl.adjust(pressure.Sample('psi'), now=1), 3)
+
+    def test_decrease(self):
+        self.queue.limit = 8
+        sample = pressure.Sample('psi', cpu=50)
+        self.assertEqual(self.ctl.adjust(sample, now=0), 6)
+        self.assertEqual(self.ctl.adjust(sample, now=5), 6)  # Cooling down.
+        self.assertEqual(self.ctl.adjust(sample, now=11), 4)
+        swapping = pressure.Sample('psi', swapout=10)
+        self.assertEqual(self.ctl.adjust(swapping, now=30), 2)
+        self.assertEqual(self.ctl.adjust(swapping, now=50), 2)  # Minimum.
+        self.assertEqual([x['reason'] for x in self.changes],
+                         ['cpu pressure', 'cpu pressure', 'memory pressure'])
+        self.assertEqual(self.ctl.adjustments['down'], 3)
+
+    def test_loadavg(self):
+        """ Load average samples have their own target and cooldown. """
+        self.queue.limit = 8
+        busy = pressure.Sample('loadavg', cpu=0.9)
+        self.assertEqual(self.ctl.adjust(busy, now=0), 8)
+        overloaded = pressure.Sample('loadavg', cpu=1.5)
+        self.assertEqual(self.ctl.adjust(overloaded, now=5), 6)
+        self.assertEqual(self.ctl.adjust(overloaded, now=20), 6)
+        self.assertEqual(self.ctl.adjust(overloaded, now=64), 6)
+        self.assertEqual(self.ctl.adjust(overloaded, now=66), 4)
+        self.assertEqual(self.changes[-1]['reason'], 'cpu pressure')
+
+    def test_bounds(self):
+        self.assertRaises(ValueError, pressure.AdaptiveConcurrency, None, 0,
+                          4)
+        self.assertRaises(ValueError, pressure.AdaptiveConcurrency, None, 5,
+                          4)
@@ -0,0 +1,36 @@
+"""
+Process accounting tests
+"""
+
+import os
+import resource
+import unittest
+from cronredux import procwatch
+
+
+class ResourceUsageTests(unittest.TestCase):
+
+    def test_add(self):
+        a = procwatch.ResourceUsage(utime=1, stime=2, maxrss=100, inblock=1,
+                                    oublock=2, nvcsw=3, nivcsw=4)
+        b = procwatch.ResourceUsage(utime=1, stime=1, maxrss=50, inblock=1,
+                                    oublock=1, nvcsw=1, nivcsw=1)
+        c = a + b
+        self.assertEqual(c.as_dict(), {
+            "utime": 2, "stime": 3, "maxrss": 100, "inblock": 2,
+            "oublock": 3, "nvcsw": 4, "nivcsw": 5})
+        self.assertEqual(c.cpu, 5)
+        a += b
+        self.assertEqual(a.as_dict(), c.as_dict())
+
+    def test_from_rusage(self):
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        usage = procwatch.ResourceUsage.from_rusage(ru)
+        self.assertEqual(usage.maxrss, ru.ru_maxrss)
+        self.assertEqual(usage.utime, ru.ru_utime)
+
+    def test_exitcode(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(3)
+        self.assertEqual(procwatch.exitcode(os.waitpid(pid, 0)[1]), 3)
@@ -2,8 +2,15 @@
 Test scheduler logic.
 """
 
+import argparse
+import asyncio
+import os
+import shutil
+import signal
 import time
-from cronredux import scheduler
+import unittest
+from cronredux import clock, cronparser, cronspec, notification, scheduler, \
+    simulate
 
 
 class TestTask(scheduler.Task):
@@ -25,3 +32,334 @@ class TestTask(scheduler.Task):
         if self.on_call is not None:
             self.on_call()
         self.set_state('done')
+
+
+class TaskOptionTests(unittest.TestCase):
+
+    def test_no_options(self):
+        task = scheduler.Task(cronspec.intern('* * * * *'), 'true')
+        self.assertIsNone(task.limit)
+        self.assertEqual(task.groups, {})
+
+    def test_options(self):
+        task = scheduler.Task(cronspec.intern('* * * * *'), 'true', {
+            "limit": '2', "group": 'db:2,io'})
+        self.assertEqual(task.limit, 2)
+        self.assertEqual(task.groups, {"db": 2, "io": None})
+
+    def test_invalid_options(self):
+        spec = cronspec.intern('* * * * *')
+        self.assertRaises(ValueError, scheduler.Task, spec, 'true',
+                          {"nope": '1'})
+        self.assertRaises(ValueError, scheduler.Task, spec, 'true',
+                          {"limit": 'x'})
+
+    def test_bare_options(self):
+        """ Only flags can be given without a value. """
+        spec = cronspec.intern('* * * * *')
+        for key in ('timeout', 'limit', 'priority', 'group', 'rlimit_cpu'):
+            with self.assertRaisesRegex(ValueError, 'Invalid value for task '
+                                        'option %s' % key):
+                scheduler.Task(spec, 'true', {key: True})
+        task = scheduler.Task(spec, 'echo hi', {"exec": True})
+        self.assertIsNotNone(task.argv)
+
+    def test_timeout_option(self):
+        task = scheduler.Task(cronspec.intern('* * * * *'), 'true', {
+            "timeout": '1.5'})
+        self.assertEqual(task.options['timeout'], 1.5)
+        self.assertEqual(task.timeout_count, 0)
+
+    def test_exec_detect(self):
+        spec = cronspec.intern('* * * * *')
+        task = scheduler.Task(spec, 'echo "a b" c\\ d')
+        self.assertEqual(task.argv[1:], ['a b', 'c d'])
+        self.assertTrue(task.argv[0].endswith('/echo'))
+        for cmd in ('echo a | cat', 'echo $HOME', 'ls *.py', 'A=1 env',
+                    'cd /tmp', 'true; false', 'no-such-program-here x'):
+            self.assertIsNone(scheduler.Task(spec, cmd).argv, cmd)
+
+    def test_python_call(self):
+        spec, command = cronparser.parseline('* * * * * py:mod:main')
+        task = scheduler.Task(cronspec.intern(spec), command, {"exec": True})
+        self.assertIs(task.call, command)
+        self.assertIsNone(task.argv)
+
+    def test_exec_option(self):
+        spec = cronspec.intern('* * * * *')
+        task = scheduler.Task(spec, 'echo a;b', {"exec": True})
+        self.assertEqual(task.argv[1:], ['a;b'])
+        task = scheduler.Task(spec, 'true', {"exec": 'no'})
+        self.assertIsNone(task.argv)
+        self.assertRaises(ValueError, scheduler.Task, spec, 'true',
+                          {"exec": 'maybe'})
+
+
+class UpdateTasksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        args = argparse.Namespace(max_concurrency=2, concurrency_group=None,
+                                  allow_overlap=False, backlog_warning=0)
+        self.tasks = [
+            scheduler.Task(cronspec.intern('* * * * *'), 'a'),
+            scheduler.Task(cronspec.intern('*/5 * * * *'), 'b'),
+            scheduler.Task(cronspec.intern('0 * * * *'), 'c')
+        ]
+        self.sched = scheduler.Scheduler(self.tasks, args,
+                                         notification.PrintNotifier(),
+                                         self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_diff(self):
+        a, b, c = self.tasks
+        a.run_count = 5
+        added, removed = self.sched.update_tasks([
+            ('* * * * *', 'a', {"priority": '3'}),
+            ('0 * * * *', 'c', {}),
+            ('0 0 * * *', 'd', {})
+        ])
+        self.assertEqual([x.cmd for x in added], ['d'])
+        self.assertEqual(removed, [b])
+        self.assertIs(self.sched.tasks[0], a)
+        self.assertEqual(a.run_count, 5)
+        self.assertEqual(a.priority, 3)
+        self.assertEqual([x.cmd for x in self.tasks], ['a', 'c', 'd'])
+        self.assertNotIn(b.ident, self.sched.tasks_by_id)
+        self.assertNotIn(b.crontab, self.sched.schedules)
+        self.assertIs(self.sched.schedules[added[0].crontab],
+                      added[0].schedule)
+
+    def test_unchanged_options(self):
+        """ Options are only reapplied to matched tasks when they change. """
+        self.sched.update_tasks([('* * * * *', 'echo hi', {"limit": '2'})])
+        task, = self.tasks
+        argv = task.argv
+        self.assertIsNotNone(argv)
+        self.sched.update_tasks([('* * * * *', 'echo hi', {"limit": '2'})])
+        self.assertIs(self.tasks[0], task)
+        self.assertIs(task.argv, argv)
+        self.sched.update_tasks([('* * * * *', 'echo hi', {"limit": '3'})])
+        self.assertIs(self.tasks[0], task)
+        self.assertEqual(task.limit, 3)
+        self.assertIsNot(task.argv, argv)
+
+    def test_duplicates(self):
+        a = self.tasks[0]
+        added, removed = self.sched.update_tasks([
+            ('* * * * *', 'a', {}),
+            ('* * * * *', 'a', {})
+        ])
+        self.assertIs(self.tasks[0], a)
+        self.assertEqual(len(added), 1)
+        self.assertEqual(len(a.schedule.tasks), 2)
+
+    def test_invalid(self):
+        before = list(self.tasks)
+        self.assertRaises(ValueError, self.sched.update_tasks, [
+            ('* * * * *', 'a', {}),
+            ('99 * * * *', 'x', {})
+        ])
+        self.assertRaises(ValueError, self.sched.update_tasks, [
+            ('* * * * *', 'a', {"nope": '1'})
+        ])
+        self.assertEqual(self.tasks, before)
+
+    def test_queued_unaffected(self):
+        b = self.tasks[1]
+        self.sched.queue.limit = 0
+        context = self.loop.run_until_complete(self.sched.enqueue_task(b))
+        self.sched.update_tasks([('* * * * *', 'a', {})])
+        self.assertEqual([x for x, _ in self.sched.queue.waiting()],
+                         [context])
+        self.assertEqual(b.active, 1)
+
+    def test_load_histogram(self):
+        self.sched.update_tasks([('H * * * *', 'job %d' % i, {})
+                                 for i in range(30)])
+        now = time.mktime((2020, 1, 1, 0, 0, 30, 0, 0, -1))
+        load = self.sched.load_histogram(2, now=now)
+        self.assertEqual(len(load), 60)
+        self.assertEqual(sum(x[1] for x in load), 30)
+        self.assertLess(max(x[0] for x in load), 30)
+
+
+class TaskExecContextTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(1000)
+        self.previous = clock.use(self.clock)
+        task = scheduler.Task(cronspec.intern('* * * * *'), 'true')
+        self.context = scheduler.TaskExecContext(task, None)
+
+    def tearDown(self):
+        clock.use(self.previous)
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.context, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.context, 'nope', 1)
+
+    def test_timing(self):
+        """ Wait and elapsed grow while their phase is live and then stay
+        put. """
+        context = self.context
+        self.clock.advance(10)
+        context.set_queued()
+        self.clock.advance(3)
+        self.assertEqual(context.wait_seconds, 3)
+        self.assertEqual(context.elapsed_seconds, 0)
+        context.set_start()
+        self.clock.advance(4)
+        self.assertEqual(context.elapsed_seconds, 4)
+        context.set_finish(0, '')
+        self.clock.advance(100)
+        self.assertEqual(context.wait_seconds, 3)
+        self.assertEqual(context.elapsed_seconds, 4)
+        self.assertEqual(context.wait.total_seconds(), 3)
+        self.assertEqual(context.elapsed.total_seconds(), 4)
+
+    def test_wall_clock_step(self):
+        """ Timing is monotonic; the wall clock is only read at creation. """
+        context = self.context
+        context.set_queued()
+        context.set_start()
+        self.clock.start -= 3600
+        self.clock.advance(5)
+        context.set_finish(0, '')
+        self.assertEqual(context.elapsed_seconds, 5)
+        self.assertEqual(context.started_ts, 1000)
+        self.assertEqual(context.finished_ts, 1005)
+
+    def test_timestamps(self):
+        context = self.context
+        self.assertIsNone(context.queued_ts)
+        self.assertIsNone(context.started)
+        self.clock.advance(10)
+        context.set_queued()
+        self.clock.advance(2)
+        context.set_start()
+        self.clock.advance(5)
+        context.set_finish(1, 'out')
+        self.assertEqual((context.queued_ts, context.started_ts,
+                          context.finished_ts), (1010, 1012, 1017))
+        self.assertEqual(context.finished.float_timestamp, 1017)
+        info = context.as_dict()
+        self.assertEqual((info['queued'], info['started'], info['finished']),
+                         (1010, 1012, 1017))
+        self.assertEqual((info['wait'], info['elapsed']), (2, 5))
+        self.assertEqual(info['state'], 'finish')
+
+
+class DeadlineTests(unittest.TestCase):
+
+    start = time.mktime((2026, 10, 17, 0, 0, 30, 0, 0, -1))
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(self.start)
+        self.previous = clock.use(self.clock)
+        self.loop = simulate.VirtualEventLoop(self.clock)
+        args = argparse.Namespace(**simulate.defaults)
+        self.tasks = [
+            scheduler.Task(cronspec.intern('* * * * *'), 'a'),
+            scheduler.Task(cronspec.intern('*/5 * * * *'), 'b'),
+            scheduler.Task(cronspec.intern('*/5 * * * *'), 'c')
+        ]
+        self.sched = scheduler.Scheduler(self.tasks, args,
+                                         simulate.CountingNotifier(),
+                                         self.loop, sinks=[])
+        self.fired = []
+
+        @asyncio.coroutine
+        def fire(task, due):
+            self.fired.append((task.cmd, due - self.start))
+        self.sched.fire = fire
+
+    def tearDown(self):
+        self.loop.close()
+        clock.use(self.previous)
+
+    def run_for(self, seconds):
+        runner = self.loop.create_task(self.sched.run())
+        self.loop.run_until_complete(asyncio.sleep(seconds, loop=self.loop))
+        runner.cancel()
+        self.assertRaises(asyncio.CancelledError, self.loop.run_until_complete,
+                          runner)
+
+    def test_fire_times(self):
+        """ Each schedule fires its tasks together at its own deadlines. """
+        self.run_for(600)
+        self.assertEqual(sorted(self.fired), sorted(
+            [('a', 30 + 60 * i) for i in range(10)] +
+            [(x, 270 + 300 * i) for x in 'bc' for i in range(2)]))
+        self.assertEqual(len(self.sched.deadlines), 2)
+
+    def test_reload_before_run(self):
+        """ Schedules added by a reload before the loop starts are only
+        queued once. """
+        self.sched.update_tasks([('* * * * *', 'a', {}),
+                                 ('*/2 * * * *', 'd', {})])
+        self.run_for(240)
+        self.assertEqual(sorted(self.fired), sorted(
+            [('a', 30 + 60 * i) for i in range(4)] +
+            [('d', 90 + 120 * i) for i in range(2)]))
+        self.assertEqual(len(self.sched.deadlines), 2)
+
+
+def running(pid):
+    """ True unless the process is gone or a zombie. """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@unittest.skipUnless(shutil.which('setsid') and os.path.exists('/proc'),
+                     'needs setsid and procfs')
+class TimeoutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        asyncio.get_child_watcher().attach_loop(self.loop)
+        settings = dict(simulate.defaults, max_concurrency=1, kill_grace=0.3,
+                        output_head=1024, output_tail=1024)
+        self.notifier = simulate.CountingNotifier()
+        self.sched = scheduler.Scheduler([], argparse.Namespace(**settings),
+                                         self.notifier, self.loop, sinks=[])
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_kill(self):
+        """ A task ignoring SIGTERM is killed with its process group after
+        the grace period, even while a grandchild that left the group still
+        holds its output pipe. """
+        task = scheduler.Task(cronspec.intern('* * * * *'), 'trap "" TERM; '
+                              'setsid sleep 60 & stray=$!; sleep 60 & '
+                              'echo $! $stray; wait',
+                              {"timeout": '0.3'})
+
+        @asyncio.coroutine
+        def run():
+            context = yield from self.sched.enqueue_task(task)
+            while not context.is_done():
+                yield from asyncio.sleep(0.05, loop=self.loop)
+            return context
+        start = time.monotonic()
+        context = self.loop.run_until_complete(asyncio.wait_for(
+            run(), 10, loop=self.loop))
+        elapsed = time.monotonic() - start
+        grandchild, stray = map(int, context.output.split())
+        os.kill(stray, signal.SIGKILL)
+        self.assertGreater(elapsed, 0.6)  # SIGTERM was ignored.
+        self.assertLess(elapsed, 5)
+        self.assertTrue(context.timed_out)
+        self.assertEqual(context.state, scheduler.ExecState.timeout)
+        self.assertEqual(context.returncode, -signal.SIGKILL)
+        self.assertEqual(task.timeout_count, 1)
+        self.assertFalse(running(grandchild))
+        self.assertEqual(self.notifier.counts['Timeout'], 1)
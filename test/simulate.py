@@ -0,0 +1,69 @@
+"""
+Schedule simulation tests.
+"""
+
+import argparse
+import asyncio
+import time
+import unittest
+from cronredux import clock, simulate
+
+
+class VirtualLoopTests(unittest.TestCase):
+
+    def test_sleep(self):
+        virtual = clock.VirtualClock(1000)
+        loop = simulate.VirtualEventLoop(virtual)
+        try:
+            start = time.monotonic()
+            loop.run_until_complete(asyncio.sleep(86400, loop=loop))
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            loop.close()
+        self.assertAlmostEqual(virtual.time(), 1000 + 86400, places=3)
+
+
+class SimulateTests(unittest.TestCase):
+
+    start = time.mktime((2026, 10, 17, 0, 0, 0, 0, 0, -1))
+
+    def run_sim(self, entries, durations, hours=1, **settings):
+        tasks = simulate.build_tasks(entries, durations)
+        return simulate.simulate(tasks, argparse.Namespace(**settings),
+                                 self.start, hours * 3600)
+
+    def test_queueing(self):
+        entries = [('* * * * *', 'task %d' % i, {}) for i in range(3)]
+        durations = dict(('task %d' % i, 25) for i in range(3))
+        report = self.run_sim(entries, durations, max_concurrency=2)
+        self.assertIs(clock.current.__class__, clock.SystemClock)
+        self.assertEqual(report['executions'], 180)
+        self.assertEqual(report['peak_concurrency'], 2)
+        self.assertEqual(report['saturated_minutes'], 60)
+        self.assertEqual(report['wait']['delayed'], 60)
+        self.assertEqual(report['wait']['max'], 25)
+        self.assertEqual(report['skipped'], 0)
+        self.assertEqual(report['minutes'][0]['starts'], 3)
+
+    def test_skipped_overlap(self):
+        report = self.run_sim([('* * * * *', 'slow', {})], {"slow": 90})
+        self.assertEqual(report['executions'], 30)
+        self.assertEqual(report['skipped'], 30)
+        self.assertEqual(report['skipped_tasks'][0]['cmd'], 'slow')
+        self.assertEqual(report['peak_concurrency'], 1)
+
+    def test_timeout(self):
+        entries = [('*/10 * * * *', 'slow', {"timeout": '60'}),
+                   ('*/10 * * * *', 'other', {})]
+        report = self.run_sim(entries, {"slow": 900, "other": 900},
+                              timeout=120)
+        self.assertEqual(report['timeouts'], 12)
+        self.assertEqual(report['executions'], 12)
+        self.assertEqual(report['skipped'], 0)
+
+    def test_render(self):
+        report = self.run_sim([('*/15 * * * *', 'task', {})], {})
+        text = simulate.render(report)
+        self.assertIn('Peak concurrency:    1', text)
+        self.assertIn(':15', text)
+        self.assertIn('Drained after end:   0s', text)
@@ -0,0 +1,77 @@
+"""
+Watchdog tests
+"""
+
+import unittest
+from cronredux import watchdog
+
+
+class FakeTimer(object):
+
+    def __init__(self, loop, when, callback):
+        self.loop = loop
+        self.when = when
+        self.callback = callback
+
+    def cancel(self):
+        self.loop.timers.remove(self)
+
+
+class FakeLoop(object):
+    """ Just enough of an event loop to drive the watchdog by hand. """
+
+    def __init__(self):
+        self.now = 0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        timer = FakeTimer(self, when, callback)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        self.now += seconds
+        for x in [x for x in self.timers if x.when <= self.now]:
+            self.timers.remove(x)
+            x.callback()
+
+
+class WatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.wd = watchdog.Watchdog(self.loop)
+        self.fired = []
+
+    def test_order(self):
+        self.wd.add(10, self.fired.append, 'b')
+        self.wd.add(5, self.fired.append, 'a')
+        self.wd.add(20, self.fired.append, 'c')
+        self.assertEqual(len(self.loop.timers), 1)
+        self.loop.advance(5)
+        self.assertEqual(self.fired, ['a'])
+        self.loop.advance(10)
+        self.assertEqual(self.fired, ['a', 'b'])
+        self.loop.advance(10)
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+        self.assertEqual(len(self.wd), 0)
+        self.assertEqual(self.loop.timers, [])
+
+    def test_cancel(self):
+        alarm = self.wd.add(5, self.fired.append, 'a')
+        self.wd.add(10, self.fired.append, 'b')
+        alarm.cancel()
+        self.loop.advance(5)
+        self.assertEqual(self.fired, [])
+        self.loop.advance(5)
+        self.assertEqual(self.fired, ['b'])
+
+    def test_single_timer(self):
+        for x in range(1000):
+            self.wd.add(1000 - x, self.fired.append, x)
+        self.assertEqual(len(self.loop.timers), 1)
+        self.loop.advance(1000)
+        self.assertEqual(self.fired, list(reversed(range(1000))))
@@ -0,0 +1,62 @@
+"""
+Python worker pool tests.
+"""
+
+import asyncio
+import unittest
+from cronredux import cronparser, cronspec, output, scheduler, workers
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        asyncio.get_child_watcher().attach_loop(self.loop)
+        self.pool = workers.WorkerPool(self.loop, size=1, max_runs=2)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.pool.close())
+        self.loop.close()
+
+    def run_call(self, command):
+        task = scheduler.Task(cronspec.intern('* * * * *'),
+                              cronparser.PythonCall(command))
+        context = scheduler.TaskExecContext(task, self.loop)
+        context.set_queued()
+        context.set_start()
+        self.loop.run_until_complete(context.run_task(output.OutputCapture(),
+                                                      self.pool))
+        return context
+
+    def test_output(self):
+        context = self.run_call('py:builtins:print hello "big world"')
+        self.assertEqual(context.returncode, 0)
+        self.assertEqual(context.output, 'hello big world\n')
+        self.assertEqual(context.task.run_count, 1)
+
+    def test_failures(self):
+        context = self.run_call('py:json:loads nope')
+        self.assertEqual(context.returncode, 1)
+        self.assertIn('JSONDecodeError', context.output)
+        context = self.run_call('py:no_such_module:main')
+        self.assertEqual(context.returncode, 1)
+        self.assertIn('No module named', context.output)
+
+    def test_recycle(self):
+        for i in range(5):
+            self.assertEqual(self.run_call('py:builtins:print').returncode, 0)
+        self.assertEqual(self.pool.recycled, 2)
+        self.assertEqual(self.pool.count, 1)
+
+    def test_spawn_failure(self):
+        """ A failed background spawn wakes callers waiting for a worker. """
+        self.pool.python = '/nonexistent/python'
+        self.pool.start()
+        self.assertRaises(FileNotFoundError, self.loop.run_until_complete,
+                          asyncio.wait_for(self.pool.acquire(), 5,
+                                           loop=self.loop))
+        self.assertEqual(self.pool.count, 0)
+        del self.pool.python
+        self.assertEqual(self.run_call('py:builtins:print').returncode, 0)
+        self.assertEqual(self.pool.count, 1)